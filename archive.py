@@ -0,0 +1,260 @@
+import os
+import json
+import zlib
+import numpy as np
+from datetime import datetime
+from typing import Dict
+from objects import Activity, ActivityTracker, DAY
+from storage import read_binary_columns, write_binary
+from util import datetime_to_micros
+
+# History split into one binary file per month (or week or year) of start times, next to an
+# index.json holding each partition's per-activity instance counts and totals. Opening the
+# archive reads the index and only the most recent partitions, older ones are read when the
+# instance list scrolls back to them, a report asks for their dates or a change touches them.
+
+INDEX_FILE = 'index.json'
+PERIODS = ['week', 'month', 'year']
+
+def period_keys(starts: np.ndarray, period: str) -> np.ndarray:
+    # weeks start on Monday (1970-01-01 was a Thursday), months and years are numbered from 1970
+    if period == 'week':
+        return (starts // DAY + 3) // 7
+    if period == 'month':
+        return starts.astype('datetime64[us]').astype('datetime64[M]').astype(np.int64)
+    if period == 'year':
+        return starts.astype('datetime64[us]').astype('datetime64[Y]').astype(np.int64)
+    raise Exception(f'Unknown archive period "{period}", expected one of {", ".join(PERIODS)}')
+
+def period_key(micros: int, period: str) -> int:
+    return int(period_keys(np.array([micros], dtype=np.int64), period)[0])
+
+def period_label(key: int, period: str) -> str:
+    if period == 'week':
+        return str(np.datetime64(key * 7 - 3, 'D'))
+    return str(np.datetime64(key, 'M' if period == 'month' else 'Y'))
+
+def partition_file(path: str, label: str) -> str:
+    return os.path.join(path, label + '.ttb')
+
+def read_index(path: str) -> dict | None:
+    index_path = os.path.join(path, INDEX_FILE)
+    if not os.path.exists(index_path):
+        return None
+    with open(index_path, 'r', encoding='utf-8') as f:
+        index = json.loads(f.read())
+    if index.get('version') != 1:
+        raise Exception(f'{index_path} is not a time tracker archive index')
+    return index
+
+def write_atomic(path: str, write):
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as f:
+        write(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+
+def create_archive(path: str, period: str = 'month'):
+    period_keys(np.zeros(0, dtype=np.int64), period)
+    os.makedirs(path, exist_ok=True)
+    if read_index(path) is None:
+        index = { "version": 1, "period": period, "activities": [ ], "totals": { }, "partitions": { } }
+        write_atomic(os.path.join(path, INDEX_FILE), lambda f: f.write(json.dumps(index).encode('utf-8')))
+
+class Archive:
+    path: str
+    period: str
+    partitions: Dict[int, dict]
+    loaded: set
+    tracker: ActivityTracker
+
+    def __init__(self, path: str, index: dict, tracker: ActivityTracker):
+        self.path = path
+        self.period = index["period"]
+        self.partitions = { entry["key"]: dict(entry, label=label) for label, entry in index["partitions"].items() }
+        self.loaded = set()
+        self.tracker = tracker
+
+    def load(self, keys):
+        # reads the partitions in one pass and extends each activity once, so paging in several
+        # months costs one sort per activity
+        keys = sorted(k for k in set(keys) if k in self.partitions and k not in self.loaded)
+        if len(keys) == 0:
+            return False
+        parts = { }
+        for key in keys:
+            names, counts, starts, ends = read_binary_columns(partition_file(self.path, self.partitions[key]["label"]))
+            offset = 0
+            for name, count in zip(names, counts):
+                parts.setdefault(name, ([], []))
+                parts[name][0].append(starts[offset:offset + count])
+                parts[name][1].append(ends[offset:offset + count])
+                offset += count
+            self.loaded.add(key)
+            for name, (count, total) in self.partitions[key]["totals"].items():
+                activity = self.tracker.activities.get(name)
+                if activity is not None:
+                    activity.archived_count -= count
+                    activity.archived_total -= total
+        for name, (starts, ends) in parts.items():
+            self.tracker.add_activity(name)
+            store = self.tracker.activities[name].store
+            starts, ends = np.concatenate(starts), np.concatenate(ends)
+            if len(store) > 0:
+                # a save merged rows held in memory into the partition, the ones in memory win
+                known = np.frombuffer(store.starts, dtype=np.int64)
+                found = np.minimum(np.searchsorted(known, starts), len(known) - 1)
+                fresh = known[found] != starts
+                starts, ends = starts[fresh], ends[fresh]
+            store.extend(starts, ends)
+        return True
+
+    def load_range(self, start: int = None, end: int = None) -> bool:
+        # partitions holding instances that start in [start, end), in microseconds
+        first = None if start is None else period_key(start, self.period)
+        last = None if end is None else period_key(end, self.period)
+        return self.load(k for k in self.partitions if (first is None or k >= first) and (last is None or k <= last))
+
+    def load_starts(self, starts: np.ndarray) -> bool:
+        return self.load(np.unique(period_keys(starts, self.period)).tolist())
+
+    def load_activity(self, name: str) -> bool:
+        return self.load(k for k, entry in self.partitions.items() if name in entry["totals"])
+
+    def load_older(self, name: str) -> bool:
+        # the newest partition not read yet that has instances of name
+        keys = [k for k, entry in self.partitions.items() if k not in self.loaded and name in entry["totals"]]
+        if len(keys) == 0:
+            return False
+        return self.load([max(keys)])
+
+    def load_all(self) -> bool:
+        return self.load(self.partitions.keys())
+
+    def unread_periods(self) -> set:
+        # partitions on disk whose rows are not in memory, periods missing from partitions
+        # (like the ones first written by this session) are held in memory completely
+        return set(k for k in self.partitions if k not in self.loaded)
+
+    def unread_files(self) -> list:
+        # the files of the unread partitions, they are only replaced whole so another thread can read them
+        return [partition_file(self.path, self.partitions[k]["label"]) for k in sorted(self.unread_periods())]
+
+    def saved(self, partitions: Dict[int, dict], held: set):
+        # called with save_archive's result once it is written. The partitions in held now
+        # contain exactly the rows that were in memory, the others keep the entry their
+        # archived counts were taken from.
+        for key in held:
+            self.partitions[key] = partitions[key]
+            self.loaded.add(key)
+        for key in list(self.partitions):
+            if key not in partitions:
+                del self.partitions[key]
+                self.loaded.discard(key)
+
+def open_archive(path: str, period: str = 'month', recent: int = 2, window_days: int = 7) -> ActivityTracker:
+    # reads the newest recent partitions plus every partition within window_days of today,
+    # so the 7 day column is complete, the rest only counts towards the activity totals
+    index = read_index(path)
+    if index is None:
+        create_archive(path, period)
+        index = read_index(path)
+    tracker = ActivityTracker({ name: Activity(name) for name in index["activities"] })
+    archive = Archive(path, index, tracker)
+    tracker.archive = archive
+    for name, (count, total) in index["totals"].items():
+        tracker.add_activity(name)
+        tracker.activities[name].archived_count = count
+        tracker.activities[name].archived_total = total
+    keys = sorted(archive.partitions)
+    first = period_key(datetime_to_micros(datetime.now()) - window_days * DAY, archive.period)
+    archive.load(keys[max(len(keys) - recent, 0):] + [k for k in keys if k >= first])
+    return tracker
+
+def merge_unread(path: str, entry: dict, key: int, names: list, codes: np.ndarray, starts: np.ndarray, ends: np.ndarray, keys: np.ndarray):
+    # a change reached a partition that was never read, so its rows on disk are kept as well
+    disk_names, disk_counts, disk_starts, disk_ends = read_binary_columns(partition_file(path, entry["label"]))
+    disk_codes = np.repeat(np.arange(len(disk_names)), disk_counts)
+    mine = keys == key
+    present = set(zip((names[c] for c in codes[mine].tolist()), starts[mine].tolist()))
+    keep = np.array([(disk_names[c], s) not in present for c, s in zip(disk_codes.tolist(), disk_starts.tolist())], dtype=bool)
+    known = { name: n for n, name in enumerate(names) }
+    extra = np.array([known.setdefault(disk_names[c], len(known)) for c in disk_codes[keep].tolist()], dtype=np.int64)
+    return (
+        list(known),
+        np.concatenate([codes, extra]),
+        np.concatenate([starts, disk_starts[keep]]),
+        np.concatenate([ends, disk_ends[keep]]),
+        np.concatenate([keys, np.full(len(extra), key, dtype=np.int64)])
+    )
+
+def save_archive(columns, path: str, unread: set = None, period: str = 'month'):
+    # columns hold every instance except the ones in the partitions in unread, which are kept
+    # on disk and merged with any of their rows that are in columns. Partitions missing from
+    # both are dropped, and partitions whose content did not change are not rewritten. Returns
+    # the partitions after the save by key and the keys written from columns alone, for
+    # Archive.saved.
+    names, counts, starts, ends = columns
+    create_archive(path, period)
+    index = read_index(path)
+    period = index["period"]
+    partitions = { entry["key"]: dict(entry, label=label) for label, entry in index["partitions"].items() }
+    names = list(names)
+    codes = np.repeat(np.arange(len(names)), counts)
+    keys = period_keys(starts, period)
+    unread = unread if unread is not None else set()
+    merged = set()
+    for key in np.unique(keys).tolist():
+        if key in partitions and key in unread:
+            names, codes, starts, ends, keys = merge_unread(path, partitions[key], key, names, codes, starts, ends, keys)
+            merged.add(key)
+    order = np.lexsort((starts, codes, keys))
+    codes, starts, ends, keys = codes[order], starts[order], ends[order], keys[order]
+    bounds = (np.flatnonzero(np.diff(keys)) + 1).tolist()
+    written = set()
+    for lo, hi in zip([0] + bounds, bounds + [len(keys)]):
+        if hi <= lo:
+            continue
+        key = int(keys[lo])
+        used, local = np.unique(codes[lo:hi], return_inverse=True)
+        firsts = np.concatenate([[0], np.flatnonzero(np.diff(local)) + 1])
+        part_names = [names[c] for c in used.tolist()]
+        part_counts = np.diff(np.append(firsts, hi - lo)).tolist()
+        sums = np.add.reduceat(ends[lo:hi] - starts[lo:hi], firsts).tolist()
+        part = (part_names, part_counts, starts[lo:hi], ends[lo:hi])
+        crc = zlib.crc32(json.dumps([part_names, part_counts]).encode('utf-8'))
+        crc = zlib.crc32(ends[lo:hi].tobytes(), zlib.crc32(starts[lo:hi].tobytes(), crc))
+        written.add(key)
+        if key in partitions and partitions[key].get("crc") == crc:
+            continue
+        label = period_label(key, period)
+        write_atomic(partition_file(path, label), lambda f: write_binary(part, f))
+        partitions[key] = {
+            "key": key,
+            "label": label,
+            "rows": hi - lo,
+            "crc": crc,
+            "totals": { name: [count, total] for name, count, total in zip(part_names, part_counts, sums) }
+        }
+    for key in list(partitions):
+        if key not in written and key not in unread:
+            # every row of this period is gone
+            os.remove(partition_file(path, partitions[key]["label"]))
+            del partitions[key]
+    totals = { }
+    for entry in partitions.values():
+        for name, (count, total) in entry["totals"].items():
+            summed = totals.setdefault(name, [0, 0])
+            summed[0] += count
+            summed[1] += total
+    index = {
+        "version": 1,
+        "period": period,
+        "activities": names,
+        # per-activity sums over every partition, so opening the archive does not add them up
+        "totals": totals,
+        "partitions": { entry["label"]: { k: v for k, v in entry.items() if k != "label" } for _, entry in sorted(partitions.items()) }
+    }
+    write_atomic(os.path.join(path, INDEX_FILE), lambda f: f.write(json.dumps(index).encode('utf-8')))
+    return partitions, written - merged
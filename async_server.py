@@ -0,0 +1,394 @@
+import io
+import json
+import bisect
+import signal
+import asyncio
+from typing import Dict, List
+from time_tracker_server import InvalidChange, RevisionStore, ShardIndex, config, load_config, queries, read_csv_rows
+from metrics import Metrics
+from transfer import CHUNK_SIZE, MIN_COMPRESS_SIZE, BodyTooLarge, available_encodings, choose_encoding, compress, decoding_reader
+
+# The same endpoints as time_tracker_server.py served from one event loop, so an idle or slow
+# connection costs a socket and a coroutine instead of a thread. Every shard is read once and
+# then changed in memory, and changes are appended to the journal in batches on a worker thread
+# with one fsync each (group commit). A response is only sent once every change staged before it
+# is on disk, so nothing a client has seen can be lost and its revision reissued after a crash.
+# The full /retrieve body is kept encoded per revision and content encoding until the next change.
+# Parsing bodies, building the query index and the /retrieve body run on worker threads, holding
+# the shard's lock so the loop does not stage changes into the rows they read.
+
+MAX_HEADERS = 100
+MAX_BODY_SIZE = 64 * 1024 * 1024
+STATUS_TEXT = { 200: 'OK', 400: 'Bad Request', 401: 'Unauthorized', 404: 'Not Found', 413: 'Content Too Large', 500: 'Internal Server Error' }
+
+class AsyncServer:
+    shards: ShardIndex
+    metrics: Metrics
+    commit_delay: float
+    idle_timeout: float
+    max_body_size: int
+    pending: Dict[RevisionStore, List[dict]]
+    batch: asyncio.Future | None
+    writing: asyncio.Future | None
+    payloads: Dict[RevisionStore, tuple]
+    locks: Dict[RevisionStore, asyncio.Lock]
+    segments: Dict[RevisionStore, Dict[str, bytes]]
+    encoded: Dict[RevisionStore, List[str]]
+    flushing: asyncio.Task | None
+    writers: set
+
+    def __init__(self, shards: ShardIndex, metrics: Metrics = None, commit_delay_ms: float = 0, idle_timeout: float = 60, max_body_size: int = MAX_BODY_SIZE):
+        self.shards = shards
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.commit_delay = commit_delay_ms / 1000
+        self.idle_timeout = idle_timeout
+        self.max_body_size = max_body_size
+        self.pending = { }
+        self.batch = None
+        self.writing = None
+        self.payloads = { }
+        self.locks = { }
+        self.segments = { }
+        self.encoded = { }
+        self.flushing = None
+        self.writers = set()
+
+    async def get_store(self, user: str | None) -> RevisionStore:
+        store = self.shards.shards.get(user)
+        if store is not None:
+            return store
+        # the first request for a shard reads its journal off the loop
+        return await asyncio.to_thread(self.shards.get, user)
+
+    def store_lock(self, store: RevisionStore) -> asyncio.Lock:
+        # held by stage and while a worker thread reads the store
+        return self.locks.setdefault(store, asyncio.Lock())
+
+    async def in_thread(self, store: RevisionStore, func, *args):
+        async with self.store_lock(store):
+            return await asyncio.to_thread(func, *args)
+
+    # group commit
+
+    def stage(self, store: RevisionStore, records: List[dict]) -> List[dict]:
+        # callers hold store_lock
+        committed = store.stage(records)
+        segments = self.segments.get(store, { })
+        for change in committed:
+            segments.pop(change.get('activity'), None)
+        encoded = self.encoded.get(store)
+        if encoded is not None:
+            encoded.extend(json.dumps(c) for c in committed)
+        if len(committed) > 0:
+            self.pending.setdefault(store, [ ]).extend(committed)
+            if self.batch is None:
+                self.batch = asyncio.get_running_loop().create_future()
+            if self.flushing is None or self.flushing.done():
+                self.flushing = asyncio.create_task(self.flush_later())
+        return committed
+
+    async def flush_later(self):
+        # requests already read stage their changes first and share the fsync
+        await asyncio.sleep(self.commit_delay)
+        await self.flush()
+
+    async def flush(self):
+        # one batch at a time on a worker thread, changes staged meanwhile go in the next one
+        while len(self.pending) > 0:
+            pending, batch = self.pending, self.batch
+            self.pending, self.batch = { }, None
+            self.writing = batch
+            try:
+                with self.metrics.timer('flush'):
+                    await asyncio.to_thread(self.append, pending)
+            except OSError as e:
+                print(f'Could not write changes: {e}')
+                batch.set_exception(e)
+            else:
+                batch.set_result(None)
+            finally:
+                self.writing = None
+            for store in pending:
+                if store not in self.pending and store.should_compact():
+                    with self.metrics.timer('compact'):
+                        await self.compact(store)
+
+    def append(self, pending: Dict[RevisionStore, List[dict]]):
+        for store, committed in pending.items():
+            store.append(committed)
+
+    async def synced(self):
+        # waits until every change staged so far is on disk
+        batches = [b for b in (self.writing, self.batch) if b is not None]
+        if len(batches) > 0:
+            await asyncio.gather(*batches)
+
+    async def compact(self, store: RevisionStore):
+        kept = store.compacted()
+        count = len(store.changes)
+        await asyncio.to_thread(store.rewrite, kept)
+        # changes staged while the file was rewritten are still pending and follow the kept ones
+        print(f'Compacted {count} changes into {len(kept)}')
+        store.changes = kept + store.changes[count:]
+        store.revisions = [c['rev'] for c in store.changes]
+        self.encoded.pop(store, None)
+
+    async def close(self):
+        # drops idle keep-alive connections and writes what is still pending
+        for writer in list(self.writers):
+            writer.close()
+        if self.flushing is not None:
+            await self.flushing
+        await self.flush()
+
+    # cached /retrieve payloads
+
+    def retrieve_payload(self, store: RevisionStore, encoding: str | None) -> asyncio.Future:
+        revision, encoded = self.payloads.get(store, (None, None))
+        if revision != store.revision:
+            encoded = { }
+            self.payloads[store] = (store.revision, encoded)
+        if encoding not in encoded:
+            # concurrent requests for the same revision share one build
+            encoded[encoding] = asyncio.ensure_future(self.encode_payload(store, encoding))
+        return encoded[encoding]
+
+    async def encode_payload(self, store: RevisionStore, encoding: str | None) -> bytes:
+        if encoding is None:
+            return await self.in_thread(store, self.csv_payload, store)
+        data = await self.retrieve_payload(store, None)
+        return await asyncio.to_thread(compress, data, encoding)
+
+    def csv_payload(self, store: RevisionStore) -> bytes:
+        # store.to_csv() from the rows of each activity, kept until a change touches that activity,
+        # so a sync to one activity does not reformat the others
+        segments = self.segments.setdefault(store, { })
+        parts = [b'Activity,Start,End\n']
+        for name in store.rows:
+            segment = segments.get(name)
+            if segment is None:
+                segment = segments[name] = store.activity_csv(name).encode('utf-8')
+            parts.append(segment)
+        return b''.join(parts)
+
+    def changes_since(self, store: RevisionStore, revision: int) -> str:
+        # json.dumps(store.since(revision)) from each change encoded once
+        encoded = self.encoded.get(store)
+        if encoded is None:
+            encoded = self.encoded[store] = [json.dumps(c) for c in store.changes]
+        return '[' + ', '.join(encoded[bisect.bisect_right(store.revisions, revision):]) + ']'
+
+    # HTTP
+
+    async def serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.writers.add(writer)
+        try:
+            while True:
+                try:
+                    line = await asyncio.wait_for(reader.readline(), self.idle_timeout)
+                except asyncio.TimeoutError:
+                    break
+                if len(line) == 0:
+                    break
+                if line in (b'\r\n', b'\n'):
+                    continue
+                keep_alive = await self.handle(line, reader, writer)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError):
+            pass
+        finally:
+            self.writers.discard(writer)
+            writer.close()
+
+    async def read_headers(self, reader: asyncio.StreamReader) -> Dict[str, str]:
+        headers = { }
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                return headers
+            if len(headers) >= MAX_HEADERS:
+                raise ValueError('Too many headers')
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+    async def read_body(self, reader: asyncio.StreamReader, headers: Dict[str, str]) -> bytes:
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = [ ]
+            received = 0
+            while True:
+                size = int((await reader.readline()).split(b';')[0].strip(), 16)
+                received += size
+                if received > self.max_body_size:
+                    raise BodyTooLarge()
+                if size == 0:
+                    while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                        pass
+                    return b''.join(chunks)
+                chunks.append(await reader.readexactly(size))
+                await reader.readline()
+        length = int(headers.get('content-length', 0))
+        if length > self.max_body_size:
+            raise BodyTooLarge()
+        return await reader.readexactly(length)
+
+    async def handle(self, line: bytes, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> bool:
+        method, path, version = line.decode('latin-1').split()
+        headers = await self.read_headers(reader)
+        connection = headers.get('connection', '').lower()
+        keep_alive = connection != 'close' and (version == 'HTTP/1.1' or connection == 'keep-alive')
+        if method == 'GET':
+            status, content_type, body, encoding = self.handle_get(path)
+        elif method == 'POST':
+            endpoint = self.endpoint(path)
+            with self.metrics.timer('request' + endpoint):
+                try:
+                    raw = await self.read_body(reader, headers)
+                except BodyTooLarge:
+                    # the rest of the body is not read, the connection is closed instead
+                    raw = b''
+                    status, content_type, body, encoding = 413, 'text/plain', 'Request body too large'.encode(), None
+                else:
+                    status, content_type, body, encoding = await self.handle_post(path, headers, raw)
+            self.metrics.count('requests' + endpoint)
+            if status != 200:
+                self.metrics.count('errors' + endpoint)
+            self.metrics.observe('request_bytes' + endpoint, len(raw))
+        else:
+            status, content_type, body, encoding = 400, 'text/plain', f'Unsupported method {method}'.encode(), None
+        if status != 200:
+            keep_alive = False
+        if encoding is None and len(body) >= MIN_COMPRESS_SIZE:
+            encoding = choose_encoding(headers.get('accept-encoding'))
+            if encoding is not None:
+                body = await asyncio.to_thread(compress, body, encoding) if len(body) >= CHUNK_SIZE else compress(body, encoding)
+        if method == 'POST':
+            self.metrics.observe('response_bytes' + self.endpoint(path), len(body))
+        head = [
+            f'HTTP/1.1 {status} {STATUS_TEXT.get(status, "")}',
+            f'Content-type: {content_type}',
+            f'Accept-Encoding: {", ".join(available_encodings())}',
+            f'Content-Length: {len(body)}'
+        ]
+        if encoding is not None:
+            head.append(f'Content-Encoding: {encoding}')
+        if not keep_alive:
+            head.append('Connection: close')
+        writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1') + body)
+        await writer.drain()
+        return keep_alive
+
+    def endpoint(self, path: str) -> str:
+        if path in ('/retrieve', '/sync'):
+            return path
+        if path.startswith('/query/') and path[len('/query/'):] in queries:
+            return path
+        return '/other'
+
+    def handle_get(self, path: str) -> tuple:
+        if path == '/metrics':
+            if not self.metrics.enabled:
+                return 404, 'text/plain', 'Metrics are disabled'.encode(), None
+            return 200, 'application/json', self.metrics.to_json().encode(), None
+        return 200, 'text/plain', 'success'.encode(), None
+
+    async def handle_post(self, path: str, headers: Dict[str, str], raw: bytes) -> tuple:
+        ret_data = 'blank'
+        content_type = 'text/plain'
+        try:
+            body = decoding_reader(io.BytesIO(raw), headers.get('content-encoding'), self.max_body_size)
+            if headers.get('content-type', '').startswith('text/csv'):
+                post_data = {
+                    'user': headers.get('x-user'),
+                    'password': headers.get('x-password'),
+                    'data': io.TextIOWrapper(body, encoding='utf-8', newline='')
+                }
+            else:
+                post_data = await asyncio.to_thread(json.load, body)
+            user = post_data.get('user')
+            if not self.shards.authenticate(user, post_data['password']):
+                ret_data = 'Unauthorized'
+                raise Exception('Unauthorized')
+            store = await self.get_store(user)
+            if path == '/retrieve' and 'since' in post_data:
+                content_type = 'application/json'
+                ret_data = f'{{"revision": {store.revision}, "changes": {self.changes_since(store, int(post_data["since"]))}}}'
+            elif path == '/retrieve':
+                if store.is_empty():
+                    ret_data = 'File does not exist'
+                    raise Exception('File not found')
+                encoding = choose_encoding(headers.get('accept-encoding'))
+                payload = await self.retrieve_payload(store, encoding)
+                await self.synced()
+                return 200, content_type, payload, encoding
+            if path.startswith('/query/'):
+                content_type = 'application/json'
+                # the first query builds the index from every row
+                ret_data = json.dumps(await self.in_thread(store, store.query, path[len('/query/'):], post_data))
+            if path == '/sync' and 'changes' in post_data:
+                since = int(post_data['since'])
+                content_type = 'application/json'
+                async with self.store_lock(store):
+                    newer = self.changes_since(store, since)
+                    self.stage(store, post_data['changes'])
+                    ret_data = f'{{"revision": {store.revision}, "changes": {newer}}}'
+            elif path == '/sync':
+                ret_data = 'synced'
+                rows = await asyncio.to_thread(read_csv_rows, post_data['data'])
+                async with self.store_lock(store):
+                    records = await asyncio.to_thread(store.csv_records, rows)
+                    self.stage(store, records)
+            # also for reads, which may show changes another request staged
+            await self.synced()
+        except BodyTooLarge:
+            return 413, 'text/plain', 'Request body too large'.encode(), None
+        except InvalidChange as e:
+            print(e)
+            return 400, 'text/plain', str(e).encode(), None
+        except OSError as e:
+            print(e)
+            return 500, 'text/plain', 'Could not save changes'.encode(), None
+        except Exception as e:
+            print(e)
+            return 401, content_type, ret_data.encode(), None
+        return 200, content_type, ret_data.encode(), None
+
+async def start_server(host: str, port: int, app: AsyncServer, backlog: int = 4096) -> asyncio.Server:
+    return await asyncio.start_server(app.serve, host, port, backlog=backlog, limit=CHUNK_SIZE)
+
+def raise_file_limit():
+    # every connection holds a file descriptor and the default soft limit is often 1024
+    try:
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    wanted = 65536 if hard == resource.RLIM_INFINITY else hard
+    if soft != resource.RLIM_INFINITY and soft < wanted:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (wanted, hard))
+
+async def run(port: int):
+    shards = ShardIndex('.', config.get('password'), config.get('users'))
+    metrics = Metrics(config.get('metrics', False), config.get('profile'))
+    app = AsyncServer(shards, metrics, config.get('commit_delay_ms', 0), config.get('idle_timeout', 60), config.get('max_body_mb', 64) * 1024 * 1024)
+    httpd = await start_server('', port, app)
+    print(f'Starting async server on port {port}...')
+    # a terminated server still writes the changes it has staged
+    stopped = asyncio.Event()
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stopped.set)
+    except NotImplementedError:
+        pass
+    try:
+        async with httpd:
+            await stopped.wait()
+    finally:
+        await app.close()
+
+if __name__ == '__main__':
+    load_config()
+    raise_file_limit()
+    try:
+        asyncio.run(run(int(config['server_port'])))
+    except KeyboardInterrupt:
+        pass
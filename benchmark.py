@@ -0,0 +1,276 @@
+import os
+import sys
+import time
+import json
+import random
+import tempfile
+import subprocess
+import pandas as pd
+from datetime import datetime, timedelta
+from objects import Activity, ActivityInstance, ActivityTracker
+from util import str_to_datetime, datetime_to_micros
+
+def make_tracker(num_instances: int, num_activities: int = 20, seed: int = 0) -> ActivityTracker:
+    rng = random.Random(seed)
+    names = [f'Activity {n}' for n in range(num_activities)]
+    starts = {name: [] for name in names}
+    ends = {name: [] for name in names}
+    t = datetime_to_micros(datetime(2020, 1, 1, 8, 0, 0, 123456))
+    for _ in range(num_instances):
+        start = t + rng.randint(60, 7200) * 1_000_000
+        end = start + rng.randint(60, 7200) * 1_000_000 + rng.randint(0, 999999)
+        name = rng.choice(names)
+        starts[name].append(start)
+        ends[name].append(end)
+        t = end
+    return ActivityTracker({name: Activity.from_arrays(name, starts[name], ends[name]) for name in names})
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return time.perf_counter() - start, result
+
+def bench_save(sizes):
+    print('Save (to_dataframe + to_csv)')
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'activities.csv')
+        for n in sizes:
+            tracker = make_tracker(n)
+            build, df = timed(tracker.to_dataframe)
+            write, _ = timed(lambda: df.to_csv(path, index=False))
+            size = os.path.getsize(path)
+            print(f'  {n:>9,} instances: to_dataframe {build:8.3f} s, to_csv {write:8.3f} s, {size / n:.1f} bytes/instance')
+
+def reference_from_dataframe(df: pd.DataFrame) -> ActivityTracker:
+    instances = { }
+    for _, row in df.iterrows():
+        name = row["Activity"]
+        if not name in instances:
+            instances[name] = [ ]
+        start = str_to_datetime(row["Start"])
+        end = str_to_datetime(row["End"])
+        instances[name].append(ActivityInstance(start, end, end - start))
+    return ActivityTracker({k: Activity(k, v) for k, v in instances.items()})
+
+def tracker_rows(tracker: ActivityTracker):
+    return [
+        (a.name, i.start_time, i.end_time, i.duration)
+        for a in tracker.activities.values()
+        for i in a.instances
+    ]
+
+def bench_load(sizes, check_limit=100_000):
+    print('Load (read_csv + from_dataframe)')
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'activities.csv')
+        for n in sizes:
+            make_tracker(n).to_dataframe().to_csv(path, index=False)
+            read, df = timed(lambda: pd.read_csv(path))
+            load, tracker = timed(lambda: ActivityTracker.from_dataframe(df))
+            line = f'  {n:>9,} instances: read_csv {read:8.3f} s, from_dataframe {load:8.3f} s'
+            if n <= check_limit:
+                ref_time, reference = timed(lambda: reference_from_dataframe(df))
+                if tracker_rows(tracker) != tracker_rows(reference):
+                    raise Exception(f'from_dataframe does not match the reference loader at {n} instances')
+                line += f', row-by-row {ref_time:8.3f} s (matches)'
+            print(line)
+
+def bench_formats(sizes):
+    import importlib.util
+    from storage import file_names, load_tracker, save_tracker, cache_path
+    formats = ['csv', 'binary']
+    if importlib.util.find_spec('pyarrow') is not None:
+        formats.append('parquet')
+    print('Storage formats (save_tracker / load_tracker)')
+    with tempfile.TemporaryDirectory() as tmp:
+        for n in sizes:
+            tracker = make_tracker(n)
+            for storage_format in formats:
+                path = os.path.join(tmp, file_names[storage_format])
+                save, _ = timed(lambda: save_tracker(tracker, path))
+                if os.path.exists(cache_path(path)):
+                    os.remove(cache_path(path))
+                load, loaded = timed(lambda: load_tracker(path))
+                if tracker_rows(loaded) != tracker_rows(tracker):
+                    raise Exception(f'{storage_format} round trip does not match at {n} instances')
+                size = os.path.getsize(path)
+                print(f'  {n:>9,} instances, {storage_format:<7}: save {save:8.3f} s, load {load:8.3f} s, {size / n:5.1f} bytes/instance')
+
+def bench_archive(sizes):
+    # opening an archive reads its index and the newest partitions, the older ones stay on disk
+    import gc
+    import tracemalloc
+    from storage import load_tracker, save_tracker
+    print('Archive startup (open_archive / load_tracker of the binary file)')
+    with tempfile.TemporaryDirectory() as tmp:
+        for n in sizes:
+            # move the history so it ends today, the way a real one does
+            names, counts, starts, ends = make_tracker(n).to_columns()
+            shift = datetime_to_micros(datetime.now()) - int(ends.max())
+            tracker = ActivityTracker.from_columns(names, counts, starts + shift, ends + shift)
+            archive_path = os.path.join(tmp, f'{n}.archive')
+            binary_path = os.path.join(tmp, f'{n}.ttb')
+            save_tracker(tracker, archive_path)
+            save_tracker(tracker, binary_path)
+            results = { }
+            for name, path in [('archive', archive_path), ('binary', binary_path)]:
+                gc.collect()
+                tracemalloc.start()
+                load, loaded = timed(lambda: load_tracker(path))
+                results[name] = (load, tracemalloc.get_traced_memory()[0], loaded)
+                tracemalloc.stop()
+            loaded = results['archive'][2]
+            if any(loaded.activities[a.name].get_total_time() != a.get_total_time() for a in tracker.activities.values()):
+                raise Exception(f'archive totals do not match at {n} instances')
+            rows = sum(len(a.store) for a in loaded.activities.values())
+            print(f'  {n:>9,} instances: archive {results["archive"][0]:7.3f} s {results["archive"][1] / 1e6:7.2f} MB ' +
+                  f'({len(loaded.archive.loaded)} of {len(loaded.archive.partitions)} months, {rows:,} instances read), ' +
+                  f'binary {results["binary"][0]:7.3f} s {results["binary"][1] / 1e6:7.2f} MB')
+            del tracker, loaded, results
+
+class LegacyInstance:
+    def __init__(self, start_time, end_time, duration):
+        self.start_time = start_time
+        self.end_time = end_time
+        self.duration = duration
+
+def bench_memory(sizes):
+    import gc
+    import tracemalloc
+    print('Memory (tracemalloc, instances only)')
+    for n in sizes:
+        names, counts, starts, ends = make_tracker(n).to_columns()
+        gc.collect()
+        tracemalloc.start()
+        tracker = ActivityTracker.from_columns(names, counts, starts, ends)
+        compact = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        gc.collect()
+        tracemalloc.start()
+        legacy = [
+            LegacyInstance(s, e, e - s)
+            for s, e in zip(starts.astype('datetime64[us]').tolist(), ends.astype('datetime64[us]').tolist())
+        ]
+        objects = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        print(f'  {n:>9,} instances: array store {compact / n:6.1f} bytes/instance, objects {objects / n:6.1f} bytes/instance')
+        del tracker, legacy
+
+def bench_timer(ticks=100_000):
+    from codec import format_seconds
+    print('Live timer tick (text for the running timer)')
+    tracker = make_tracker(1000)
+    name = next(iter(tracker.activities))
+    tracker.set_activity(name)
+    tracker.start_timer(name)
+    old, _ = timed(lambda: [tracker.get_current_time() for _ in range(ticks)])
+    started = time.monotonic() - 3725
+    new, _ = timed(lambda: [format_seconds(int(time.monotonic() - started)) for _ in range(ticks)])
+    print(f'  get_current_time {old / ticks * 1e6:6.2f} us/tick, LiveTimer {new / ticks * 1e6:6.2f} us/tick')
+
+def bench_codec(count=200_000):
+    # the strftime/strptime/str(timedelta) versions the codec replaced, checked for identical text
+    import codec
+    from codec import TIME_FORMAT
+    from util import datetime_to_str, str_to_datetime
+    print('Timestamp and duration text')
+    rng = random.Random(3)
+    base = datetime_to_micros(datetime(1999, 1, 1))
+    micros = [base + rng.randint(0, 40 * 365 * 86400) * 1_000_000 + rng.randint(0, 999999) for _ in range(count)]
+    epoch = datetime(1970, 1, 1)
+    times = [epoch + timedelta(microseconds=us) for us in micros]
+    durations = [rng.randint(-10 ** 11, 10 ** 12) for _ in range(count)]
+    strings = [t.strftime(TIME_FORMAT) for t in times]
+    cases = [
+        ('datetime_to_str', lambda: [t.strftime(TIME_FORMAT) for t in times], lambda: [datetime_to_str(t) for t in times]),
+        ('format_timestamp', lambda: [(epoch + timedelta(microseconds=us)).strftime(TIME_FORMAT) for us in micros], lambda: [codec.format_timestamp(us) for us in micros]),
+        ('str_to_datetime', lambda: [datetime.strptime(s, TIME_FORMAT) for s in strings], lambda: [str_to_datetime(s) for s in strings]),
+        ('parse_timestamp', lambda: [(datetime.strptime(s, TIME_FORMAT) - epoch) // timedelta(microseconds=1) for s in strings], lambda: [codec.parse_timestamp(s) for s in strings]),
+        ('format_duration', lambda: [str(timedelta(microseconds=us)).split('.')[0] for us in durations], lambda: [codec.format_duration(us) for us in durations]),
+        ('pretty_date', lambda: [t.strftime('%y/%m/%d') for t in times], lambda: [codec.format_date(us) for us in micros]),
+        ('pretty_start_time', lambda: [t.strftime('%H:%M') for t in times], lambda: [codec.format_clock(us) for us in micros]),
+    ]
+    for name, old_fn, new_fn in cases:
+        old, old_values = timed(old_fn)
+        new, new_values = timed(new_fn)
+        if old_values != new_values:
+            raise Exception(f'{name} does not match the old text')
+        print(f'  {name:<18} old {old / count * 1e6:6.2f} us, new {new / count * 1e6:6.2f} us ({old / new:4.1f}x), identical for {count:,} values')
+
+IMPORTS = '''
+import sys, time
+sys.path.insert(0, {root!r})
+begin = time.perf_counter()
+{extra}import objects, storage, journal, sync_client, worker, instance_view
+print(time.perf_counter() - begin)
+'''
+
+def bench_imports(runs=5):
+    print('Import time (objects, storage, journal, sync_client, worker, instance_view)')
+    root = os.path.dirname(os.path.abspath(__file__))
+    for label, extra in [('lazy pandas', ''), ('eager pandas', 'import pandas\n')]:
+        code = IMPORTS.format(root=root, extra=extra)
+        times = [float(subprocess.check_output([sys.executable, '-c', code])) for _ in range(runs)]
+        print(f'  {label:<12}: {min(times) * 1000:7.1f} ms (best of {runs})')
+
+# Runs in a fresh interpreter inside a directory holding activities.csv and config.json. Without
+# a display it stops once the data the window would show is in memory.
+STARTUP = '''
+import sys, time, json
+begin = time.perf_counter()
+sys.path.insert(0, {root!r})
+import tkinter as tk
+try:
+    tk.Tk().destroy()
+    display = True
+except tk.TclError:
+    display = False
+if display:
+    import main
+    app = main.TimeTrackerApp()
+    app.update()
+    ready = time.perf_counter() - begin
+    app.close()
+else:
+    from storage import load_tracker, read_cache
+    tracker, fresh = read_cache('activities.csv')
+    if tracker is None:
+        tracker = load_tracker('activities.csv')
+    ready = time.perf_counter() - begin
+print(json.dumps({{ "ready": ready, "display": display, "pandas": "pandas" in sys.modules }}))
+'''
+
+def run_startup(directory: str) -> dict:
+    code = STARTUP.format(root=os.path.dirname(os.path.abspath(__file__)))
+    return json.loads(subprocess.check_output([sys.executable, '-c', code], cwd=directory).decode().splitlines()[-1])
+
+def bench_startup(sizes):
+    from storage import cache_path
+    print('Startup (process start to first paint, or to data in memory without a display)')
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'activities.csv')
+        with open(os.path.join(tmp, 'config.json'), 'w', encoding='utf-8') as f:
+            f.write(json.dumps({ "sync": "full" }))
+        for n in sizes:
+            make_tracker(n).to_dataframe().to_csv(path, index=False)
+            if os.path.exists(cache_path(path)):
+                os.remove(cache_path(path))
+            cold = run_startup(tmp)
+            warm = run_startup(tmp)
+            os.utime(path)
+            stale = run_startup(tmp)
+            kind = 'first paint' if cold["display"] else 'data ready'
+            print(f'  {n:>9,} instances, {kind}: no cache {cold["ready"]:7.3f} s, cache {warm["ready"]:7.3f} s, ' +
+                  f'stale cache {stale["ready"]:7.3f} s (pandas imported: {cold["pandas"]}/{warm["pandas"]}/{stale["pandas"]})')
+
+if __name__ == "__main__":
+    sizes = [int(s) for s in sys.argv[1:]] or [10_000, 100_000, 1_000_000]
+    bench_save(sizes)
+    bench_load(sizes)
+    bench_formats(sizes)
+    bench_archive(sizes)
+    bench_memory(sizes)
+    bench_timer()
+    bench_codec()
+    bench_imports()
+    bench_startup(sizes)
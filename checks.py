@@ -0,0 +1,172 @@
+import os
+import sys
+import json
+import time
+import tempfile
+import subprocess
+from datetime import datetime, timedelta
+from objects import ActivityTracker
+from importer import run_import
+from harness import check, sorted_rows
+from benchmark import make_tracker
+from archive import open_archive
+from journal import Journal, apply_record, make_record
+from storage import cache_key, hold_lock, load_tracker, lock_holder, lock_path, read_cache, release_lock, save_columns, save_tracker
+from util import datetime_to_micros
+from codec import format_timestamp
+
+# Checks of the local history code that need no server, run with python checks.py. They raise
+# on the first failure like harness.py.
+
+def local_time(text: str) -> int:
+    # what an ISO 8601 time with an offset reads as on this machine's clock
+    return datetime_to_micros(datetime.fromisoformat(text).astimezone().replace(tzinfo=None))
+
+def check_import(directory: str):
+    print('Import')
+    mixed = os.path.join(directory, 'export.jsonl')
+    with open(mixed, 'w', encoding='utf-8') as f:
+        for start, end in [
+            ('24-03-01 09:00:00.000000', '24-03-01 10:00:00.000000'),
+            ('2024-07-01T12:00:00+02:00', '2024-07-01T13:30:00+02:00'),
+            ('2024-07-02T12:00:00-05:00', '2024-07-02T13:00:00-05:00')
+        ]:
+            f.write(json.dumps({ "activity": 'Reading', "start": start, "end": end }) + '\n')
+    single = os.path.join(directory, 'export.csv')
+    with open(single, 'w', encoding='utf-8') as f:
+        f.write('Activity,Start,End\nWriting,2024-01-15T08:00:00Z,2024-01-15T09:00:00Z\n')
+    fields = { 'csv': ('Activity', 'Start', 'End'), 'jsonl': ('activity', 'start', 'end') }
+    summary, (names, codes, starts, ends) = run_import(ActivityTracker(), [mixed, single], fields, 1000)
+    expected = [
+        datetime_to_micros(datetime(2024, 3, 1, 9)),
+        local_time('2024-07-01T12:00:00+02:00'),
+        local_time('2024-07-02T12:00:00-05:00'),
+        local_time('2024-01-15T08:00:00+00:00')
+    ]
+    check(summary["imported"] == 4 and starts.tolist() == expected, 'ISO times with an offset are imported as local clock times')
+    check((ends - starts).tolist() == [3_600_000_000, 5_400_000_000, 3_600_000_000, 3_600_000_000], 'durations across offsets are kept')
+
+def reopened(path: str) -> ActivityTracker:
+    tracker = open_archive(path, recent=1)
+    tracker.load_all()
+    return tracker
+
+def check_archive(directory: str, num_instances: int = 10_000):
+    print('Archive')
+    path = os.path.join(directory, 'activities.archive')
+    expected = make_tracker(num_instances, seed=11)
+    save_tracker(expected, path)
+    tracker = open_archive(path, recent=1)
+    check(len(tracker.unread_periods()) > 2, 'opening reads only the newest partitions')
+    # the oldest instance of one activity and the second oldest of another, both in unread partitions
+    first = expected.activities['Activity 0'].instances[0]
+    second = expected.activities['Activity 1'].instances[1]
+    records = [
+        make_record("delete", 'Activity 0', first.start_time),
+        make_record("stop", 'Activity 1', second.start_time, second.end_time + timedelta(minutes=5))
+    ]
+    for record in records:
+        apply_record(expected, record)
+        apply_record(tracker, record)
+    save_tracker(tracker, path)
+    check(sorted_rows(reopened(path)) == sorted_rows(expected), 'a delete and an edit in unread partitions survive save and reopen')
+
+    # a period first written during this session, then emptied again
+    start = datetime(2041, 6, 1, 9)
+    record = make_record("add", 'Activity 2', start, start + timedelta(hours=1))
+    apply_record(tracker, record)
+    save_tracker(tracker, path)
+    record = make_record("delete", 'Activity 2', start)
+    apply_record(tracker, record)
+    save_tracker(tracker, path)
+    check(sorted_rows(reopened(path)) == sorted_rows(expected), 'an instance deleted from a partition written this session stays deleted')
+    tracker.remove_activity('Activity 3')
+    expected.remove_activity('Activity 3')
+    save_tracker(tracker, path)
+    check(sorted_rows(reopened(path)) == sorted_rows(expected), 'a removed activity does not come back from unread partitions')
+
+def check_journal(directory: str):
+    print('Journal')
+    path = os.path.join(directory, 'activities.journal')
+    journal = Journal(path, os.path.join(directory, 'journal.csv'))
+    start = datetime(2024, 5, 1, 9)
+    for n in range(3):
+        journal.append(make_record("add", 'Reading', start + timedelta(hours=n), start + timedelta(hours=n, minutes=30)))
+    size = os.path.getsize(path)
+    # a crash in the middle of an append
+    with open(path, 'ab') as f:
+        f.write(b'{"op": "add", "activity": "Reading", "start": "24-05-01 1')
+    tracker = ActivityTracker()
+    check(Journal(path, None).replay(tracker) == 3 and len(tracker.activities['Reading'].store) == 3, 'replay stops before a truncated final line')
+    check(os.path.getsize(path) == size, 'the truncated line is cut off the file')
+    # a complete record missing only its newline was not fsynced either
+    with open(path, 'ab') as f:
+        f.write(json.dumps(make_record("delete", 'Reading', start)).encode('utf-8'))
+    journal = Journal(path, None)
+    tracker = ActivityTracker()
+    journal.replay(tracker)
+    journal.append(make_record("add", 'Writing', start, start + timedelta(hours=1)))
+    tracker = ActivityTracker()
+    check(Journal(path, None).replay(tracker) == 4 and len(tracker.activities['Reading'].store) == 3 and 'Writing' in tracker.activities, 'records appended after a repair are replayed')
+
+def check_cache(directory: str, num_instances: int = 2_000):
+    print('CSV snapshot')
+    path = os.path.join(directory, 'activities.csv')
+    tracker = make_tracker(num_instances, seed=12)
+    save_columns(tracker.to_columns(), path)
+    cached, fresh = read_cache(path)
+    check(fresh and sorted_rows(cached) == sorted_rows(tracker), 'saving a CSV writes a fresh snapshot')
+    mtime, size = cache_key(path)
+    os.utime(path, ns=(mtime, mtime + 1_000_000_000))
+    check(not read_cache(path)[1], 'a CSV with a newer modification time makes the snapshot stale')
+    os.utime(path, ns=(mtime, mtime))
+    check(read_cache(path)[1], 'the snapshot is fresh again for the modification time it was taken at')
+    end = datetime_to_micros(datetime(2045, 1, 1))
+    with open(path, 'a', encoding='utf-8') as f:
+        f.write(f'Activity 0,{format_timestamp(end - 3_600_000_000)},{format_timestamp(end)}\n')
+    os.utime(path, ns=(mtime, mtime))
+    check(not read_cache(path)[1], 'a CSV of another size makes the snapshot stale at the same modification time')
+    loaded = load_tracker(path, cache=False)
+    check(len(loaded.activities['Activity 0'].store) == len(tracker.activities['Activity 0'].store) + 1 and not read_cache(path)[1], 'a read-only load parses the CSV and leaves the snapshot alone')
+    load_tracker(path)
+    cached, fresh = read_cache(path)
+    check(fresh and sorted_rows(cached) == sorted_rows(loaded), 'loading the changed CSV writes a fresh snapshot')
+
+def check_lock(directory: str):
+    print('History lock')
+    path = os.path.join(directory, 'activities.csv')
+    exited = subprocess.Popen([sys.executable, '-c', 'pass'])
+    exited.wait()
+    with open(lock_path(path), 'w', encoding='utf-8') as f:
+        f.write(str(exited.pid))
+    check(lock_holder(path) is None, 'a lock left by a process that exited is ignored')
+    hold_lock(path)
+    check(lock_holder(path) == os.getpid(), 'a lock left behind is taken over')
+    running = subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(30)'])
+    try:
+        with open(lock_path(path), 'w', encoding='utf-8') as f:
+            f.write(str(running.pid))
+        try:
+            hold_lock(path)
+            refused = False
+        except Exception:
+            refused = True
+        check(refused and lock_holder(path) == running.pid, 'a lock held by a running process is not taken over')
+    finally:
+        running.kill()
+        running.wait()
+    hold_lock(path)
+    release_lock(path)
+    check(not os.path.exists(lock_path(path)), 'releasing removes the lock')
+
+if __name__ == "__main__":
+    if hasattr(time, 'tzset'):
+        # a zone with daylight saving, so converting to local time is not a no-op
+        os.environ['TZ'] = 'America/New_York'
+        time.tzset()
+    with tempfile.TemporaryDirectory() as directory:
+        check_import(directory)
+        check_lock(directory)
+        check_archive(directory)
+        check_journal(directory)
+        check_cache(directory)
@@ -0,0 +1,346 @@
+import os
+import json
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import threading
+import requests
+from datetime import datetime, timedelta
+import time_tracker_server as server
+import async_server
+from objects import ActivityTracker
+from journal import make_record, apply_record
+from sync_client import SyncClient
+from benchmark import make_tracker, tracker_rows
+from storage import iter_csv, save_tracker
+from archive import open_archive
+from util import datetime_to_str
+from transfer import compress, encode_chunks
+
+PASSWORD = 'harness'
+
+def start_server(directory: str, password: str = PASSWORD, threaded: bool = True, users: dict = None):
+    shards = server.ShardIndex(directory, password, users)
+    httpd = server.make_server(('127.0.0.1', 0), shards, threaded)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    return httpd, f'http://127.0.0.1:{httpd.server_address[1]}'
+
+class AsyncServerThread:
+    # runs async_server.py's event loop on a thread, with the same shutdown calls as HTTPServer
+    def __init__(self, app: async_server.AsyncServer):
+        self.app = app
+        self.shards = app.shards
+        self.loop = asyncio.new_event_loop()
+        self.httpd = self.loop.run_until_complete(async_server.start_server('127.0.0.1', 0, app))
+        self.server_address = self.httpd.sockets[0].getsockname()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+    async def stop(self):
+        self.httpd.close()
+        await self.app.close()
+        # the connections it closed finish their handlers
+        tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+        if len(tasks) > 0:
+            await asyncio.wait(tasks, timeout=5)
+
+    def shutdown(self):
+        asyncio.run_coroutine_threadsafe(self.stop(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+    def server_close(self):
+        self.loop.close()
+
+def start_async_server(directory: str, password: str = PASSWORD, users: dict = None, commit_delay_ms: float = 0):
+    shards = server.ShardIndex(directory, password, users)
+    httpd = AsyncServerThread(async_server.AsyncServer(shards, commit_delay_ms=commit_delay_ms))
+    return httpd, f'http://127.0.0.1:{httpd.server_address[1]}'
+
+def stop_server(httpd):
+    httpd.shutdown()
+    httpd.server_close()
+
+def make_client(directory: str, url: str, name: str, user: str = None, password: str = PASSWORD) -> SyncClient:
+    return SyncClient(url, password, os.path.join(directory, f'{name}_state.json'), user, queue_path=os.path.join(directory, f'{name}_queue.jsonl'))
+
+def sorted_rows(tracker: ActivityTracker):
+    return sorted(tracker_rows(tracker))
+
+def check(condition: bool, message: str):
+    if not condition:
+        raise Exception(f'FAILED: {message}')
+    print(f'  ok: {message}')
+
+def eventually(condition, seconds: float = 2) -> bool:
+    # for effects the async server applies in the background, such as its journal writes
+    end = time.perf_counter() + seconds
+    while not condition():
+        if time.perf_counter() > end:
+            return False
+        time.sleep(0.01)
+    return True
+
+def check_delta_sync(directory: str, url: str):
+    print('Delta sync')
+    tracker_a = make_tracker(200, seed=1)
+    tracker_b = ActivityTracker()
+    client_a = make_client(directory, url, 'a')
+    client_b = make_client(directory, url, 'b')
+
+    check(client_a.push(tracker_a) == [], 'first push uploads local history')
+    check(client_b.push(tracker_b) is not None, 'second client bootstraps from the server')
+    check(sorted_rows(tracker_a) == sorted_rows(tracker_b), 'both clients hold the same history')
+
+    start = datetime(2030, 1, 1, 9, 0, 0, 1)
+    record = make_record("add", "Activity 0", start, start + timedelta(hours=1))
+    apply_record(tracker_a, record)
+    client_a.queue(record)
+    first = tracker_b.activities["Activity 1"].instances[0]
+    record = make_record("delete", "Activity 1", first.start_time)
+    apply_record(tracker_b, record)
+    client_b.queue(record)
+
+    revision = client_a.revision
+    client_a.push(tracker_a)
+    check(client_a.revision == revision + 1, 'a push of one change advances the revision by one')
+    applied = client_b.push(tracker_b)
+    check(len(applied) == 1, 'the other client receives only the newer change')
+    client_a.push(tracker_a)
+    check(sorted_rows(tracker_a) == sorted_rows(tracker_b), 'clients converge after exchanging deltas')
+
+    res = requests.post(url + '/retrieve', json={ "password": PASSWORD, "since": client_a.revision - 1 }).json()
+    check(len(res["changes"]) == 1, '/retrieve with since returns only newer changes')
+    res = requests.post(url + '/retrieve', json={ "password": PASSWORD })
+    check(res.status_code == 200 and res.text.startswith('Activity,Start,End'), '/retrieve without since still returns CSV')
+    res = requests.post(url + '/retrieve', json={ "password": 'wrong', "since": 0 })
+    check(res.status_code == 401, 'wrong password is rejected')
+
+def check_legacy_sync(directory: str, url: str):
+    print('Legacy sync')
+    tracker = ActivityTracker()
+    client = make_client(directory, url, 'legacy')
+    client.push(tracker)
+    data = make_tracker(50, seed=2).to_dataframe().to_csv(index=False)
+    res = requests.post(url + '/sync', json={ "password": PASSWORD, "data": data })
+    check(res.text == 'synced', 'full CSV sync is still accepted')
+    client.push(tracker)
+    check(sorted_rows(tracker) == sorted_rows(make_tracker(50, seed=2)), 'full CSV sync replaces the history for delta clients')
+
+def check_bandwidth(directory: str, url: str, num_instances: int = 10_000):
+    print('Bandwidth')
+    tracker = make_tracker(num_instances, seed=3)
+    client = make_client(directory, url, 'bandwidth')
+    client.push(tracker)
+    full = len(json.dumps({ "password": PASSWORD, "data": tracker.to_dataframe().to_csv(index=False) }))
+    start = datetime(2031, 1, 1, 9)
+    record = make_record("stop", "Activity 0", start, start + timedelta(minutes=25))
+    apply_record(tracker, record)
+    client.queue(record)
+    delta = len(json.dumps({ "password": PASSWORD, "since": client.revision, "changes": client.pending }))
+    client.push(tracker)
+    print(f'  one stop_timer at {num_instances:,} instances: full sync {full:,} bytes, delta sync {delta:,} bytes')
+
+def check_users(directory: str, url: str):
+    print('Users')
+    tracker_alice = make_tracker(30, seed=4)
+    tracker_bob = make_tracker(40, seed=5)
+    make_client(directory, url, 'alice', 'alice', 'alice-password').push(tracker_alice)
+    make_client(directory, url, 'bob', 'bob', 'bob-password').push(tracker_bob)
+    tracker = ActivityTracker()
+    make_client(directory, url, 'alice-2', 'alice', 'alice-password').push(tracker)
+    check(sorted_rows(tracker) == sorted_rows(tracker_alice), 'each user only sees their own shard')
+    res = requests.post(url + '/retrieve', json={ "user": 'bob', "password": 'alice-password', "since": 0 })
+    check(res.status_code == 401, 'a user cannot use another user\'s password')
+    res = requests.post(url + '/retrieve', json={ "user": 'alice', "password": 'alice-password', "since": 0 }).json()
+    check(res["revision"] == 30, 'revisions are counted per user')
+    check(eventually(lambda: os.path.exists(os.path.join(directory, 'users', 'bob', 'changes.jsonl'))), 'user shards are stored in their own directory')
+
+def check_invalid_changes(directory: str, url: str):
+    print('Invalid changes')
+    body = { "user": 'alice', "password": 'alice-password' }
+    before = requests.post(url + '/retrieve', json=dict(body, since=0)).json()
+    good = make_record("add", "Activity 0", datetime(2034, 1, 1), datetime(2034, 1, 2))
+    bad = dict(make_record("stop", "Activity 0", datetime(2034, 2, 1), datetime(2034, 2, 2)), end='tomorrow')
+    res = requests.post(url + '/sync', json=dict(body, since=before["revision"], changes=[good, bad]))
+    check(res.status_code == 400, 'a batch with an invalid change is answered with 400')
+    after = requests.post(url + '/retrieve', json=dict(body, since=0)).json()
+    check(after == before, 'no change of a rejected batch is applied')
+
+def check_transfer(directory: str, url: str, num_instances: int = 50_000):
+    print('Compressed transfer')
+    tracker = make_tracker(num_instances, seed=7)
+    headers = { "Content-Type": "text/csv", "X-User": 'dave', "X-Password": 'dave-password', "Content-Encoding": 'gzip' }
+    res = requests.post(url + '/sync', data=encode_chunks(iter_csv(tracker.to_columns()), 'gzip'), headers=headers)
+    check(res.text == 'synced', 'a gzip CSV upload streamed with chunked encoding is accepted')
+    body = { "user": 'dave', "password": 'dave-password' }
+    plain = requests.post(url + '/retrieve', json=body, headers={ "Accept-Encoding": 'identity' }, stream=True)
+    plain_size = len(plain.raw.read())
+    packed = requests.post(url + '/retrieve', json=body, headers={ "Accept-Encoding": 'gzip' }, stream=True)
+    packed_size = len(packed.raw.read(decode_content=False))
+    # the threaded server streams the CSV, the async one sends its cached copy with a length
+    sent = packed.headers.get('Transfer-Encoding') == 'chunked' or packed.headers.get('Content-Length') == str(packed_size)
+    check(packed.headers.get('Content-Encoding') == 'gzip' and sent, '/retrieve sends gzip when the client accepts it')
+    loaded = ActivityTracker()
+    client = make_client(directory, url, 'dave', 'dave', 'dave-password')
+    client.push(loaded)
+    check(sorted_rows(loaded) == sorted_rows(tracker), 'the streamed upload round-trips through the delta protocol')
+    record = make_record("add", "Activity 0", datetime(2033, 1, 1), datetime(2033, 1, 2))
+    client.queue(record)
+    check(client.push(loaded) is not None and client.server_encodings is not None, 'delta uploads are accepted once the server advertises encodings')
+    res = requests.post(url + '/retrieve', json=body, headers={ "Accept-Encoding": 'gzip' })
+    check('33-01-01 00:00:00.000000' in res.text, '/retrieve includes changes synced after the previous /retrieve')
+    print(f'  /retrieve of {num_instances:,} instances: {plain_size:,} bytes plain, {packed_size:,} bytes gzip ({plain_size / packed_size:.1f}x smaller)')
+
+def check_queries(directory: str, url: str, num_instances: int = 20_000):
+    print('Queries')
+    tracker = make_tracker(num_instances, seed=8)
+    client = make_client(directory, url, 'erin', 'erin', 'erin-password')
+    client.push(tracker)
+    session = requests.Session()
+    def query(name: str, **params):
+        begin = time.perf_counter()
+        res = session.post(f'{url}/query/{name}', json=dict(params, user='erin', password='erin-password')).json()
+        return res, time.perf_counter() - begin
+    totals, first = query('totals')
+    check(all(abs(totals["totals"][a.name]["seconds"] - a.get_time_between().total_seconds()) < 1e-6 for a in tracker.activities.values()), '/query/totals matches the local totals')
+    start, end = datetime(2021, 1, 1), datetime(2022, 1, 1)
+    ranged, _ = query('range', start=datetime_to_str(start), end=datetime_to_str(end))
+    check(all(abs(ranged["totals"][a.name]["seconds"] - a.get_time_between(start, end).total_seconds()) < 1e-6 for a in tracker.activities.values()), '/query/range matches get_time_between')
+    activity = tracker.activities["Activity 5"]
+    page, _ = query('instances', activity="Activity 5", offset=10, limit=20)
+    expected = [(datetime_to_str(i.start_time), datetime_to_str(i.end_time)) for i in activity.get_sorted_instances()[10:30]]
+    check(page["count"] == len(activity.instances) and [(i["start"], i["end"]) for i in page["instances"]] == expected, '/query/instances pages newest first')
+    record = make_record("add", "Activity 5", datetime(2035, 1, 1), datetime(2035, 1, 1, 2))
+    apply_record(tracker, record)
+    client.queue(record)
+    client.push(tracker)
+    totals, _ = query('totals')
+    check(totals["totals"]["Activity 5"]["seconds"] == activity.get_time_between().total_seconds() and totals["revision"] == client.revision, 'the index follows changes made through /sync')
+    times = [query('range', start=datetime_to_str(start), end=datetime_to_str(end))[1] for _ in range(20)]
+    begin = time.perf_counter()
+    session.post(url + '/retrieve', json={ "user": 'erin', "password": 'erin-password' }).content
+    full = time.perf_counter() - begin
+    print(f'  {num_instances:,} instances: first query {first * 1000:.1f} ms (builds the index), range query {min(times) * 1000:.2f} ms, full /retrieve {full * 1000:.1f} ms')
+
+def check_batches(directory: str, url: str, num_instances: int = 2_500, batch_size: int = 500):
+    print('Batched upload')
+    user, password = 'frank', 'frank-password'
+    # an archive with only its newest month in memory, the first sync also sends the months on disk
+    tracker = make_tracker(num_instances, seed=9)
+    path = os.path.join(directory, 'frank.archive')
+    save_tracker(tracker, path)
+    opened = open_archive(path, recent=1)
+    client = SyncClient(url, password, os.path.join(directory, 'frank_state.json'), user, queue_path=os.path.join(directory, 'frank_queue.jsonl'), batch_size=batch_size)
+    sizes = [ ]
+    request = client.request
+    def counted(path: str, body: dict) -> dict:
+        sizes.append(len(body["changes"]))
+        return request(path, body)
+    client.request = counted
+    check(len(opened.unread_files()) > 0 and client.push(opened) == [], 'the first push uploads a partly read archive')
+    check(len(sizes) == -(-num_instances // batch_size) and max(sizes) == batch_size, f'the history goes out in batches of {batch_size}')
+    loaded = ActivityTracker()
+    make_client(directory, url, 'frank-2', user, password).push(loaded)
+    check(sorted_rows(loaded) == sorted_rows(tracker), 'the batches add up to the whole history')
+
+    start = datetime(2036, 1, 1)
+    for n in range(1_200):
+        record = make_record("add", "Activity 0", start + timedelta(hours=n), start + timedelta(hours=n, minutes=30))
+        apply_record(opened, record)
+        client.queue(record)
+    sizes.clear()
+    pushed = client.prepare_push(opened)
+    client.finish_push(opened, pushed, client.send(pushed))
+    check(len(client.pending) == 700 and len(client.outbox.read(repair=False)) == 700, 'an acknowledged batch is dropped from the queue file, the rest stays')
+    client.url = 'http://127.0.0.1:9'
+    check(client.push(opened) is None and len(client.pending) == 700, 'a failed batch stays queued')
+    client.url = url
+    sizes.clear()
+    check(client.push(opened) == [] and sizes == [batch_size, 200] and os.path.getsize(client.outbox.path) == 0, 'the queue is sent in batches until it is empty')
+
+def check_body_limit(directory: str, url: str):
+    print('Body limit')
+    # about 64 KB sent, more than the 64 MB limit once decompressed
+    bomb = compress(b'{"password": "' + b'0' * async_server.MAX_BODY_SIZE + b'"}', 'gzip')
+    res = requests.post(url + '/retrieve', data=bomb, headers={ "Content-Type": "application/json", "Content-Encoding": 'gzip' })
+    check(res.status_code == 413, f'a {len(bomb):,} byte body that decompresses past the limit is answered with 413')
+    res = requests.post(url + '/retrieve', json={ "user": 'alice', "password": 'alice-password', "since": 0 })
+    check(res.status_code == 200, 'the server keeps answering after a rejected body')
+
+def edit_offline(tracker: ActivityTracker, client: SyncClient, rng: random.Random, client_id: int, num_edits: int):
+    names = sorted(tracker.activities.keys())
+    for n in range(num_edits):
+        name = rng.choice(names)
+        instances = tracker.activities[name].instances if name in tracker.activities else []
+        kind = rng.random()
+        if kind < 0.4 or len(instances) == 0:
+            start = datetime(2032, 1, 1) + timedelta(days=client_id, minutes=n)
+            record = make_record("add", name, start, start + timedelta(minutes=rng.randint(1, 60)))
+        elif kind < 0.7:
+            instance = rng.choice(instances)
+            record = make_record("stop", name, instance.start_time, instance.start_time + timedelta(minutes=rng.randint(1, 60)))
+        elif kind < 0.95:
+            record = make_record("delete", name, rng.choice(instances).start_time)
+        else:
+            record = make_record("remove", name)
+        apply_record(tracker, record)
+        client.queue(record)
+
+def check_offline(directory: str, url: str, num_clients: int = 4):
+    print('Offline clients')
+    user, password = 'carol', 'carol-password'
+    trackers = [make_tracker(100, seed=6)] + [ActivityTracker() for _ in range(num_clients - 1)]
+    clients = [make_client(directory, url, f'carol-{i}', user, password) for i in range(num_clients)]
+    for tracker, client in zip(trackers, clients):
+        client.push(tracker)
+        client.save_state()
+    check(all(sorted_rows(t) == sorted_rows(trackers[0]) for t in trackers), 'all clients start from the same history')
+
+    for i, (tracker, client) in enumerate(zip(trackers, clients)):
+        client.url = 'http://127.0.0.1:9'
+        edit_offline(tracker, client, random.Random(i), i, 40)
+    check(all(c.push(t) is None for t, c in zip(trackers, clients)), 'pushing while the server is unreachable fails')
+    check(all(len(c.pending) == 40 for c in clients), 'failed pushes keep every queued change')
+
+    clients = [make_client(directory, url, f'carol-{i}', user, password) for i in range(num_clients)]
+    check(all(len(c.pending) == 40 for c in clients), 'queued changes survive a client restart')
+    for _ in range(2):
+        for tracker, client in zip(trackers, clients):
+            client.push(tracker)
+    check(all(len(c.pending) == 0 for c in clients), 'every queued change is acknowledged')
+    check(all(os.path.getsize(c.outbox.path) == 0 for c in clients), 'acknowledged changes are dropped from the queue file')
+    server_tracker = ActivityTracker()
+    make_client(directory, url, 'carol-check', user, password).push(server_tracker)
+    check(all(sorted_rows(t) == sorted_rows(server_tracker) for t in trackers), f'{num_clients} clients converge to the server history after editing offline')
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Check the sync protocol against an in-process server')
+    parser.add_argument('--async', dest='use_async', action='store_true', help='run the checks against async_server.py')
+    args = parser.parse_args()
+    users = { 'alice': 'alice-password', 'bob': 'bob-password', 'carol': 'carol-password', 'dave': 'dave-password', 'erin': 'erin-password', 'frank': 'frank-password' }
+    with tempfile.TemporaryDirectory() as directory:
+        if args.use_async:
+            httpd, url = start_async_server(directory, users=users)
+        else:
+            httpd, url = start_server(directory, users=users)
+        try:
+            check_delta_sync(directory, url)
+            check_legacy_sync(directory, url)
+            check_bandwidth(directory, url)
+            check_users(directory, url)
+            check_invalid_changes(directory, url)
+            check_offline(directory, url)
+            check_transfer(directory, url)
+            check_queries(directory, url)
+            check_batches(directory, url)
+            if args.use_async:
+                check_body_limit(directory, url)
+        finally:
+            stop_server(httpd)
+        shards = server.ShardIndex(directory, PASSWORD, users)
+        for user, store in httpd.shards.shards.items():
+            check(shards.get(user).rows == store.rows, f'shard for {user or "the shared password"} survives a restart')
@@ -0,0 +1,52 @@
+import threading
+
+# One pooled HTTP session per server, shared by the full-history and delta sync paths.
+# Requests keep their TCP connection alive between calls, so a burst of saves and syncs
+# costs one handshake instead of one per request.
+
+class ServerSession:
+    url: str
+    connect_timeout: float
+    read_timeout: float
+    pool_size: int
+    server_encodings: str | None
+    session: object | None
+    lock: threading.Lock
+
+    def __init__(self, url: str, timeout: float = 10, connect_timeout: float = None, pool_size: int = 2):
+        self.url = url
+        self.read_timeout = timeout
+        self.connect_timeout = connect_timeout if connect_timeout is not None else min(timeout, 3)
+        self.pool_size = pool_size
+        # what the server said it can decode, None until it has answered once
+        self.server_encodings = None
+        self.session = None
+        self.lock = threading.Lock()
+
+    def open(self):
+        # requests is imported on first use so starting the window does not pay for it
+        with self.lock:
+            if self.session is None:
+                import requests
+                from requests.adapters import HTTPAdapter
+                session = requests.Session()
+                # retries are left to the caller, which backs off between attempts
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, max_retries=0)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self.session = session
+            return self.session
+
+    def post(self, path: str, **kwargs):
+        res = self.open().post(self.url + path, timeout=(self.connect_timeout, self.read_timeout), **kwargs)
+        self.server_encodings = res.headers.get('Accept-Encoding', self.server_encodings)
+        if res.status_code != 200:
+            # reading the body hands the connection back to the pool
+            raise Exception(f'Server responded with {res.status_code}, {res.content.decode()}')
+        return res
+
+    def close(self):
+        with self.lock:
+            if self.session is not None:
+                self.session.close()
+                self.session = None
@@ -0,0 +1,286 @@
+import os
+import sys
+import json
+import time
+import argparse
+import itertools
+import numpy as np
+from typing import TYPE_CHECKING
+from objects import ActivityTracker, NO_END
+from journal import Journal, add_records
+from storage import data_file, format_of, load_tracker, lock_holder, save_columns
+from report import load_config
+from codec import TIME_FORMAT, format_timestamp
+from util import micros_to_datetime
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+# Bulk import of CSV and JSONL exports into the local history. Input is read chunk_rows rows at a
+# time and each chunk is reduced to three int64 columns, rows already in the history are dropped
+# per chunk by binary search in the (already sorted) instance stores, repeats within the import
+# by one sort at the end. The merged history is written once, like a save, and with delta sync
+# the imported rows are queued for the server like instances added in the app.
+
+OVERLAP_POLICIES = ['keep', 'skip', 'fail']
+IMPORT_OPS = ('add', 'stop')
+
+def parse_times(values) -> np.ndarray:
+    # each value in the app's own '%y-%m-%d %H:%M:%S.%f' (century filled in like
+    # parse_time_column) or else ISO 8601, to microseconds with NO_END for missing or unreadable text
+    import pandas as pd
+    values = pd.Series(values, dtype=object).fillna('').astype(str)
+    century = values.str[:2].lt('69').map({True: '20', False: '19'})
+    times = pd.to_datetime(century + values, format='%Y' + TIME_FORMAT[2:], errors='coerce')
+    micros = np.where(times.isna().to_numpy(), NO_END, times.to_numpy(dtype='datetime64[us]').astype(np.int64))
+    rest = (micros == NO_END) & (values != '').to_numpy()
+    if np.any(rest):
+        micros[rest] = parse_iso_times(values[rest])
+    return micros
+
+def parse_iso_times(values: 'pd.Series') -> np.ndarray:
+    import pandas as pd
+    try:
+        times = pd.to_datetime(values, format='ISO8601', errors='coerce')
+    except ValueError:
+        # pandas only parses one UTC offset per column, so mixed offsets go one at a time
+        times = pd.to_datetime(pd.Series([iso_time(value) for value in values], dtype=object))
+    if times.dt.tz is not None:
+        # the history holds local wall clock times, so the instant is moved to the local zone
+        times = times.dt.tz_convert(local_zone()).dt.tz_localize(None)
+    return np.where(times.isna().to_numpy(), NO_END, times.to_numpy(dtype='datetime64[us]').astype(np.int64))
+
+def iso_time(value: str):
+    import pandas as pd
+    try:
+        time = pd.Timestamp(value)
+    except ValueError:
+        return pd.NaT
+    return time.tz_convert(local_zone()).tz_localize(None) if time.tzinfo is not None else time
+
+def local_zone():
+    # the zone of this machine including its daylight saving rules, which a fixed offset would miss
+    from dateutil.tz import tzlocal
+    return tzlocal()
+
+def read_csv_chunks(path: str, fields: tuple, chunk_rows: int):
+    import pandas as pd
+    with pd.read_csv(path, usecols=list(fields), dtype=str, keep_default_na=False, chunksize=chunk_rows) as reader:
+        for chunk in reader:
+            yield chunk[fields[0]].to_numpy(dtype=object), chunk[fields[1]], chunk[fields[2]], 0
+
+def read_jsonl_chunks(path: str, fields: tuple, chunk_rows: int):
+    # journal and changes.jsonl records carry an "op", only the ones that record an instance count
+    activity, start, end = fields
+    with open(path, 'r', encoding='utf-8') as f:
+        while True:
+            lines = list(itertools.islice(f, chunk_rows))
+            if len(lines) == 0:
+                return
+            names, starts, ends = [ ], [ ], [ ]
+            skipped = 0
+            for line in lines:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    skipped += 1
+                    continue
+                if not isinstance(record, dict) or record.get('op', 'add') not in IMPORT_OPS:
+                    skipped += 1
+                    continue
+                names.append(record.get(activity))
+                starts.append(record.get(start))
+                ends.append(record.get(end))
+            yield np.array(names, dtype=object), starts, ends, skipped
+
+def input_format(path: str, given: str | None) -> str:
+    if given is not None:
+        return given
+    return 'jsonl' if os.path.splitext(path)[1].lower() in ('.jsonl', '.json', '.ndjson') else 'csv'
+
+class Importer:
+    tracker: ActivityTracker
+    names: list
+    name_codes: dict
+    codes: list
+    starts: list
+    ends: list
+    rows: int
+    invalid: int
+    skipped: int
+    existing: int
+
+    def __init__(self, tracker: ActivityTracker):
+        self.tracker = tracker
+        self.names = [ ]
+        self.name_codes = { }
+        self.codes = [ ]
+        self.starts = [ ]
+        self.ends = [ ]
+        self.rows = 0
+        self.invalid = 0
+        self.skipped = 0
+        self.existing = 0
+
+    def add_chunk(self, names: np.ndarray, starts, ends, skipped: int = 0):
+        self.rows += len(names) + skipped
+        self.skipped += skipped
+        if len(names) == 0:
+            return
+        import pandas as pd
+        starts = parse_times(starts)
+        ends = parse_times(ends)
+        local, uniques = pd.factorize(pd.Series(names, dtype=object).replace('', None))
+        valid = (local >= 0) & (starts != NO_END) & (ends != NO_END) & (ends >= starts)
+        self.invalid += len(names) - int(np.count_nonzero(valid))
+        codes = np.array([self.name_codes.setdefault(str(name), len(self.name_codes)) for name in uniques], dtype=np.int64)
+        codes, starts, ends = codes[local[valid]], starts[valid], ends[valid]
+        if len(starts) == 0:
+            return
+        self.names = list(self.name_codes)
+        # archived periods the chunk falls into are read so their instances are matched too
+        self.tracker.load_range(micros_to_datetime(int(starts.min())), micros_to_datetime(int(starts.max())))
+        keep = np.ones(len(starts), dtype=bool)
+        for code in np.unique(codes).tolist():
+            activity = self.tracker.activities.get(self.names[code])
+            if activity is None or len(activity.store) == 0:
+                continue
+            mine = np.flatnonzero(codes == code)
+            known = np.frombuffer(activity.store.starts, dtype=np.int64)
+            found = np.minimum(np.searchsorted(known, starts[mine]), len(known) - 1)
+            keep[mine[known[found] == starts[mine]]] = False
+        self.existing += len(keep) - int(np.count_nonzero(keep))
+        self.codes.append(codes[keep])
+        self.starts.append(starts[keep])
+        self.ends.append(ends[keep])
+
+    def collect(self):
+        # the imported rows ordered by activity and start, the first of each repeated pair kept
+        codes = np.concatenate(self.codes) if len(self.codes) > 0 else np.zeros(0, dtype=np.int64)
+        starts = np.concatenate(self.starts) if len(self.starts) > 0 else np.zeros(0, dtype=np.int64)
+        ends = np.concatenate(self.ends) if len(self.ends) > 0 else np.zeros(0, dtype=np.int64)
+        order = np.lexsort((starts, codes))
+        codes, starts, ends = codes[order], starts[order], ends[order]
+        first = np.ones(len(starts), dtype=bool)
+        first[1:] = (codes[1:] != codes[:-1]) | (starts[1:] != starts[:-1])
+        return codes[first], starts[first], ends[first], len(starts) - int(np.count_nonzero(first))
+
+def find_overlaps(tracker: ActivityTracker, starts: np.ndarray, ends: np.ndarray, examples: int = 0):
+    # One timer runs at a time, so instances overlap across activities as well. An imported row
+    # overlaps the history if some instance starting before its end ends after its start: with
+    # the history sorted by start that is the running maximum of the ends found by searchsorted.
+    # Returns both masks and, for the first examples rows overlapping the history, the instance
+    # holding that maximum.
+    names, counts, known_starts, known_ends = tracker.to_columns()
+    with_history = np.zeros(len(starts), dtype=bool)
+    partners = [ ]
+    if len(known_starts) > 0:
+        order = np.argsort(known_starts, kind='stable')
+        known_codes = np.repeat(np.arange(len(names)), counts)[order]
+        known_starts, known_ends = known_starts[order], known_ends[order]
+        latest = np.maximum.accumulate(known_ends)
+        before = np.searchsorted(known_starts, ends, side='left') - 1
+        with_history = (before >= 0) & (latest[np.maximum(before, 0)] > starts)
+        holder = np.maximum.accumulate(np.where(known_ends == latest, np.arange(len(latest)), 0))
+        for h in holder[before[with_history][:examples]].tolist():
+            partners.append((names[known_codes[h]], int(known_starts[h]), int(known_ends[h])))
+    # rows of the import that overlap an earlier imported row
+    order = np.argsort(starts, kind='stable')
+    within = np.zeros(len(starts), dtype=bool)
+    if len(starts) > 1:
+        within[order[1:]] = starts[order[1:]] < np.maximum.accumulate(ends[order])[:-1]
+    return with_history, within, partners
+
+def describe(name: str, start: int, end: int) -> str:
+    return f'{name} {format_timestamp(start)} - {format_timestamp(end)}'
+
+def run_import(tracker: ActivityTracker, paths: list, fields: dict, chunk_rows: int, given_format: str = None, overlaps: str = 'keep', examples: int = 5):
+    # returns the importer summary and the imported (names, codes, starts, ends), which are None
+    # if overlaps is 'fail' and some were found
+    importer = Importer(tracker)
+    for path in paths:
+        kind = input_format(path, given_format)
+        reader = read_jsonl_chunks if kind == 'jsonl' else read_csv_chunks
+        for chunk in reader(path, fields[kind], chunk_rows):
+            importer.add_chunk(*chunk)
+    codes, starts, ends, repeated = importer.collect()
+    with_history, within, partners = find_overlaps(tracker, starts, ends, examples)
+    summary = {
+        "rows": importer.rows,
+        "invalid": importer.invalid,
+        "skipped": importer.skipped,
+        "existing": importer.existing,
+        "repeated": repeated,
+        "overlapping history": int(np.count_nonzero(with_history)),
+        "overlapping import": int(np.count_nonzero(within))
+    }
+    for i, partner in zip(np.flatnonzero(with_history).tolist(), partners):
+        print(f'  overlap: {describe(importer.names[codes[i]], starts[i], ends[i])} with {describe(*partner)}', file=sys.stderr)
+    if overlaps == 'fail' and np.any(with_history | within):
+        return summary, None
+    if overlaps == 'skip':
+        keep = ~with_history
+        codes, starts, ends = codes[keep], starts[keep], ends[keep]
+    bounds = np.flatnonzero(np.diff(codes)) + 1
+    for lo, hi in zip([0] + bounds.tolist(), bounds.tolist() + [len(codes)]):
+        if hi <= lo:
+            continue
+        name = importer.names[codes[lo]]
+        tracker.add_activity(name)
+        tracker.activities[name].store.extend(starts[lo:hi], ends[lo:hi])
+    summary["imported"] = len(starts)
+    return summary, (importer.names, codes, starts, ends)
+
+if __name__ == "__main__":
+    config = load_config()
+    parser = argparse.ArgumentParser(description='Merge CSV or JSONL exports from other trackers into the history in one write')
+    parser.add_argument('inputs', nargs='+', help='files to import, .jsonl/.json/.ndjson are read as JSON lines and anything else as CSV')
+    parser.add_argument('--format', choices=['csv', 'jsonl'], help='read every input as this format instead of going by extension')
+    parser.add_argument('--data', default=data_file(config.get('storage_format', 'csv')), help='history file, defaults to the one in config.json')
+    parser.add_argument('--activity-field', help='column or key holding the activity name (default Activity for CSV, activity for JSONL)')
+    parser.add_argument('--start-field', help='column or key holding the start time (default Start / start)')
+    parser.add_argument('--end-field', help='column or key holding the end time (default End / end)')
+    parser.add_argument('--overlaps', choices=OVERLAP_POLICIES, default='keep', help='keep overlapping rows and report them, skip rows that overlap the history, or write nothing if any overlap')
+    parser.add_argument('--chunk-rows', type=int, default=250_000, help='rows read at a time')
+    parser.add_argument('--dry-run', action='store_true', help='report what would be imported without writing')
+    parser.add_argument('--force', action='store_true', help='write even if the history is marked as open by the app, for a lock the app left behind')
+    args = parser.parse_args()
+
+    holder = lock_holder(args.data)
+    if holder is not None and not args.dry_run and not args.force:
+        # the app would write its own copy over the import on its next save
+        print(f'{args.data} is open in the time tracker (process {holder}), close it before importing or pass --force if it is not running', file=sys.stderr)
+        sys.exit(1)
+
+    fields = {
+        'csv': (args.activity_field or 'Activity', args.start_field or 'Start', args.end_field or 'End'),
+        'jsonl': (args.activity_field or 'activity', args.start_field or 'start', args.end_field or 'end')
+    }
+    begin = time.perf_counter()
+    journal = None
+    if config.get('storage') == 'journal':
+        journal = Journal('activities.journal', args.data, config.get('journal_compact_every', 500))
+    tracker = load_tracker(args.data, cache=False) if os.path.exists(args.data) else ActivityTracker()
+    if journal is not None:
+        journal.replay(tracker)
+    loaded = time.perf_counter()
+    summary, rows = run_import(tracker, args.inputs, fields, args.chunk_rows, args.format, args.overlaps)
+    imported = time.perf_counter()
+    print(', '.join(f'{value:,} {key}' for key, value in summary.items()), file=sys.stderr)
+    if rows is None:
+        print('Overlapping instances found, nothing was written', file=sys.stderr)
+        sys.exit(1)
+    if not args.dry_run and summary["imported"] > 0:
+        if format_of(args.data) == 'archive':
+            from archive import create_archive
+            create_archive(args.data, config.get('archive_period', 'month'))
+        if journal is not None:
+            # the replayed journal is part of the written history
+            journal.compact(tracker.to_columns(), unread=tracker.unread_periods())
+        else:
+            save_columns(tracker.to_columns(), args.data, tracker.unread_periods())
+        if config.get('sync', 'delta') == 'delta' and 'server' in config and 'server_port' in config and os.path.exists('sync_state.json'):
+            # before the first delta sync the whole history is uploaded anyway, see SyncClient.prepare_push
+            Journal('sync_queue.jsonl', None).extend(add_records(rows))
+    rate = summary["rows"] / max(imported - loaded, 1e-9) * 60
+    print(f'loaded in {loaded - begin:.2f} s, imported in {imported - loaded:.2f} s ({rate:,.0f} rows/min), written in {time.perf_counter() - imported:.2f} s', file=sys.stderr)
@@ -0,0 +1,110 @@
+import bisect
+import tkinter as tk
+from tkinter import ttk
+from typing import Callable
+from objects import Activity, ActivityInstance
+from util import pretty_duration
+
+def instance_row(instance: ActivityInstance):
+    if instance.currently_running():
+        return (instance.pretty_date(), instance.pretty_start_time(), '', '')
+    return (instance.pretty_date(), instance.pretty_start_time(), instance.pretty_stop_time(), pretty_duration(instance.duration))
+
+class PagedInstanceList:
+    tree: ttk.Treeview
+    scrollbar: ttk.Scrollbar
+    page_size: int
+    activity: Activity | None
+    loaded: int
+    loading: bool
+    load_older: Callable[[str], bool] | None
+
+    def __init__(self, tree: ttk.Treeview, scrollbar: ttk.Scrollbar, page_size: int = 200, load_older: Callable[[str], bool] = None):
+        self.tree = tree
+        self.scrollbar = scrollbar
+        self.page_size = page_size
+        # reads more of an activity's archived history, see ActivityTracker.load_older
+        self.load_older = load_older
+        self.activity = None
+        self.loaded = 0
+        self.loading = False
+        self.tree.configure(yscrollcommand=self.on_scroll)
+
+    def show(self, activity: Activity):
+        self.activity = activity
+        self.loaded = 0
+        self.tree.delete(*self.tree.get_children())
+        self.load_more()
+
+    def clear(self):
+        self.activity = None
+        self.loaded = 0
+        self.tree.delete(*self.tree.get_children())
+
+    def reload(self):
+        if self.activity is None:
+            return
+        loaded = self.loaded
+        self.show(self.activity)
+        while self.loaded < loaded and self.load_more():
+            pass
+
+    def load_more(self) -> bool:
+        if self.loaded >= len(self.activity.store):
+            # every instance read so far is shown, read the next older archived ones
+            if not self.page_in():
+                return False
+        store = self.activity.store
+        first = len(store) - 1 - self.loaded
+        last = max(first - self.page_size, -1)
+        if first <= last:
+            # page_in had to reload and that already showed the new rows
+            return True
+        for k in range(first, last, -1):
+            instance = ActivityInstance.view(store, k)
+            self.tree.insert("", tk.END, instance.to_string(), values=instance_row(instance))
+        self.loaded += first - last
+        return True
+
+    def page_in(self) -> bool:
+        if self.load_older is None or self.activity.archived_count == 0:
+            return False
+        store = self.activity.store
+        oldest = store.starts[len(store) - self.loaded] if self.loaded > 0 else None
+        if not self.load_older(self.activity.name):
+            return False
+        if oldest is not None and len(store) - bisect.bisect_left(store.starts, oldest) != self.loaded:
+            # the partition had rows between the ones already shown
+            self.reload()
+        return True
+
+    def on_scroll(self, first, last):
+        self.scrollbar.set(first, last)
+        if self.activity is None or self.loading or float(last) < 0.95:
+            return
+        self.loading = True
+        self.tree.after_idle(self.finish_scroll)
+
+    def finish_scroll(self):
+        if self.activity is not None:
+            self.load_more()
+        self.loading = False
+
+    def insert(self, instance: ActivityInstance):
+        if self.activity is None or instance.store is not self.activity.store:
+            return
+        item = instance.to_string()
+        if self.tree.exists(item):
+            self.tree.item(item, values=instance_row(instance))
+            return
+        position = len(self.activity.store) - 1 - instance.position()
+        if position >= self.loaded and self.loaded < len(self.activity.store) - 1:
+            return
+        self.tree.insert("", position, item, values=instance_row(instance))
+        self.loaded += 1
+
+    def delete(self, item: str):
+        if not self.tree.exists(item):
+            return
+        self.tree.delete(item)
+        self.loaded -= 1
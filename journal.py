@@ -0,0 +1,189 @@
+import os
+import json
+import threading
+from objects import ActivityTracker, format_time_column
+from util import str_to_datetime, datetime_to_str
+from storage import save_columns
+
+def make_record(op: str, activity: str, start=None, end=None) -> dict:
+    record = { "op": op, "activity": activity }
+    if start is not None:
+        record["start"] = datetime_to_str(start)
+    if end is not None:
+        record["end"] = datetime_to_str(end)
+    return record
+
+def add_records(rows, batch_size: int = 100_000):
+    # the "add" records make_record would give for (names, codes, starts, ends), formatted a batch at a time
+    names, codes, starts, ends = rows
+    for lo in range(0, len(starts), batch_size):
+        batch_starts = format_time_column(starts[lo:lo + batch_size]).tolist()
+        batch_ends = format_time_column(ends[lo:lo + batch_size]).tolist()
+        for code, start, end in zip(codes[lo:lo + batch_size].tolist(), batch_starts, batch_ends):
+            yield { "op": "add", "activity": names[code], "start": start, "end": end }
+
+def encode_record(record: dict) -> bytes:
+    # one line of a journal file
+    return (json.dumps(record) + '\n').encode('utf-8')
+
+def apply_record(tracker: ActivityTracker, record: dict) -> bool:
+    op = record["op"]
+    name = record["activity"]
+    if op == "start":
+        return False
+    if op == "stop" or op == "add":
+        tracker.add_activity(name)
+        activity = tracker.activities[name]
+        start = str_to_datetime(record["start"])
+        end = str_to_datetime(record["end"])
+        # an archived instance has to be read before it can be found or replaced
+        tracker.load_range(start, start)
+        instance = activity.get_instance(start)
+        if instance is not None:
+            if instance.end_time == end:
+                return False
+            instance.end_time = end
+            return True
+        activity.insert_instance(start, end)
+        return True
+    if op == "delete":
+        if tracker.name_available(name):
+            return False
+        activity = tracker.activities[name]
+        start = str_to_datetime(record["start"])
+        tracker.load_range(start, start)
+        instance = activity.get_instance(start)
+        if instance is None:
+            return False
+        activity.remove_instance(instance)
+        return True
+    if op == "remove":
+        return tracker.remove_activity(name)
+    print(f'Journal: unknown operation "{op}"')
+    return False
+
+class Journal:
+    path: str
+    snapshot_path: str
+    compact_every: int
+    num_records: int
+    offset: int
+    compacted_records: int
+    compacted_offset: int
+    lock: threading.Lock
+
+    def __init__(self, path: str, snapshot_path: str, compact_every: int = 500):
+        self.path = path
+        self.snapshot_path = snapshot_path
+        self.compact_every = compact_every
+        self.num_records = 0
+        self.offset = 0
+        self.compacted_records = 0
+        self.compacted_offset = 0
+        self.lock = threading.Lock()
+
+    def append(self, record: dict):
+        line = encode_record(record)
+        with self.lock:
+            with open(self.path, 'ab') as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+            self.num_records += 1
+            self.offset += len(line)
+
+    def extend(self, records, batch_size: int = 100_000):
+        # many records with one fsync, for bulk changes like importer.py
+        with self.lock:
+            with open(self.path, 'ab') as f:
+                lines = [ ]
+                for record in records:
+                    lines.append(json.dumps(record) + '\n')
+                    if len(lines) >= batch_size:
+                        self.write_lines(f, lines)
+                        lines = [ ]
+                self.write_lines(f, lines)
+                f.flush()
+                os.fsync(f.fileno())
+
+    def write_lines(self, f, lines: list):
+        data = ''.join(lines).encode('utf-8')
+        f.write(data)
+        self.num_records += len(lines)
+        self.offset += len(data)
+
+    def read(self, repair: bool = True) -> list:
+        if not os.path.exists(self.path):
+            return []
+        records = []
+        offset = 0
+        with open(self.path, 'rb') as f:
+            for line in f:
+                try:
+                    if not line.endswith(b'\n'):
+                        raise ValueError('record is not terminated')
+                    records.append(json.loads(line.decode('utf-8')))
+                except ValueError:
+                    if repair:
+                        print(f'Journal: dropping incomplete record after {len(records)} records')
+                    break
+                offset += len(line)
+        if not repair:
+            return records
+        if offset != os.path.getsize(self.path):
+            os.truncate(self.path, offset)
+        self.offset = offset
+        self.num_records = len(records)
+        self.compacted_offset = 0
+        self.compacted_records = 0
+        return records
+
+    def replay(self, tracker: ActivityTracker) -> int:
+        records = self.read()
+        running = { }
+        for record in records:
+            if record["op"] == "start":
+                running[record["activity"]] = record["start"]
+            elif record["op"] == "stop":
+                running.pop(record["activity"], None)
+            apply_record(tracker, record)
+        for name, start in running.items():
+            print(f'Journal: discarding unfinished timer for "{name}" started at {start}')
+        self.num_records = len(records)
+        return self.num_records
+
+    def should_compact(self) -> bool:
+        return self.num_records - self.compacted_records >= self.compact_every
+
+    def mark(self):
+        with self.lock:
+            return self.offset, self.num_records
+
+    def compact(self, columns, mark=None, unread: set = None):
+        # columns is a snapshot taken at mark, records appended after it stay in the journal.
+        # offset and num_records count everything appended since the journal was read, so a
+        # mark stays valid even if an older compaction finishes in between.
+        if mark is None:
+            mark = self.mark()
+        saved = save_columns(columns, self.snapshot_path, unread)
+        self.truncate(mark)
+        return saved
+
+    def truncate(self, mark):
+        offset, num_records = mark
+        with self.lock:
+            if offset <= self.compacted_offset:
+                return
+            tail = b''
+            if os.path.exists(self.path):
+                with open(self.path, 'rb') as f:
+                    f.seek(offset - self.compacted_offset)
+                    tail = f.read()
+            temp_path = self.path + '.tmp'
+            with open(temp_path, 'wb') as f:
+                f.write(tail)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, self.path)
+            self.compacted_offset = offset
+            self.compacted_records = num_records
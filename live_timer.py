@@ -0,0 +1,81 @@
+import time
+import tkinter as tk
+from datetime import datetime
+from typing import Dict
+from codec import format_seconds
+
+class RunningTimer:
+    __slots__ = ('label', 'started', 'text')
+
+    def __init__(self, label: tk.Widget, started: float):
+        self.label = label
+        self.started = started
+        self.text = None
+
+class LiveTimer:
+    # Updates the labels of running timers once a second. Nothing is scheduled while no timer
+    # is running or the window is minimized, and a tick only touches the running timers.
+    widget: tk.Misc
+    timers: Dict[str, RunningTimer]
+    visible: bool
+    after_id: str | None
+
+    def __init__(self, widget: tk.Misc):
+        self.widget = widget
+        self.timers = { }
+        self.visible = True
+        self.after_id = None
+        widget.bind('<Unmap>', self.on_unmap, add='+')
+        widget.bind('<Map>', self.on_map, add='+')
+
+    def start(self, key: str, label: tk.Widget, start_time: datetime):
+        elapsed = (datetime.now() - start_time).total_seconds()
+        self.timers[key] = RunningTimer(label, time.monotonic() - elapsed)
+        self.schedule(0)
+
+    def stop(self, key: str):
+        self.timers.pop(key, None)
+        if len(self.timers) == 0:
+            self.cancel()
+
+    def clear(self):
+        self.timers.clear()
+        self.cancel()
+
+    def running(self, key: str) -> bool:
+        return key in self.timers
+
+    def schedule(self, delay: int):
+        if self.after_id is None and self.visible and len(self.timers) > 0:
+            self.after_id = self.widget.after(delay, self.tick)
+
+    def cancel(self):
+        if self.after_id is not None:
+            self.widget.after_cancel(self.after_id)
+            self.after_id = None
+
+    def tick(self):
+        self.after_id = None
+        now = time.monotonic()
+        next_tick = 1.0
+        for timer in self.timers.values():
+            elapsed = now - timer.started
+            text = format_seconds(max(int(elapsed), 0))
+            if text != timer.text:
+                timer.label.config(text=text)
+                timer.text = text
+            next_tick = min(next_tick, 1.0 - elapsed % 1.0)
+        # wake up just after the next whole second so the display never skips a second
+        self.schedule(int(next_tick * 1000) + 5)
+
+    def on_unmap(self, event):
+        if event.widget is self.widget:
+            self.visible = False
+            self.cancel()
+
+    def on_map(self, event):
+        if event.widget is self.widget:
+            self.visible = True
+            for timer in self.timers.values():
+                timer.text = None
+            self.schedule(0)
@@ -0,0 +1,238 @@
+import time
+import json
+import asyncio
+import socket
+import random
+import argparse
+import tempfile
+import threading
+import requests
+from datetime import datetime, timedelta
+from harness import start_server, start_async_server, stop_server, PASSWORD
+from async_server import raise_file_limit
+from http_client import ServerSession
+from journal import make_record
+from benchmark import make_tracker
+
+def percentile(values, p):
+    if len(values) == 0:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+def slow_client(url: str, seconds: float):
+    host, port = url.split('//')[1].split(':')
+    with socket.create_connection((host, int(port))) as sock:
+        sock.sendall(f'POST /retrieve HTTP/1.1\r\nHost: {host}\r\nContent-Length: 1000000\r\n\r\n'.encode())
+        end = time.perf_counter() + seconds
+        while time.perf_counter() < end:
+            sock.sendall(b' ')
+            time.sleep(0.1)
+
+def run_client(url: str, client_id: int, num_requests: int, sync_ratio: float, users: list, latencies: dict):
+    rng = random.Random(client_id)
+    session = requests.Session()
+    revisions = { }
+    t = datetime(2040, 1, 1) + timedelta(days=client_id)
+    for n in range(num_requests):
+        user, password = rng.choice(users)
+        revision = revisions.get(user, 0)
+        if rng.random() < sync_ratio:
+            kind = 'sync'
+            start = t + timedelta(minutes=n)
+            body = { "since": revision, "changes": [make_record("add", f'Client {client_id}', start, start + timedelta(seconds=30))] }
+        else:
+            kind = 'retrieve'
+            body = { "since": revision }
+        body["password"] = password
+        if user is not None:
+            body["user"] = user
+        begin = time.perf_counter()
+        res = session.post(f'{url}/{kind}', json=body)
+        latencies[kind].append(time.perf_counter() - begin)
+        if res.status_code != 200:
+            raise Exception(f'{kind} failed with {res.status_code}')
+        revisions[user] = res.json()["revision"]
+    session.close()
+
+def run_load(url: str, num_clients: int, num_requests: int, sync_ratio: float, slow: float = 0, users: list = None):
+    if users is None:
+        users = [(None, PASSWORD)]
+    latencies = { 'retrieve': [], 'sync': [] }
+    if slow > 0:
+        threading.Thread(target=slow_client, args=(url, slow), daemon=True).start()
+        time.sleep(0.2)
+    threads = [
+        threading.Thread(target=run_client, args=(url, i, num_requests, sync_ratio, users, latencies))
+        for i in range(num_clients)
+    ]
+    begin = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - begin
+    total = sum(len(v) for v in latencies.values())
+    print(f'  {num_clients} clients, {total} requests in {elapsed:.2f} s ({total / elapsed:.0f} req/s)')
+    for kind, values in latencies.items():
+        print(f'    {kind:<8} p50 {percentile(values, 50) * 1000:7.2f} ms, p99 {percentile(values, 99) * 1000:7.2f} ms')
+
+SERVERS = { 'threaded': 'Threaded', 'single': 'Single-threaded', 'async': 'Async' }
+
+def start(kind: str, directory: str):
+    if kind == 'async':
+        return start_async_server(directory)
+    return start_server(directory, threaded=kind == 'threaded')
+
+def run_mode(kind: str, args):
+    print(f'{SERVERS[kind]} server, {args.history:,} instances of history')
+    with tempfile.TemporaryDirectory() as directory:
+        make_tracker(args.history).to_dataframe().to_csv(f'{directory}/activities.csv', index=False)
+        httpd, url = start(kind, directory)
+        try:
+            if args.connections:
+                run_connections(url, args.connections, args)
+            else:
+                run_load(url, args.clients, args.requests, args.sync_ratio, args.slow)
+        finally:
+            stop_server(httpd)
+
+async def read_response(reader: asyncio.StreamReader) -> tuple:
+    status = int((await reader.readline()).split()[1])
+    headers = { }
+    while (line := await reader.readline()) not in (b'\r\n', b''):
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    if headers.get('transfer-encoding') == 'chunked':
+        chunks = [ ]
+        while (size := int((await reader.readline()).strip(), 16)) > 0:
+            chunks.append(await reader.readexactly(size))
+            await reader.readline()
+        await reader.readline()
+        return status, b''.join(chunks)
+    return status, await reader.readexactly(int(headers.get('content-length', 0)))
+
+async def connection_client(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, client_id: int, revision: int, args, latencies: dict):
+    rng = random.Random(client_id)
+    t = datetime(2040, 1, 1) + timedelta(days=client_id)
+    try:
+        for n in range(args.requests):
+            roll = rng.random()
+            if roll < args.sync_ratio:
+                kind = 'sync'
+                start = t + timedelta(minutes=n)
+                body = { "since": revision, "changes": [make_record("add", f'Client {client_id}', start, start + timedelta(seconds=30))] }
+            elif roll < args.sync_ratio + args.full_ratio:
+                kind = 'full'
+                body = { }
+            else:
+                kind = 'retrieve'
+                body = { "since": revision }
+            body["password"] = PASSWORD
+            data = json.dumps(body).encode()
+            path = '/sync' if kind == 'sync' else '/retrieve'
+            begin = time.perf_counter()
+            writer.write(f'POST {path} HTTP/1.1\r\nHost: localhost\r\nContent-Type: application/json\r\nContent-Length: {len(data)}\r\n\r\n'.encode() + data)
+            status, content = await asyncio.wait_for(read_response(reader), args.timeout)
+            latencies[kind].append(time.perf_counter() - begin)
+            if status != 200:
+                raise Exception(f'{kind} failed with {status}')
+            if kind != 'full':
+                revision = json.loads(content)["revision"]
+    finally:
+        writer.close()
+
+async def drive_connections(url: str, num_connections: int, args, latencies: dict) -> tuple:
+    # every connection is opened before the first request, so the server holds all of them at once
+    host, port = url.split('//')[1].split(':')
+    # clients that are already up to date, so retrieves only carry what others synced since
+    revision = requests.post(url + '/retrieve', json={ "password": PASSWORD, "since": 2 ** 62 }).json()["revision"]
+    opened = await asyncio.gather(*[asyncio.open_connection(host, int(port)) for _ in range(num_connections)], return_exceptions=True)
+    failures = [o for o in opened if isinstance(o, Exception)]
+    begin = time.perf_counter()
+    results = await asyncio.gather(*[
+        connection_client(reader, writer, i, revision, args, latencies)
+        for i, (reader, writer) in enumerate(o for o in opened if not isinstance(o, Exception))
+    ], return_exceptions=True)
+    return time.perf_counter() - begin, failures + [r for r in results if isinstance(r, Exception)]
+
+def run_connections(url: str, num_connections: int, args):
+    raise_file_limit()
+    latencies = { 'retrieve': [], 'sync': [], 'full': [] }
+    elapsed, failures = asyncio.run(drive_connections(url, num_connections, args, latencies))
+    total = sum(len(v) for v in latencies.values())
+    print(f'  {num_connections} open connections, {total} requests in {elapsed:.2f} s ({total / elapsed:.0f} req/s), {len(failures)} connections failed')
+    if len(failures) > 0:
+        print(f'    first failure: {failures[0]!r}')
+    for kind, values in latencies.items():
+        print(f'    {kind:<8} p50 {percentile(values, 50) * 1000:7.2f} ms, p99 {percentile(values, 99) * 1000:7.2f} ms')
+
+def run_users(num_users: int, args):
+    users = { f'user{i}': f'password{i}' for i in range(num_users) }
+    print(f'{num_users:,} users, user0 has {args.history:,} instances of history')
+    with tempfile.TemporaryDirectory() as directory:
+        httpd, url = start_server(directory, users=users)
+        tracker = make_tracker(args.history)
+        httpd.shards.get('user0').commit([
+            make_record("add", a.name, i.start_time, i.end_time)
+            for a in tracker.activities.values()
+            for i in a.instances
+        ])
+        try:
+            run_load(url, args.clients, args.requests, args.sync_ratio, users=list(users.items()))
+        finally:
+            stop_server(httpd)
+
+def run_sync_latency(args):
+    # one client syncing a single change at a time, as after each stop: a new connection per
+    # request (plain requests.post, as the client used to) against the pooled keep-alive session
+    print(f'Sequential syncs, {args.requests} per transport, {args.history:,} instances of history')
+    with tempfile.TemporaryDirectory() as directory:
+        make_tracker(args.history).to_dataframe().to_csv(f'{directory}/activities.csv', index=False)
+        httpd, url = start_server(directory)
+        session = ServerSession(url)
+        transports = {
+            'new connection': lambda body: requests.post(url + '/sync', json=body, timeout=10),
+            'pooled session': lambda body: session.post('/sync', json=body)
+        }
+        try:
+            revision = 0
+            for n, (name, post) in enumerate(transports.items()):
+                latencies = [ ]
+                for i in range(args.requests):
+                    start = datetime(2041, 1, 1) + timedelta(days=n, minutes=i)
+                    body = { "password": PASSWORD, "since": revision, "changes": [make_record("add", name, start, start + timedelta(seconds=30))] }
+                    begin = time.perf_counter()
+                    revision = post(body).json()["revision"]
+                    latencies.append(time.perf_counter() - begin)
+                print(f'    {name:<16} p50 {percentile(latencies, 50) * 1000:7.2f} ms, p99 {percentile(latencies, 99) * 1000:7.2f} ms')
+        finally:
+            session.close()
+            stop_server(httpd)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Drive concurrent retrieve/sync clients against a local server')
+    parser.add_argument('--clients', type=int, default=50)
+    parser.add_argument('--requests', type=int, default=40, help='requests per client')
+    parser.add_argument('--sync-ratio', type=float, default=0.2)
+    parser.add_argument('--history', type=int, default=10_000)
+    parser.add_argument('--slow', type=float, default=0, help='seconds one extra client spends trickling a request body')
+    parser.add_argument('--single-threaded', action='store_true', help='also run against the single-threaded server')
+    parser.add_argument('--async', dest='use_async', action='store_true', help='also run against async_server.py')
+    parser.add_argument('--connections', type=int, help='hold this many keep-alive connections open at once, one client each, instead of --clients threads')
+    parser.add_argument('--timeout', type=float, default=10, help='seconds a request may take with --connections before its connection counts as failed')
+    parser.add_argument('--full-ratio', type=float, default=0.05, help='share of full CSV retrieves with --connections')
+    parser.add_argument('--users', type=int, nargs='+', help='run once per user count with requests spread across per-user shards')
+    parser.add_argument('--sync-latency', action='store_true', help='compare per-sync latency with and without a pooled connection')
+    args = parser.parse_args()
+    if args.sync_latency:
+        run_sync_latency(args)
+    elif args.users:
+        for num_users in args.users:
+            run_users(num_users, args)
+    else:
+        run_mode('threaded', args)
+        if args.single_threaded:
+            run_mode('single', args)
+        if args.use_async:
+            run_mode('async', args)
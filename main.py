@@ -1,14 +1,20 @@
 import tkinter as tk
 import json
 import os
-import requests
-from datetime import datetime
-from typing import List
 from tkinter import ttk, messagebox, simpledialog
 from objects import ActivityTracker
-import pandas as pd
-
-from util import pretty_duration, get_number, str_to_datetime, datetime_to_str, ask_time
+from journal import Journal, make_record
+from archive import open_archive
+from storage import data_file, format_of, hold_lock, iter_csv, load_tracker, read_cache, read_csv, release_lock, save_tracker, save_columns
+from sync_client import SyncClient
+from instance_view import PagedInstanceList
+from worker import BackgroundWorker
+from live_timer import LiveTimer
+from metrics import Metrics
+from http_client import ServerSession
+from transfer import CHUNK_SIZE, choose_encoding, encode_chunks
+
+from util import pretty_duration, str_to_datetime, ask_time
 
 config = {}
 if not os.path.exists('config.json'):
@@ -25,6 +31,34 @@ class TimeTrackerApp(tk.Tk):
         self.geometry("1280x720")
 
         self.data = ActivityTracker()
+        self.metrics = Metrics(config.get('metrics', False), config.get('profile'))
+        self.worker = BackgroundWorker(self, config.get('worker_queue_size', 64))
+        self.timeout = config.get('timeout', 10)
+        self.retries = config.get('retries', 3)
+        self.session = None
+        if 'server' in config and 'server_port' in config:
+            self.session = ServerSession(f"http://{config['server']}:{config['server_port']}", self.timeout, config.get('connect_timeout'))
+        self.save_scheduled = False
+        self.sync_scheduled = False
+        self.syncing = False
+        self.sync_again = False
+        self.retrieving = False
+        self.upload_waiting = False
+        self.changed = False
+        self.data_file = data_file(config.get('storage_format', 'csv'))
+        try:
+            hold_lock(self.data_file)
+        except Exception as e:
+            messagebox.showerror("Already Open", str(e))
+            raise
+        self.journal = None
+        if config.get('storage') == 'journal':
+            self.journal = Journal('activities.journal', self.data_file, config.get('journal_compact_every', 500))
+        self.sync = None
+        self.sync_retry_scheduled = False
+        if config.get('sync', 'delta') == 'delta' and 'server' in config and 'server_port' in config:
+            self.sync = SyncClient(self.session.url, config.get('password'), user=config.get('user'), timeout=self.timeout, session=self.session, batch_size=config.get('sync_batch_size', 5000))
+        self.protocol("WM_DELETE_WINDOW", self.close)
 
         self.add_activity_frame = ttk.Frame(self)
         self.add_activity_frame.pack(side=tk.TOP, fill=tk.X)
@@ -91,8 +125,8 @@ class TimeTrackerApp(tk.Tk):
         self.instance_list.pack_forget()
 
         self.instance_list_scrollbar = ttk.Scrollbar(self.activities_frame, orient="vertical", command=self.instance_list.yview)
-        self.instance_list.configure(yscrollcommand=self.instance_list_scrollbar.set)
         self.instance_list_scrollbar.pack_forget()
+        self.instance_view = PagedInstanceList(self.instance_list, self.instance_list_scrollbar, config.get('instance_page_size', 200), lambda name: self.data.load_older(name))
 
         # Timer control buttons
         self.start_timer_button = ttk.Button(self.activities_frame, text="Start Timer", command=self.start_timer)
@@ -103,16 +137,18 @@ class TimeTrackerApp(tk.Tk):
         self.hours_last_week_label = ttk.Label(self.activities_frame, text="0:00")
 
         # Save button
-        self.save_data_button = ttk.Button(self.report_frame, text="Save Data", command=self.save_data)
+        self.save_data_button = ttk.Button(self.report_frame, text="Save Data", command=lambda: self.save_data(True))
         self.save_data_button.pack(side=tk.LEFT, padx=(10, 5), pady=10)
 
-        self.load_data()
+        self.live_timer = LiveTimer(self)
 
-        # Initialize the live timer update
-        self.update_live_timer()
+        self.load_data()
 
     def show_activities_list(self):
+        # stopped here rather than by unload_activity so the stop is journaled and synced
+        self.stop_timer()
         self.data.unload_activity()
+        self.live_timer.clear()
         self.instance_list.pack_forget()
         self.start_timer_button.pack_forget()
         self.stop_timer_button.pack_forget()
@@ -132,9 +168,8 @@ class TimeTrackerApp(tk.Tk):
             return
         self.activities_list.pack_forget()
         self.instance_list.pack(side=tk.LEFT, fill=tk.BOTH, expand=True, padx=10, pady=10)
-        self.instance_list.delete(*self.instance_list.get_children())
-        for i in self.data.get_current_activity().get_sorted_instances():
-            self.instance_list.insert("", tk.END, i.to_string(), values=(i.pretty_date(), i.pretty_start_time(), i.pretty_stop_time(), pretty_duration(i.duration)))
+        with self.metrics.timer('ui/instances'):
+            self.instance_view.show(self.data.get_current_activity())
         self.start_timer_button.pack(side=tk.TOP, pady=(10, 5))
         self.activities_button.pack(side=tk.TOP, pady=(5, 10))
         self.delete_instance_button.pack(side=tk.TOP, pady=(5, 10))
@@ -154,70 +189,246 @@ class TimeTrackerApp(tk.Tk):
         result = messagebox.askyesno("Delete Instance", "Are you sure?")
         if not result:
             return
-        if not self.data.get_current_activity().delete_instance(selected_item[0]):
+        activity = self.data.get_current_activity()
+        if not activity.delete_instance(selected_item[0]):
             return
-        self.show_activities_list()
-        self.show_instance_list(None)
+        self.record_change(make_record("delete", activity.name, str_to_datetime(selected_item[0])))
+        self.instance_view.delete(selected_item[0])
+        self.refresh_activity(activity.name)
         self.save_data()
 
-    def save_data(self):
-        self.data.to_dataframe().to_csv("activities.csv", index=False)
-        print("Data Saved!")
+    def refresh_activity(self, name):
+        with self.metrics.timer('ui/refresh'):
+            self.update_activity_row(name)
+
+    def update_activity_row(self, name):
+        if name not in self.data.activities:
+            if self.activities_list.exists(name):
+                self.activities_list.delete(name)
+            return
+        activity = self.data.activities[name]
+        values = (name, pretty_duration(activity.get_total_duration()), pretty_duration(activity.get_hours_last_week()))
+        if self.activities_list.exists(name):
+            self.activities_list.item(name, values=values)
+        else:
+            self.activities_list.insert("", tk.END, name, values=values)
+        if name == self.data.current_activity:
+            self.hours_last_week_label.config(text='7 Day: ' + pretty_duration(activity.get_hours_last_week()))
+
+    def record_change(self, record):
+        self.changed = True
+        if self.journal is not None:
+            self.journal.append(record)
+        if self.sync is not None:
+            self.sync.queue(record)
+
+    def save_data(self, force=False):
+        if self.journal is not None and not force and not self.journal.should_compact():
+            return
+        if force:
+            self.write_data()
+        elif not self.save_scheduled:
+            self.save_scheduled = True
+            self.after(config.get('save_delay', 250), self.write_data)
+
+    def write_data(self):
+        self.save_scheduled = False
+        data = self.data
+        columns = data.to_columns()
+        unread = data.unread_periods()
+        if self.journal is not None:
+            mark = self.journal.mark()
+            def write():
+                return "Journal Compacted!", self.journal.compact(columns, mark, unread)
+        else:
+            def write():
+                return "Data Saved!", save_columns(columns, self.data_file, unread)
+        self.worker.submit(self.metrics.wrap('save', write), lambda result: self.finish_save(data, result), key='save', retries=self.retries)
+
+    def finish_save(self, data, result):
+        # the archive learns which partitions now match memory, see Archive.saved
+        if result is None:
+            return
+        message, saved = result
+        data.saved(saved)
+        self.print_result(message)
+
+    def print_result(self, message):
+        if message is not None:
+            print(message)
+
+    def post(self, path, body=None, **kwargs):
+        return self.session.post(path, json=body, **kwargs)
 
     def get_data_from_server(self):
         if 'server' not in config or 'server_port' not in config:
             print('Server or server port not in config file, reading locally')
             return None
-        ip = config['server']
-        port = config['server_port']
-        res = requests.post(f'http://{ip}:{port}/retrieve', json={
-            "password": config['password']    
-        })
-        if res.status_code != 200:
-            print(f'Server responded with {res.status_code}, {res.content.decode()}')
-            return None
-        data = res.content.decode()
-        print('Loaded data from server, writing activities file')
-        if len(data) > 0:
-            with open('activities.csv', 'w', encoding='utf-8') as f:
-                f.write(data)
-        return data
+        body = { "password": config['password'] }
+        if 'user' in config:
+            body["user"] = config['user']
+        def fetch():
+            res = self.post('/retrieve', body, stream=True)
+            download = 'activities.download.csv'
+            with open(download, 'wb') as f:
+                for chunk in res.iter_content(CHUNK_SIZE):
+                    f.write(chunk)
+            self.metrics.observe('retrieve_bytes', os.path.getsize(download))
+            if os.path.getsize(download) == 0:
+                os.remove(download)
+                return None
+            print('Loaded data from server, writing activities file')
+            if self.data_file == 'activities.csv':
+                os.replace(download, 'activities.csv')
+                return load_tracker('activities.csv')
+            tracker = read_csv(download)
+            os.remove(download)
+            save_tracker(tracker, self.data_file)
+            return tracker
+        self.retrieving = self.worker.submit(self.metrics.wrap('retrieve', fetch), self.finish_retrieve, retries=self.retries)
+
+    def finish_retrieve(self, tracker):
+        self.retrieving = False
+        self.replace_data(tracker)
+        if self.upload_waiting:
+            self.upload_waiting = False
+            self.sync_data()
+
+    def replace_data(self, tracker):
+        if tracker is None:
+            return
+        if self.changed:
+            # changes made while loading win over the loaded copy, which fills in the rest
+            added = self.data.merge(tracker)
+            print(f'Merged {added} instances from the loaded copy into the changes made while loading')
+            self.save_data(True)
+            with self.metrics.timer('ui/activities'):
+                for name in tracker.activities.keys():
+                    self.update_activity_row(name)
+            self.instance_view.reload()
+            return
+        self.data = tracker
+        self.show_activities_list()
+        with self.metrics.timer('ui/activities'):
+            self.activities_list.delete(*self.activities_list.get_children())
+            for name in self.data.activities.keys():
+                self.update_activity_row(name)
+
+    def sync_changes(self):
+        if self.syncing:
+            self.sync_again = True
+            return
+        pushed = self.sync.prepare_push(self.data)
+        self.syncing = self.worker.submit(self.metrics.wrap('sync', lambda: self.sync.send(pushed)), lambda res: self.finish_sync(pushed, res), retries=self.retries)
+        if not self.syncing:
+            self.sync.finish_push(self.data, pushed, None)
+
+    def finish_sync(self, pushed, res):
+        self.syncing = False
+        applied = self.sync.finish_push(self.data, pushed, res)
+        if applied is not None:
+            if len(applied) > 0:
+                print(f'Applied {len(applied)} changes from server')
+                self.save_data(True)
+                for name in set(change["activity"] for change in applied):
+                    self.refresh_activity(name)
+                with self.metrics.timer('ui/instances'):
+                    self.instance_view.reload()
+            self.sync.save_state()
+            if self.sync.has_pending():
+                # the next batch of the history or the queue
+                self.sync_again = True
+            else:
+                print('Data Synced to server')
+        elif not self.sync_retry_scheduled:
+            print(f'{len(self.sync.pending)} changes kept for the next sync')
+            self.sync_retry_scheduled = True
+            self.after(int(config.get('sync_retry_interval', 30) * 1000), self.retry_sync)
+        if self.sync_again:
+            self.sync_again = False
+            self.sync_changes()
+
+    def scheduled_sync(self):
+        self.sync_scheduled = False
+        self.sync_changes()
+
+    def retry_sync(self):
+        self.sync_retry_scheduled = False
+        self.sync_changes()
 
     def sync_data(self):
+        if self.sync is not None:
+            # changes made within sync_delay milliseconds of each other go out in one request
+            if not self.sync_scheduled:
+                self.sync_scheduled = True
+                self.after(config.get('sync_delay', 250), self.scheduled_sync)
+            return None
         if 'server' not in config or 'server_port' not in config:
             print('Server or server port not in config file, reading locally')
             return None
         if 'password' not in config:
             print('Password not in config')
             return None
-        ip = config['server']
-        port = config['server_port']
-        f = open('activities.csv', 'r', encoding='utf-8')
-        data = f.read()
-        f.close()
-        res = requests.post(f'http://{ip}:{port}/sync', json={
-            "password": config['password'],
-            "data": data
-        })
-        if res.status_code != 200:
-            print(f'Server responded with {res.status_code}, {res.content.decode()}')
+        if self.retrieving:
+            # the upload replaces the server's copy, so it waits until that copy is merged in
+            self.upload_waiting = True
             return None
-        print('Data Synced to server')
+        # the whole history is uploaded, including archived partitions. It is taken from memory
+        # because the file may still be waiting for a debounced save.
+        self.data.load_all()
+        columns = self.data.to_columns()
+        read_chunks = lambda: iter_csv(columns)
+        def send():
+            if self.session.server_encodings is None:
+                # the server has not answered yet, so it may not take streamed uploads
+                data = b''.join(c.encode('utf-8') if isinstance(c, str) else c for c in read_chunks()).decode('utf-8')
+                body = { "password": config['password'], "data": data }
+                if 'user' in config:
+                    body["user"] = config['user']
+                self.post('/sync', body)
+                return 'Data Synced to server'
+            encoding = choose_encoding(self.session.server_encodings)
+            headers = { "Content-Type": "text/csv", "X-Password": config['password'] }
+            if 'user' in config:
+                headers["X-User"] = config['user']
+            if encoding is not None:
+                headers["Content-Encoding"] = encoding
+            self.post('/sync', data=encode_chunks(read_chunks(), encoding), headers=headers)
+            return 'Data Synced to server'
+        self.worker.submit(self.metrics.wrap('sync', send), self.print_result, key='sync', retries=self.retries)
 
     def load_data(self):
-        self.get_data_from_server()
-
-        file_name = "activities.csv"
-        if not os.path.exists(file_name):
-            return
-        df = pd.read_csv("activities.csv")
-        self.data = ActivityTracker.from_dataframe(df)
-        for k in self.data.activities.keys():
-            self.activities_list.insert("", tk.END, k, values=(
-                k, 
-                pretty_duration(self.data.activities[k].get_total_time()), 
-                pretty_duration(self.data.activities[k].get_hours_last_week())
-            ))
+        with self.metrics.timer('load'):
+            self.read_data()
+        with self.metrics.timer('ui/activities'):
+            for k in self.data.activities.keys():
+                self.activities_list.insert("", tk.END, k, values=(
+                    k, 
+                    pretty_duration(self.data.activities[k].get_total_duration()), 
+                    pretty_duration(self.data.activities[k].get_hours_last_week())
+                ))
+        if self.sync is not None:
+            self.sync_changes()
+        else:
+            self.get_data_from_server()
+
+    def read_data(self):
+        tracker = None
+        fast_start = self.journal is None and format_of(self.data_file) == 'csv' and config.get('fast_start', True)
+        if fast_start and os.path.exists(self.data_file):
+            # show the last parsed snapshot right away and parse the edited CSV in the background
+            tracker, fresh = read_cache(self.data_file)
+            if tracker is not None and not fresh:
+                self.worker.submit(self.metrics.wrap('load', lambda: load_tracker(self.data_file)), self.replace_data)
+        if format_of(self.data_file) == 'archive':
+            tracker = open_archive(self.data_file, config.get('archive_period', 'month'), config.get('archive_recent', 2))
+        elif tracker is None and os.path.exists(self.data_file):
+            tracker = load_tracker(self.data_file)
+        if tracker is not None:
+            self.data = tracker
+        if self.journal is not None and self.journal.replay(self.data) > 0:
+            self.changed = True
+            self.save_data(True)
 
     def add_activity(self):
         activity_name = simpledialog.askstring("Activity Title", "What is the name of the activity?")
@@ -236,6 +447,7 @@ class TimeTrackerApp(tk.Tk):
             activity_name = selected_item[0]
             self.data.remove_activity(activity_name)
             self.activities_list.delete(activity_name)
+            self.record_change(make_record("remove", activity_name))
         self.save_data()
         self.sync_data()
 
@@ -254,6 +466,9 @@ class TimeTrackerApp(tk.Tk):
         print("Starting timer")
         activity_name = selected_item[0]
         self.data.start_timer(activity_name)
+        instance = self.data.activities[activity_name].get_last_instance()
+        self.live_timer.start(activity_name, self.current_activity_time_label, instance.start_time)
+        self.record_change(make_record("start", activity_name, instance.start_time))
 
     def add_manual_instance(self):
         start_time = ask_time('Start Time')
@@ -263,14 +478,16 @@ class TimeTrackerApp(tk.Tk):
         if end_time is None:
             return
 
-        instance = self.data.get_current_activity().add_instance()
+        activity = self.data.get_current_activity()
+        instance = activity.add_instance()
         instance.start_time = start_time
         instance.end_time = end_time
         instance.duration = end_time - start_time
+        self.record_change(make_record("add", activity.name, start_time, end_time))
+        self.instance_view.insert(instance)
+        self.refresh_activity(activity.name)
         self.save_data()
         self.sync_data()
-        self.show_activities_list()
-        self.show_instance_list(None)
 
     def reset_current_activity_label(self):
         self.current_activity_label.config(text="")
@@ -279,24 +496,34 @@ class TimeTrackerApp(tk.Tk):
 
     def stop_timer(self):
         current_activity = self.data.get_current_activity()
+        if current_activity is None:
+            return
+        instance = current_activity.get_last_instance()
         if self.data.stop_timer() is None:
             return
+        self.live_timer.stop(current_activity.name)
+        self.record_change(make_record("stop", current_activity.name, instance.start_time, instance.end_time))
+        self.data.set_activity(current_activity.name)
         self.stop_timer_button.pack_forget()
         self.start_timer_button.pack(side=tk.TOP, pady=(5, 10))
-        self.activities_list.set(current_activity.name, "Time", current_activity.get_total_time())
+        self.instance_view.insert(instance)
+        self.refresh_activity(current_activity.name)
         self.current_activity_time_label.config(text="0:00:00")
         self.current_activity_colon.config(text=": ")
         self.save_data()
         self.sync_data()
-        self.show_activities_list()
-        self.show_instance_list(None)
-
-    def update_live_timer(self):
-        current_time = self.data.get_current_time()
-        if current_time is not None:
-            self.current_activity_time_label.config(text=current_time)
 
-        self.after(1000, self.update_live_timer)
+    def close(self):
+        # a running timer is stopped like the Stop Timer button would, so it is journaled and queued
+        self.stop_timer()
+        if self.save_scheduled:
+            self.write_data()
+        self.worker.close()
+        release_lock(self.data_file)
+        if self.session is not None:
+            self.session.close()
+        self.metrics.dump(config.get('metrics_file', 'metrics.json'))
+        self.destroy()
 
 if __name__ == "__main__":
     app = TimeTrackerApp()
@@ -0,0 +1,156 @@
+import json
+import time
+import cProfile
+import threading
+from contextlib import contextmanager, nullcontext
+from typing import Callable, Dict
+
+# Opt-in timing histograms and counters shared by the client and the server. With metrics
+# disabled timer() hands back a shared no-op context, so the instrumented paths cost one call.
+
+class Histogram:
+    # Power of two buckets over integer values (microseconds for timings, bytes for sizes),
+    # bucket i counts values below 2 ** i
+    count: int
+    total: int
+    low: int | None
+    high: int | None
+    buckets: Dict[int, int]
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.low = None
+        self.high = None
+        self.buckets = { }
+
+    def add(self, value: int):
+        value = max(int(value), 0)
+        self.count += 1
+        self.total += value
+        self.low = value if self.low is None else min(self.low, value)
+        self.high = value if self.high is None else max(self.high, value)
+        bucket = value.bit_length()
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+    def percentile(self, fraction: float) -> int:
+        # upper bound of the bucket holding the value, capped at the largest value seen
+        rank = fraction * self.count
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return min(2 ** bucket - 1, self.high)
+        return self.high or 0
+
+    def to_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "sum": self.total,
+            "min": self.low,
+            "max": self.high,
+            "mean": self.total / self.count if self.count > 0 else None,
+            "p50": self.percentile(0.5),
+            "p90": self.percentile(0.9),
+            "p99": self.percentile(0.99),
+            "buckets": { str(2 ** bucket): self.buckets[bucket] for bucket in sorted(self.buckets) }
+        }
+
+class Metrics:
+    enabled: bool
+    profile: str | None
+    profile_path: str
+    histograms: Dict[str, Histogram]
+    counters: Dict[str, int]
+    lock: threading.Lock
+    started: float
+
+    def __init__(self, enabled: bool = False, profile: str = None, profile_path: str = 'profile_{name}.prof'):
+        # profile names one timed operation, the first time it runs it is captured with cProfile
+        # and written to profile_path. Profiling works even with the metrics themselves disabled.
+        self.enabled = enabled
+        self.profile = profile
+        self.profile_path = profile_path
+        self.histograms = { }
+        self.counters = { }
+        self.lock = threading.Lock()
+        self.started = time.time()
+
+    def observe(self, name: str, value: int):
+        if not self.enabled:
+            return
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.add(value)
+
+    def count(self, name: str, amount: int = 1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def timer(self, name: str):
+        # times the with block into the histogram name (in microseconds)
+        if name == self.profile:
+            return self.profiled(name)
+        if not self.enabled:
+            return nullcontext()
+        return self.timed(name)
+
+    @contextmanager
+    def timed(self, name: str):
+        begin = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, (time.perf_counter() - begin) * 1_000_000)
+
+    @contextmanager
+    def profiled(self, name: str):
+        with self.lock:
+            # only the first run is captured, later and concurrent runs are just timed
+            capture = self.profile == name
+            self.profile = None
+        if not capture:
+            with self.timer(name):
+                yield
+            return
+        profiler = cProfile.Profile()
+        try:
+            with self.timer(name):
+                profiler.enable()
+                try:
+                    yield
+                finally:
+                    profiler.disable()
+        finally:
+            path = self.profile_path.format(name=name.replace('/', '_'))
+            profiler.dump_stats(path)
+            print(f'Profile of {name} written to {path}')
+
+    def wrap(self, name: str, function: Callable) -> Callable:
+        # for work handed to another thread, so the timing covers the run and not the wait
+        def timed_function(*args, **kwargs):
+            with self.timer(name):
+                return function(*args, **kwargs)
+        return timed_function
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {
+                "started": self.started,
+                "uptime": time.time() - self.started,
+                "counters": dict(self.counters),
+                "histograms": { name: histogram.to_dict() for name, histogram in sorted(self.histograms.items()) }
+            }
+
+    def to_json(self) -> str:
+        return json.dumps(self.snapshot(), indent=2)
+
+    def dump(self, path: str):
+        if not self.enabled:
+            return
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(self.to_json())
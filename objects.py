@@ -1,29 +1,312 @@
-from typing import List, Dict
-from datetime import datetime, timedelta
-import pandas as pd
-from util import pretty_time, append_df, str_to_datetime, datetime_to_str
+from typing import List, Dict, TYPE_CHECKING
+import bisect
+from array import array
+from datetime import date, datetime, timedelta
+import numpy as np
+if TYPE_CHECKING:
+    import pandas as pd
+    from archive import Archive
+from codec import TIME_FORMAT, format_clock, format_date, format_duration
+from util import pretty_time, datetime_to_str, str_to_datetime, datetime_to_micros, micros_to_datetime, EPOCH
+
+NO_END = -2 ** 63
+DAY = 86_400_000_000
+
+# pandas takes about as long to import as everything else combined, so it is only imported
+# by the functions that convert to and from DataFrames
+
+def parse_time_column(column: 'pd.Series') -> 'pd.Series':
+    # pandas only has a fast path for four digit years, so expand %y the way strptime does
+    import pandas as pd
+    column = column.astype(str)
+    century = column.str[:2].lt("69").map({True: "20", False: "19"})
+    return pd.to_datetime(century + column, format='%Y' + TIME_FORMAT[2:])
+
+def format_time_column(micros: np.ndarray) -> 'pd.Series':
+    import pandas as pd
+    iso = pd.Series(np.datetime_as_string(micros.astype('datetime64[us]'), unit='us'))
+    return iso.str.slice(2).str.replace('T', ' ', regex=False)
+
+def columns_to_dataframe(names: List[str], counts: List[int], starts: np.ndarray, ends: np.ndarray) -> 'pd.DataFrame':
+    import pandas as pd
+    return pd.DataFrame({
+        "Activity": np.repeat(np.array(names, dtype=object), counts),
+        "Start": format_time_column(starts),
+        "End": format_time_column(ends)
+    }, columns=["Activity", "Start", "End"])
+
+def total_from(starts: array, ends: array, start: int, end: int = None) -> int:
+    # summed durations of the finished instances starting in [start, end), starts being sorted
+    lo = bisect.bisect_left(starts, start)
+    hi = len(starts) if end is None else bisect.bisect_left(starts, end)
+    if hi <= lo:
+        return 0
+    window_starts = np.frombuffer(starts, dtype=np.int64)[lo:hi]
+    window_ends = np.frombuffer(ends, dtype=np.int64)[lo:hi]
+    return int(np.where(window_ends == NO_END, 0, window_ends - window_starts).sum())
+
+class RollingWindow:
+    __slots__ = ('num_days', 'first_day', 'total')
+
+    def __init__(self, num_days: int, today: int, starts: array, ends: array):
+        self.num_days = num_days
+        self.first_day = today - num_days + 1
+        self.total = total_from(starts, ends, self.first_day * DAY)
+
+    def add(self, day: int, duration: int):
+        if day >= self.first_day:
+            self.total += duration
+
+    def advance(self, today: int, starts: array, ends: array) -> bool:
+        first_day = today - self.num_days + 1
+        if first_day < self.first_day:
+            return False
+        if first_day > self.first_day:
+            self.total -= total_from(starts, ends, self.first_day * DAY, first_day * DAY)
+        self.first_day = first_day
+        return True
+
+class Aggregates:
+    # The running total and the rolling windows asked for so far. Per-day totals are read from
+    # the sorted instance arrays when needed instead of being kept, which would take more memory
+    # than the arrays themselves.
+    __slots__ = ('total', 'windows')
+
+    def __init__(self):
+        self.total = 0
+        self.windows = { }
+
+    def add(self, start: int, end: int, sign: int = 1):
+        if end == NO_END:
+            return
+        duration = (end - start) * sign
+        day = start // DAY
+        self.total += duration
+        for window in self.windows.values():
+            window.add(day, duration)
+
+    def rebuild(self, starts: np.ndarray, ends: np.ndarray):
+        finished = ends != NO_END
+        self.total = int((ends[finished] - starts[finished]).sum())
+        self.windows = { }
+
+    def window(self, num_days: int, today: int, starts: array, ends: array) -> int:
+        window = self.windows.get(num_days)
+        if window is None or not window.advance(today, starts, ends):
+            window = RollingWindow(num_days, today, starts, ends)
+            self.windows[num_days] = window
+        return window.total
+
+    def days(self, starts: array, ends: array) -> Dict[int, int]:
+        starts = np.frombuffer(starts, dtype=np.int64)
+        ends = np.frombuffer(ends, dtype=np.int64)
+        finished = ends != NO_END
+        starts = starts[finished]
+        durations = ends[finished] - starts
+        if len(starts) == 0:
+            return { }
+        days = starts // DAY
+        firsts = np.concatenate([np.zeros(1, dtype=np.int64), np.flatnonzero(np.diff(days)) + 1])
+        return dict(zip(days[firsts].tolist(), np.add.reduceat(durations, firsts).tolist()))
+
+class InstanceStore:
+    __slots__ = ('starts', 'ends', 'running', 'num_running', 'prefix', 'aggregates')
+
+    def __init__(self):
+        self.starts = array('q')
+        self.ends = array('q')
+        self.running = None
+        self.num_running = 0
+        self.prefix = None
+        self.aggregates = Aggregates()
+
+    def __len__(self) -> int:
+        return len(self.starts)
+
+    def find_running(self):
+        self.running = self.ends.index(NO_END) if self.num_running > 0 else None
+
+    def insert(self, start: int, end: int) -> int:
+        index = bisect.bisect_right(self.starts, start)
+        self.starts.insert(index, start)
+        self.ends.insert(index, end)
+        if self.running is not None and self.running >= index:
+            self.running += 1
+        if end == NO_END:
+            self.running = index
+            self.num_running += 1
+        self.aggregates.add(start, end)
+        self.prefix = None
+        return index
+
+    def remove(self, index: int):
+        end = self.ends[index]
+        self.aggregates.add(self.starts[index], end, -1)
+        del self.starts[index]
+        del self.ends[index]
+        if end == NO_END:
+            self.num_running -= 1
+            self.find_running()
+        elif self.running is not None and self.running > index:
+            self.running -= 1
+        self.prefix = None
+
+    def set_start(self, index: int, start: int) -> int:
+        end = self.ends[index]
+        self.remove(index)
+        return self.insert(start, end)
+
+    def set_end(self, index: int, end: int):
+        previous = self.ends[index]
+        self.aggregates.add(self.starts[index], previous, -1)
+        self.ends[index] = end
+        self.aggregates.add(self.starts[index], end)
+        if previous != NO_END and end == NO_END:
+            self.num_running += 1
+            self.running = index
+        elif previous == NO_END and end != NO_END:
+            self.num_running -= 1
+            self.find_running()
+        self.prefix = None
+
+    def extend(self, starts: np.ndarray, ends: np.ndarray):
+        starts = np.concatenate([np.frombuffer(self.starts, dtype=np.int64), np.asarray(starts, dtype=np.int64)])
+        ends = np.concatenate([np.frombuffer(self.ends, dtype=np.int64), np.asarray(ends, dtype=np.int64)])
+        order = np.argsort(starts, kind='stable')
+        starts = starts[order]
+        ends = ends[order]
+        self.starts = array('q', starts.tobytes())
+        self.ends = array('q', ends.tobytes())
+        self.num_running = int(np.count_nonzero(ends == NO_END))
+        self.find_running()
+        self.aggregates.rebuild(starts, ends)
+        self.prefix = None
+
+    def apply(self, starts: np.ndarray, ends: np.ndarray, deleted: np.ndarray, bulk: int = 64):
+        # sets the end of each of starts, adding the ones not stored yet, and removes the starts in
+        # deleted. More than bulk changes rebuild the arrays once instead of moving them per change.
+        # Returns which of starts and of deleted changed something.
+        known_starts = np.frombuffer(self.starts, dtype=np.int64)
+        known_ends = np.frombuffer(self.ends, dtype=np.int64)
+        if len(known_starts) == 0:
+            self.extend(starts, ends)
+            return np.ones(len(starts), dtype=bool), np.zeros(len(deleted), dtype=bool)
+        index = np.searchsorted(known_starts, starts)
+        found = known_starts[np.minimum(index, len(known_starts) - 1)] == starts
+        changed = ~found | (known_ends[np.minimum(index, len(known_starts) - 1)] != ends)
+        delete_index = np.searchsorted(known_starts, deleted)
+        removed = known_starts[np.minimum(delete_index, len(known_starts) - 1)] == deleted
+        if len(starts) + len(deleted) <= bulk:
+            # the arrays cannot grow while numpy views of them exist
+            del known_starts, known_ends
+            for start, end in zip(starts[changed].tolist(), ends[changed].tolist()):
+                k = self.find(start)
+                if k is None:
+                    self.insert(start, end)
+                else:
+                    self.set_end(k, end)
+            for start in deleted[removed].tolist():
+                self.remove(self.find(start))
+        elif changed.any() or removed.any():
+            kept = np.ones(len(known_starts), dtype=bool)
+            kept[delete_index[removed]] = False
+            updated_ends = known_ends.copy()
+            updated_ends[index[found]] = ends[found]
+            new_starts = np.concatenate([known_starts[kept], starts[~found]])
+            new_ends = np.concatenate([updated_ends[kept], ends[~found]])
+            self.starts = array('q')
+            self.ends = array('q')
+            self.extend(new_starts, new_ends)
+        return changed, removed
+
+    def find(self, start: int) -> int | None:
+        index = bisect.bisect_left(self.starts, start)
+        if index < len(self.starts) and self.starts[index] == start:
+            return index
+        return None
+
+    def duration_prefix(self) -> np.ndarray:
+        if self.prefix is None:
+            starts = np.frombuffer(self.starts, dtype=np.int64)
+            ends = np.frombuffer(self.ends, dtype=np.int64)
+            durations = np.where(ends == NO_END, 0, ends - starts)
+            self.prefix = np.concatenate([np.zeros(1, dtype=np.int64), np.cumsum(durations)])
+        return self.prefix
+
+    def total_between(self, start: int = None, end: int = None) -> int:
+        prefix = self.duration_prefix()
+        lo = 0 if start is None else bisect.bisect_left(self.starts, start)
+        hi = len(self.starts) if end is None else bisect.bisect_left(self.starts, end)
+        return int(prefix[hi] - prefix[lo]) if hi > lo else 0
 
 class ActivityInstance:
-    start_time: datetime
-    end_time: datetime
-    duration: timedelta
+    # A view of one row of an InstanceStore. Rows move when an earlier one is inserted or
+    # removed, so the view keeps its start time and finds its row again by it when the row at
+    # index no longer has that start.
+    __slots__ = ('store', 'index', 'start')
 
     def __init__(self, start_time: datetime = None, end_time: datetime = None, duration: timedelta = None):
         if start_time == None:
-            self.start_time = datetime.now()
-        else:
-            self.start_time = start_time
-        self.end_time = end_time
-        self.duration = duration
+            start_time = datetime.now()
+        if end_time is None and duration is not None:
+            end_time = start_time + duration
+        self.store = InstanceStore()
+        self.start = datetime_to_micros(start_time)
+        self.index = self.store.insert(self.start, NO_END if end_time is None else datetime_to_micros(end_time))
+
+    def view(store: InstanceStore, index: int):
+        instance = ActivityInstance.__new__(ActivityInstance)
+        instance.store = store
+        instance.index = index
+        instance.start = store.starts[index]
+        return instance
+
+    def position(self) -> int:
+        index = self.index
+        if index >= len(self.store.starts) or self.store.starts[index] != self.start:
+            index = self.store.find(self.start)
+            if index is None:
+                raise IndexError('instance is no longer in its activity')
+            self.index = index
+        return index
+
+    @property
+    def start_time(self) -> datetime:
+        return micros_to_datetime(self.start)
+
+    @start_time.setter
+    def start_time(self, value: datetime):
+        start = datetime_to_micros(value)
+        self.index = self.store.set_start(self.position(), start)
+        self.start = start
+
+    @property
+    def end_time(self) -> datetime | None:
+        end = self.store.ends[self.position()]
+        return None if end == NO_END else micros_to_datetime(end)
+
+    @end_time.setter
+    def end_time(self, value: datetime | None):
+        self.store.set_end(self.position(), NO_END if value is None else datetime_to_micros(value))
+
+    @property
+    def duration(self) -> timedelta | None:
+        end = self.store.ends[self.position()]
+        if end == NO_END:
+            return None
+        return timedelta(microseconds=end - self.start)
+
+    @duration.setter
+    def duration(self, value: timedelta | None):
+        self.end_time = None if value is None else self.start_time + value
 
     def currently_running(self) -> bool:
-        return self.end_time is None
+        return self.store.ends[self.position()] == NO_END
 
     def stop_instance(self) -> timedelta | None:
         if not self.currently_running():
             return None
         self.end_time = datetime.now()
-        self.duration = self.end_time - self.start_time
         return self.duration
     
     def current_time(self) -> str | None:
@@ -37,49 +320,100 @@ class ActivityInstance:
         return datetime_to_str(self.start_time)
     
     def pretty_start_time(self) -> str:
-        return self.pretty_time(self.start_time)
+        return format_clock(self.start)
 
     def pretty_stop_time(self) -> str:
         return self.pretty_time(self.end_time)
 
     def pretty_date(self) -> str:
-        return self.start_time.strftime('%y/%m/%d')
+        return format_date(self.start)
 
     def pretty_time(self, t) -> str:
-        return t.strftime('%H:%M')
+        return f'{t.hour:02d}:{t.minute:02d}'
+
+class InstanceList:
+    __slots__ = ('store',)
+
+    def __init__(self, store: InstanceStore):
+        self.store = store
+
+    def __len__(self) -> int:
+        return len(self.store)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [ActivityInstance.view(self.store, k) for k in range(len(self.store))[index]]
+        if index < 0:
+            index += len(self.store)
+        if index < 0 or index >= len(self.store):
+            raise IndexError('instance index out of range')
+        return ActivityInstance.view(self.store, index)
+
+    def __iter__(self):
+        for k in range(len(self.store)):
+            yield ActivityInstance.view(self.store, k)
 
 class Activity:
     name: str
-    instances: List[ActivityInstance]
+    store: InstanceStore
+    archived_count: int
+    archived_total: int
 
-    def __init__(self, name: str, instances: List[ActivityInstance] = []):
+    def __init__(self, name: str, instances: List[ActivityInstance] = None):
         self.name = name
-        self.instances = instances
+        self.store = InstanceStore()
+        # instances in archive partitions that have not been read yet, see archive.py
+        self.archived_count = 0
+        self.archived_total = 0
+        if instances is not None:
+            self.store.extend(
+                [i.start for i in instances],
+                [i.store.ends[i.position()] for i in instances]
+            )
+
+    def from_arrays(name: str, starts: np.ndarray, ends: np.ndarray):
+        activity = Activity(name)
+        activity.store.extend(starts, ends)
+        return activity
+
+    @property
+    def instances(self) -> InstanceList:
+        return InstanceList(self.store)
 
     def add_instance(self):
-        instance = ActivityInstance()
-        self.instances.append(instance)
-        return instance
+        index = self.store.insert(datetime_to_micros(datetime.now()), NO_END)
+        return ActivityInstance.view(self.store, index)
+
+    def insert_instance(self, start_time: datetime, end_time: datetime) -> ActivityInstance:
+        index = self.store.insert(datetime_to_micros(start_time), datetime_to_micros(end_time))
+        return ActivityInstance.view(self.store, index)
+
+    def remove_instance(self, instance: ActivityInstance):
+        self.store.remove(instance.position())
 
     def delete_instance(self, start_time: str) -> bool:
         if start_time == None:
             print("Delete Instance: No start time")
             return False
-        instance = None
-        for i in self.instances:
-            if datetime_to_str(i.start_time) == start_time:
-                instance = i
-                break
-        if instance == None:
+        index = self.store.find(datetime_to_micros(str_to_datetime(start_time)))
+        if index == None:
             print(f"Delete Instance: could not find start time \"{start_time}\"")
             return False
-        self.instances.remove(instance)
+        self.store.remove(index)
         return True
 
+    def get_instance(self, start_time: datetime) -> ActivityInstance | None:
+        index = self.store.find(datetime_to_micros(start_time))
+        if index is None:
+            return None
+        return ActivityInstance.view(self.store, index)
+
     def get_last_instance(self) -> ActivityInstance | None:
-        if len(self.instances) == 0:
+        if self.store.running is not None:
+            return ActivityInstance.view(self.store, self.store.running)
+        if len(self.store) == 0:
             return None
-        return self.instances[-1]
+        return ActivityInstance.view(self.store, len(self.store) - 1)
 
     def currently_running(self) -> bool:
         last_instance = self.get_last_instance()
@@ -92,10 +426,23 @@ class Activity:
             return None
         last_instance = self.get_last_instance()
         return last_instance.stop_instance()
+
+    def finished_arrays(self):
+        starts = np.frombuffer(self.store.starts, dtype=np.int64)
+        ends = np.frombuffer(self.store.ends, dtype=np.int64)
+        finished = ends != NO_END
+        return starts[finished], ends[finished]
     
     def get_total_time(self) -> str:
-        total = sum([instance.duration for instance in self.instances], timedelta())
-        return pretty_time(total)
+        return format_duration(self.store.aggregates.total + self.archived_total)
+
+    def get_total_duration(self) -> timedelta:
+        return timedelta(microseconds=self.store.aggregates.total + self.archived_total)
+
+    def get_time_between(self, start: datetime = None, end: datetime = None) -> timedelta:
+        start = None if start is None else datetime_to_micros(start)
+        end = None if end is None else datetime_to_micros(end)
+        return timedelta(microseconds=self.store.total_between(start, end))
     
     def get_current_time(self) -> str | None:
         if not self.currently_running():
@@ -103,27 +450,70 @@ class Activity:
         return self.get_last_instance().current_time()
     
     def get_hours_last_week(self) -> timedelta:
-        now = datetime.now()
-        last_week = now - timedelta(days=6, hours=now.hour, minutes=now.minute)
-        total_time = timedelta(days=0)
-        instances_last_week = [i for i in self.instances if i.start_time >= last_week]
-        for i in instances_last_week:
-            total_time += i.duration
-        return total_time
+        return self.get_time_last_days(7)
+
+    def get_time_last_days(self, num_days: int) -> timedelta:
+        today = datetime_to_micros(datetime.now()) // DAY
+        return timedelta(microseconds=self.store.aggregates.window(num_days, today, self.store.starts, self.store.ends))
+
+    def get_daily_totals(self) -> Dict[date, timedelta]:
+        return {
+            (EPOCH + timedelta(days=day)).date(): timedelta(microseconds=total)
+            for day, total in self.store.aggregates.days(self.store.starts, self.store.ends).items() if total != 0
+        }
     
     def get_sorted_instances(self) -> List[ActivityInstance]:
-        ret_val = self.instances
-        ret_val.sort(key=lambda i: i.start_time)
-        ret_val.reverse()
-        return ret_val
+        return [ActivityInstance.view(self.store, k) for k in range(len(self.store) - 1, -1, -1)]
         
 class ActivityTracker:
     current_activity: str
     activities: Dict[str, Activity]
+    archive: 'Archive | None'
 
-    def __init__(self, activities: Dict[str, Activity] = {}):
-        self.activities = activities
+    def __init__(self, activities: Dict[str, Activity] = None):
+        self.activities = activities if activities is not None else {}
         self.current_activity = None
+        # set by archive.open_archive when older history stays on disk until it is needed
+        self.archive = None
+
+    def load_range(self, start: datetime = None, end: datetime = None) -> bool:
+        # reads archived instances starting in [start, end], returns whether anything was read
+        if self.archive is None:
+            return False
+        return self.archive.load_range(None if start is None else datetime_to_micros(start), None if end is None else datetime_to_micros(end))
+
+    def load_starts(self, starts: np.ndarray) -> bool:
+        # reads the archived partitions holding any of starts, in microseconds
+        if self.archive is None or len(starts) == 0:
+            return False
+        return self.archive.load_starts(starts)
+
+    def load_older(self, name: str) -> bool:
+        if self.archive is None:
+            return False
+        return self.archive.load_older(name)
+
+    def load_all(self) -> bool:
+        if self.archive is None:
+            return False
+        return self.archive.load_all()
+
+    def unread_periods(self) -> set | None:
+        # None when the tracker holds the whole history
+        if self.archive is None:
+            return None
+        return self.archive.unread_periods()
+
+    def unread_files(self) -> List[str]:
+        # binary files holding the rest of the history, see Archive.unread_files
+        if self.archive is None:
+            return [ ]
+        return self.archive.unread_files()
+
+    def saved(self, result):
+        # result is what save_columns returned for this tracker's snapshot
+        if self.archive is not None and result is not None:
+            self.archive.saved(*result)
 
     def get_current_activity(self) -> Activity | None:
         if self.current_activity is None:
@@ -148,6 +538,9 @@ class ActivityTracker:
     def remove_activity(self, name) -> bool: 
         if self.name_available(name):
             return False
+        if self.archive is not None:
+            # its archived partitions are rewritten without it on the next save
+            self.archive.load_activity(name)
         del self.activities[name]
         return True
     
@@ -171,10 +564,12 @@ class ActivityTracker:
 
     def unload_activity(self) -> bool:
         if self.get_current_activity() == None:
-            return
+            return False
         if self.timer_running():
-            self.stop_timer()
+            print("Unload Activity: Timer is currently running")
+            return False
         self.current_activity = None
+        return True
     
     def start_timer(self, name) -> bool:
         if self.name_available(name):
@@ -195,31 +590,55 @@ class ActivityTracker:
         self.current_activity = None
         return duration
     
-    def to_dataframe(self) -> pd.DataFrame:
-        self.stop_timer()
-        df = pd.DataFrame(columns=["Activity", "Start", "End"])
+    def to_columns(self):
+        # a running instance is left out and keeps running, it is written once it is stopped
+        names = []
+        counts = []
+        starts = [np.empty(0, dtype=np.int64)]
+        ends = [np.empty(0, dtype=np.int64)]
         for a in self.activities.values():
-            for i in a.instances:
-                df = append_df(df, {
-                    "Activity": a.name,
-                    "Start": datetime_to_str(i.start_time),
-                    "End": datetime_to_str(i.end_time)
-                })
-        
-        return df
-    
-    def from_dataframe(df: pd.DataFrame):
-        instances = { }
-        for _, row in df.iterrows():
-            name = row["Activity"]
-            if not name in instances:
-                instances[name] = [ ]
-            start = str_to_datetime(row["Start"])
-            end = str_to_datetime(row["End"])
-            duration = end - start
-            instances[name].append(ActivityInstance(start, end, duration))
+            activity_starts, activity_ends = a.finished_arrays()
+            names.append(a.name)
+            counts.append(len(activity_starts))
+            starts.append(activity_starts)
+            ends.append(activity_ends)
+        return names, counts, np.concatenate(starts), np.concatenate(ends)
+
+    def merge(self, other: 'ActivityTracker') -> int:
+        # adds the instances of other whose start is not in this tracker, the ones here win
+        added = 0
+        for name, activity in other.activities.items():
+            starts, ends = activity.finished_arrays()
+            self.add_activity(name)
+            store = self.activities[name].store
+            if len(store) > 0 and len(starts) > 0:
+                known = np.frombuffer(store.starts, dtype=np.int64)
+                found = np.minimum(np.searchsorted(known, starts), len(known) - 1)
+                fresh = known[found] != starts
+                starts, ends = starts[fresh], ends[fresh]
+            if len(starts) > 0:
+                store.extend(starts, ends)
+                added += len(starts)
+        return added
 
+    def from_columns(names: List[str], counts: List[int], starts: np.ndarray, ends: np.ndarray):
         activities = { }
-        for k in instances.keys():
-            activities[k] = Activity(k, instances[k])
-        return ActivityTracker(activities)
\ No newline at end of file
+        offset = 0
+        for name, count in zip(names, counts):
+            activities[name] = Activity.from_arrays(name, starts[offset:offset + count], ends[offset:offset + count])
+            offset += count
+        return ActivityTracker(activities)
+
+    def to_dataframe(self) -> 'pd.DataFrame':
+        return columns_to_dataframe(*self.to_columns())
+    
+    def from_dataframe(df: 'pd.DataFrame'):
+        import pandas as pd
+        starts = parse_time_column(df["Start"]).to_numpy().astype('datetime64[us]').astype(np.int64)
+        ends = parse_time_column(df["End"]).to_numpy().astype('datetime64[us]').astype(np.int64)
+        codes, names = pd.factorize(df["Activity"])
+        named = codes >= 0
+        codes = codes[named]
+        order = np.argsort(codes, kind='stable')
+        counts = np.bincount(codes, minlength=len(names))
+        return ActivityTracker.from_columns(list(names), counts.tolist(), starts[named][order], ends[named][order])
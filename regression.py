@@ -0,0 +1,127 @@
+import io
+import sys
+import json
+import time
+import random
+import platform
+import argparse
+import tempfile
+import requests
+import pandas as pd
+from datetime import datetime, timedelta
+from objects import ActivityTracker
+from journal import make_record
+from util import str_to_datetime, datetime_to_str
+from benchmark import make_tracker
+from harness import start_server, stop_server, PASSWORD
+
+# Times the hot paths at several history sizes and writes the best of a few runs to JSON,
+# so a later run can be compared against a saved baseline.
+
+def best(fn, repeat: int, setup=None) -> float:
+    # one untimed run first so imports and caches do not count against small sizes
+    times = [ ]
+    for run in range(repeat + 1):
+        if setup is not None:
+            setup()
+        begin = time.perf_counter()
+        fn()
+        if run > 0:
+            times.append(time.perf_counter() - begin)
+    return min(times)
+
+def bench_tracker(n: int, repeat: int, results: dict):
+    tracker = make_tracker(n)
+    csv_data = tracker.to_dataframe().to_csv(index=False)
+    df = pd.read_csv(io.StringIO(csv_data))
+    activities = list(tracker.activities.values())
+    largest = max(activities, key=lambda a: len(a.instances))
+    results[f'from_dataframe/{n}'] = best(lambda: ActivityTracker.from_dataframe(df), repeat)
+    results[f'to_dataframe/{n}'] = best(tracker.to_dataframe, repeat)
+    results[f'get_total_time/{n}'] = best(lambda: [a.get_total_time() for a in activities], repeat)
+    results[f'get_hours_last_week/{n}'] = best(lambda: [a.get_hours_last_week() for a in activities], repeat)
+    results[f'get_sorted_instances/{n}'] = best(largest.get_sorted_instances, repeat)
+
+    middle = largest.instances[len(largest.instances) // 2]
+    start, end = middle.start_time, middle.end_time
+    key = middle.to_string()
+    results[f'delete_instance/{n}'] = best(lambda: largest.delete_instance(key), repeat, lambda: largest.get_instance(start) or largest.insert_instance(start, end))
+
+    count = min(n, 100_000)
+    times = [i.start_time for a in activities for i in a.instances][:count]
+    strings = [datetime_to_str(t) for t in times]
+    results[f'datetime_to_str/{n}'] = best(lambda: [datetime_to_str(t) for t in times], repeat)
+    results[f'str_to_datetime/{n}'] = best(lambda: [str_to_datetime(s) for s in strings], repeat)
+
+def bench_server(n: int, repeat: int, results: dict):
+    with tempfile.TemporaryDirectory() as directory:
+        httpd, url = start_server(directory)
+        try:
+            tracker = make_tracker(n)
+            httpd.shards.get(None).commit([
+                make_record("add", a.name, i.start_time, i.end_time)
+                for a in tracker.activities.values()
+                for i in a.instances
+            ])
+            session = requests.Session()
+            revision = httpd.shards.get(None).revision
+            results[f'retrieve_full/{n}'] = best(lambda: session.post(url + '/retrieve', json={ "password": PASSWORD }).content, repeat)
+            results[f'retrieve_delta/{n}'] = best(lambda: session.post(url + '/retrieve', json={ "password": PASSWORD, "since": revision }).content, repeat)
+            rng = random.Random(n)
+            def sync():
+                start = datetime(2040, 1, 1) + timedelta(seconds=rng.randint(0, 10 ** 8))
+                change = make_record("add", "Activity 0", start, start + timedelta(minutes=5))
+                session.post(url + '/sync', json={ "password": PASSWORD, "since": httpd.shards.get(None).revision, "changes": [change] }).content
+            results[f'sync_delta/{n}'] = best(sync, repeat)
+            session.close()
+        finally:
+            stop_server(httpd)
+
+def compare(results: dict, baseline: dict, threshold: float, min_seconds: float) -> list:
+    regressions = [ ]
+    for name, seconds in results.items():
+        if name not in baseline:
+            continue
+        before = baseline[name]
+        ratio = seconds / before if before > 0 else float('inf')
+        flag = ratio > threshold and seconds - before > min_seconds
+        if flag:
+            regressions.append(name)
+        print(f'  {name:<28} {before * 1000:10.3f} ms -> {seconds * 1000:10.3f} ms  {ratio:5.2f}x{"  REGRESSION" if flag else ""}')
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Time objects.py, util.py and server hot paths and compare against a baseline')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1_000, 100_000, 1_000_000])
+    parser.add_argument('--repeat', type=int, default=5, help='runs per measurement, the fastest is kept')
+    parser.add_argument('--no-server', action='store_true', help='skip the retrieve/sync round-trips')
+    parser.add_argument('--output', default='bench_results.json')
+    parser.add_argument('--baseline', help='results file from an earlier run to compare against')
+    parser.add_argument('--threshold', type=float, default=1.25, help='slowdown ratio reported as a regression')
+    parser.add_argument('--min-ms', type=float, default=5.0, help='ignore slowdowns smaller than this many milliseconds')
+    args = parser.parse_args()
+
+    results = { }
+    for n in args.sizes:
+        print(f'{n:,} instances')
+        bench_tracker(n, args.repeat, results)
+        if not args.no_server:
+            bench_server(n, args.repeat, results)
+    with open(args.output, 'w', encoding='utf-8') as f:
+        f.write(json.dumps({
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "created": datetime.now().isoformat(timespec='seconds'),
+            "results": results
+        }, indent=2))
+    print(f'Wrote {len(results)} measurements to {args.output}')
+
+    if args.baseline is not None:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.loads(f.read())["results"]
+        print(f'Compared with {args.baseline} (regression above {args.threshold}x)')
+        regressions = compare(results, baseline, args.threshold, args.min_ms / 1000)
+        if len(regressions) > 0:
+            print(f'{len(regressions)} regressions: {", ".join(regressions)}')
+            sys.exit(1)
+        print('No regressions')
@@ -0,0 +1,131 @@
+import os
+import sys
+import csv
+import json
+import time
+import argparse
+import numpy as np
+from datetime import datetime
+from objects import ActivityTracker, DAY
+from journal import Journal, apply_record
+from storage import data_file, load_tracker
+from codec import format_seconds
+from util import datetime_to_micros
+
+# Instances count towards the day (and week) they started on, the same as the 7 day column
+
+report_kinds = ['day', 'week', 'activity']
+
+def load_config() -> dict:
+    if not os.path.exists('config.json'):
+        return { }
+    with open('config.json', 'r', encoding='utf-8') as f:
+        return json.loads(f.read())
+
+def load(path: str, journal_path: str = None) -> ActivityTracker:
+    tracker = load_tracker(path, cache=False) if os.path.exists(path) else ActivityTracker()
+    if journal_path is not None:
+        # read without repairing, the app may be appending to it right now
+        for record in Journal(journal_path, None).read(repair=False):
+            apply_record(tracker, record)
+    return tracker
+
+def select(tracker: ActivityTracker, start: datetime = None, end: datetime = None):
+    names, counts, starts, ends = tracker.to_columns()
+    codes = np.repeat(np.arange(len(names)), counts)
+    selected = np.ones(len(starts), dtype=bool)
+    if start is not None:
+        selected &= starts >= datetime_to_micros(start)
+    if end is not None:
+        selected &= starts < datetime_to_micros(end)
+    return names, codes[selected], starts[selected], ends[selected] - starts[selected]
+
+def group(keys: np.ndarray, durations: np.ndarray):
+    if len(keys) == 0:
+        return keys, durations, np.zeros(0, dtype=np.int64)
+    order = np.argsort(keys, kind='stable')
+    keys = keys[order]
+    durations = durations[order]
+    firsts = np.flatnonzero(np.concatenate([[True], keys[1:] != keys[:-1]]))
+    return keys[firsts], np.add.reduceat(durations, firsts), np.diff(np.append(firsts, len(keys)))
+
+def make_table(names, codes, totals, counts, period_name: str = None, periods: list = None) -> dict:
+    # a report is a dict of column name to list of values
+    table = { "activity": np.array(names, dtype=object)[codes].tolist() }
+    if period_name is not None:
+        table[period_name] = periods
+    table["seconds"] = (totals / 1_000_000).tolist()
+    # the text the app shows for activity totals
+    table["duration"] = [format_seconds(seconds) for seconds in (totals // 1_000_000).tolist()]
+    table["instances"] = counts.tolist()
+    return table
+
+def report_periods(names, codes, starts, durations, period_days: int, offset_days: int, period_name: str):
+    # offset_days moves the period boundaries, 1970-01-01 was a Thursday so 3 starts weeks on Monday
+    num_names = max(len(names), 1)
+    periods = (starts // DAY + offset_days) // period_days
+    keys, totals, counts = group(periods * num_names + codes, durations)
+    first_days = (keys // num_names) * period_days - offset_days
+    dates = np.datetime_as_string(first_days.astype('datetime64[D]')).tolist()
+    return make_table(names, keys % num_names, totals, counts, period_name, dates)
+
+def report_days(names, codes, starts, durations):
+    return report_periods(names, codes, starts, durations, 1, 0, "day")
+
+def report_weeks(names, codes, starts, durations):
+    return report_periods(names, codes, starts, durations, 7, 3, "week")
+
+def report_activities(names, codes, starts, durations):
+    keys, totals, counts = group(codes, durations)
+    return make_table(names, keys, totals, counts)
+
+reports = {
+    'day': report_days,
+    'week': report_weeks,
+    'activity': report_activities
+}
+
+def write_table(table: dict, f, output_format: str):
+    fields = list(table.keys())
+    rows = zip(*table.values())
+    if output_format == 'json':
+        f.write(json.dumps([dict(zip(fields, row)) for row in rows], indent=2) + '\n')
+        return
+    writer = csv.writer(f, lineterminator='\n')
+    writer.writerow(fields)
+    writer.writerows(rows)
+
+def output_path(path: str, kind: str, num_reports: int) -> str:
+    if num_reports == 1:
+        return path
+    base, extension = os.path.splitext(path)
+    return f'{base}_{kind}{extension}'
+
+def parse_date(value: str) -> datetime:
+    return datetime.fromisoformat(value)
+
+if __name__ == "__main__":
+    config = load_config()
+    parser = argparse.ArgumentParser(description='Write time totals per day, week or activity without opening the window')
+    parser.add_argument('reports', nargs='+', choices=report_kinds)
+    parser.add_argument('--from', dest='start', type=parse_date, help='only count instances starting at or after this date (YYYY-MM-DD[ HH:MM])')
+    parser.add_argument('--to', dest='end', type=parse_date, help='only count instances starting before this date')
+    parser.add_argument('--format', choices=['csv', 'json'], default='csv')
+    parser.add_argument('--output', help='file to write, with several reports the report name is added to it (default: stdout)')
+    parser.add_argument('--data', default=data_file(config.get('storage_format', 'csv')), help='history file, defaults to the one in config.json')
+    args = parser.parse_args()
+
+    begin = time.perf_counter()
+    journal_path = 'activities.journal' if config.get('storage') == 'journal' and os.path.exists('activities.journal') else None
+    tracker = load(args.data, journal_path)
+    tracker.load_range(args.start, args.end)
+    names, codes, starts, durations = select(tracker, args.start, args.end)
+    loaded = time.perf_counter()
+    for kind in args.reports:
+        table = reports[kind](names, codes, starts, durations)
+        if args.output is None:
+            write_table(table, sys.stdout, args.format)
+            continue
+        with open(output_path(args.output, kind, len(args.reports)), 'w', encoding='utf-8', newline='') as f:
+            write_table(table, f, args.format)
+    print(f'{len(starts):,} instances, loaded in {loaded - begin:.2f} s, reported in {time.perf_counter() - loaded:.2f} s', file=sys.stderr)
@@ -0,0 +1,266 @@
+import io
+import os
+import sys
+import json
+import mmap
+import struct
+import tempfile
+import importlib.util
+import numpy as np
+from objects import ActivityTracker, columns_to_dataframe
+
+BINARY_MAGIC = b'TTB1'
+BINARY_HEADER = struct.Struct('<4sIQQ')
+CACHE_MAGIC = b'TTC1'
+CACHE_HEADER = struct.Struct('<4s4xqq')
+
+file_names = {
+    'csv': 'activities.csv',
+    'binary': 'activities.ttb',
+    'parquet': 'activities.parquet',
+    'archive': 'activities.archive'
+}
+
+def lock_path(path: str) -> str:
+    return path + '.lock'
+
+def hold_lock(path: str):
+    # marks the history as held by the running app, so tools that write it can refuse. Another
+    # running app holding it is refused too, a lock left behind by a crash is taken over.
+    try:
+        fd = os.open(lock_path(path), os.O_WRONLY | os.O_CREAT | os.O_EXCL)
+    except FileExistsError:
+        holder = lock_holder(path)
+        if holder is not None and holder != os.getpid():
+            raise Exception(f'{path} is already open in the time tracker (process {holder})')
+        fd = os.open(lock_path(path), os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
+    with open(fd, 'w', encoding='utf-8') as f:
+        f.write(str(os.getpid()))
+
+def release_lock(path: str):
+    if lock_holder(path) == os.getpid():
+        os.remove(lock_path(path))
+
+def lock_holder(path: str) -> int | None:
+    # the process id holding the history, a lock left behind by a crash is ignored
+    try:
+        with open(lock_path(path), 'r', encoding='utf-8') as f:
+            pid = int(f.read().strip())
+    except (OSError, ValueError):
+        return None
+    return pid if process_running(pid) else None
+
+def process_running(pid: int) -> bool:
+    if os.name == 'nt':
+        # os.kill would terminate the process on Windows
+        import ctypes
+        kernel32 = ctypes.WinDLL('kernel32', use_last_error=True)
+        handle = kernel32.OpenProcess(0x1000, False, pid)  # PROCESS_QUERY_LIMITED_INFORMATION
+        if not handle:
+            # access denied means the process exists
+            return ctypes.get_last_error() == 5
+        code = ctypes.c_ulong()
+        kernel32.GetExitCodeProcess(handle, ctypes.byref(code))
+        kernel32.CloseHandle(handle)
+        return code.value == 259  # STILL_ACTIVE
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def data_file(storage_format: str) -> str:
+    if storage_format not in file_names:
+        raise Exception(f'Unknown storage format "{storage_format}", expected one of {", ".join(file_names)}')
+    return file_names[storage_format]
+
+def format_of(path: str) -> str:
+    extension = os.path.splitext(path)[1]
+    for storage_format, name in file_names.items():
+        if os.path.splitext(name)[1] == extension:
+            return storage_format
+    raise Exception(f'Unknown storage file extension "{extension}"')
+
+def require_parquet():
+    if importlib.util.find_spec('pyarrow') is None:
+        raise Exception('Parquet storage needs pyarrow, install it with "pip install pyarrow"')
+
+def write_binary(columns, f):
+    names, counts, starts, ends = columns
+    table = json.dumps([[name, count] for name, count in zip(names, counts)]).encode('utf-8')
+    table += b' ' * (-len(table) % 8)
+    f.write(BINARY_HEADER.pack(BINARY_MAGIC, 1, len(table), len(starts)))
+    f.write(table)
+    f.write(starts.astype('<i8').tobytes())
+    f.write(ends.astype('<i8').tobytes())
+
+def binary_columns(buffer, path: str, start: int = 0):
+    # the arrays are views of buffer
+    magic, version, table_size, num_rows = BINARY_HEADER.unpack_from(buffer, start)
+    if magic != BINARY_MAGIC or version != 1:
+        raise Exception(f'{path} is not a time tracker binary file')
+    offset = start + BINARY_HEADER.size
+    table = json.loads(buffer[offset:offset + table_size].decode('utf-8'))
+    offset += table_size
+    starts = np.frombuffer(buffer, dtype='<i8', count=num_rows, offset=offset)
+    ends = np.frombuffer(buffer, dtype='<i8', count=num_rows, offset=offset + 8 * num_rows)
+    return [t[0] for t in table], [t[1] for t in table], starts, ends
+
+def read_binary(path: str, start: int = 0) -> ActivityTracker:
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == start:
+            return ActivityTracker()
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            names, counts, starts, ends = binary_columns(buffer, path, start)
+            tracker = ActivityTracker.from_columns(names, counts, starts, ends)
+            del starts, ends
+            return tracker
+
+def read_binary_columns(path: str):
+    with open(path, 'rb') as f:
+        names, counts, starts, ends = binary_columns(f.read(), path)
+    return names, counts, starts.astype(np.int64), ends.astype(np.int64)
+
+def write_parquet(columns, path: str):
+    require_parquet()
+    import pandas as pd
+    names, counts, starts, ends = columns
+    pd.DataFrame({
+        "Activity": pd.Categorical(np.repeat(np.array(names, dtype=object), counts), categories=names),
+        "Start": starts,
+        "End": ends
+    }).to_parquet(path, index=False)
+
+def read_parquet(path: str) -> ActivityTracker:
+    require_parquet()
+    import pandas as pd
+    df = pd.read_parquet(path)
+    activity = pd.Categorical(df["Activity"])
+    order = np.argsort(activity.codes, kind='stable')
+    counts = np.bincount(activity.codes, minlength=len(activity.categories))
+    return ActivityTracker.from_columns(
+        list(activity.categories),
+        counts.tolist(),
+        df["Start"].to_numpy(np.int64)[order],
+        df["End"].to_numpy(np.int64)[order]
+    )
+
+# A CSV is parsed once and then kept next to it as a binary snapshot, keyed by the CSV's
+# modification time and size, so later starts skip both the parse and the pandas import
+
+def cache_path(path: str) -> str:
+    return path + '.cache'
+
+def cache_key(path: str):
+    st = os.stat(path)
+    return st.st_mtime_ns, st.st_size
+
+def read_cache(path: str):
+    # returns (tracker, fresh), a stale snapshot is still returned so it can be shown first
+    if not os.path.exists(cache_path(path)):
+        return None, False
+    try:
+        with open(cache_path(path), 'rb') as f:
+            magic, mtime, size = CACHE_HEADER.unpack(f.read(CACHE_HEADER.size))
+        if magic != CACHE_MAGIC:
+            return None, False
+        tracker = read_binary(cache_path(path), CACHE_HEADER.size)
+    except Exception as e:
+        print(f'Ignoring unreadable cache {cache_path(path)}: {e}')
+        return None, False
+    return tracker, os.path.exists(path) and cache_key(path) == (mtime, size)
+
+def write_cache(columns, path: str, key: tuple = None):
+    # key is the cache_key of the CSV the columns were read from, taken before reading it. The
+    # temporary file has a unique name, as another process may write the snapshot at the same time.
+    key = key if key is not None else cache_key(path)
+    fd, temp_path = tempfile.mkstemp(prefix=os.path.basename(cache_path(path)) + '.', suffix='.tmp', dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with open(fd, 'wb') as f:
+            f.write(CACHE_HEADER.pack(CACHE_MAGIC, *key))
+            write_binary(columns, f)
+        os.replace(temp_path, cache_path(path))
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+def read_csv(path: str) -> ActivityTracker:
+    import pandas as pd
+    return ActivityTracker.from_dataframe(pd.read_csv(path))
+
+def load_tracker(path: str, cache: bool = True) -> ActivityTracker:
+    # cache=False for tools that only read the history, a stale snapshot is then left for the app
+    storage_format = format_of(path)
+    if storage_format == 'archive':
+        from archive import open_archive
+        return open_archive(path)
+    if storage_format == 'binary':
+        return read_binary(path)
+    if storage_format == 'parquet':
+        return read_parquet(path)
+    tracker, fresh = read_cache(path)
+    if fresh:
+        return tracker
+    key = cache_key(path)
+    tracker = read_csv(path)
+    if cache:
+        write_cache(tracker.to_columns(), path, key)
+    return tracker
+
+def save_columns(columns, path: str, unread: set = None):
+    # columns is the (names, counts, starts, ends) tuple from ActivityTracker.to_columns, which
+    # owns its arrays, so it can be written from another thread while the tracker keeps changing.
+    # unread is ActivityTracker.unread_periods, it only matters for archives, which return what
+    # ActivityTracker.saved needs.
+    storage_format = format_of(path)
+    if storage_format == 'archive':
+        from archive import save_archive
+        return save_archive(columns, path, unread)
+    temp_path = path + '.tmp'
+    if storage_format == 'binary':
+        with open(temp_path, 'wb') as f:
+            write_binary(columns, f)
+    elif storage_format == 'parquet':
+        write_parquet(columns, temp_path)
+    else:
+        columns_to_dataframe(*columns).to_csv(temp_path, index=False)
+    with open(temp_path, 'rb+') as f:
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+    if storage_format == 'csv':
+        write_cache(columns, path)
+
+def save_tracker(tracker: ActivityTracker, path: str):
+    tracker.saved(save_columns(tracker.to_columns(), path, tracker.unread_periods()))
+
+def iter_csv(columns, rows: int = 50_000):
+    names, counts, starts, ends = columns
+    activity = np.repeat(np.arange(len(names)), counts)
+    for offset in range(0, max(len(starts), 1), rows):
+        part = slice(offset, offset + rows)
+        counts = np.bincount(activity[part], minlength=len(names)).tolist()
+        yield columns_to_dataframe(names, counts, starts[part], ends[part]).to_csv(index=False, header=offset == 0)
+
+def tracker_from_csv(data: str) -> ActivityTracker:
+    import pandas as pd
+    return ActivityTracker.from_dataframe(pd.read_csv(io.StringIO(data)))
+
+def stored_size(path: str) -> int:
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+    return os.path.getsize(path)
+
+if __name__ == "__main__":
+    if len(sys.argv) not in (3, 4):
+        print('Usage: python storage.py <input> <output> [week|month|year]')
+        print(f'Converts between {", ".join(file_names.values())} by file extension, the period sets how an archive is split')
+        sys.exit(1)
+    tracker = load_tracker(sys.argv[1])
+    tracker.load_all()
+    if format_of(sys.argv[2]) == 'archive':
+        from archive import create_archive
+        create_archive(sys.argv[2], sys.argv[3] if len(sys.argv) == 4 else 'month')
+    save_tracker(tracker, sys.argv[2])
+    print(f'Converted {sys.argv[1]} ({stored_size(sys.argv[1]):,} bytes) to {sys.argv[2]} ({stored_size(sys.argv[2]):,} bytes)')
@@ -0,0 +1,306 @@
+import os
+import json
+import itertools
+import numpy as np
+from typing import Dict, List
+from objects import ActivityTracker
+from journal import Journal, add_records, apply_record, encode_record
+from storage import read_binary_columns
+from codec import parse_timestamp
+from transfer import MIN_COMPRESS_SIZE, choose_encoding, compress
+from http_client import ServerSession
+
+# A /sync request carries at most batch_size changes, about 110 bytes each as JSON. The first
+# delta sync uploads the whole history this way, one batch per request, and queued changes
+# follow in batches too, so no request comes near the server's body size limit.
+
+BATCH_SIZE = 5000
+
+def history_columns(columns, files: List[str]):
+    # the rows of to_columns plus the ones in the archive partition files as (names, codes,
+    # starts, ends) sorted by activity and start. A partition can also hold rows that are in
+    # memory, those win. Runs on the worker thread.
+    names, counts, starts, ends = columns
+    known = { name: code for code, name in enumerate(names) }
+    parts = [ ]
+    for path in files:
+        part_names, part_counts, part_starts, part_ends = read_binary_columns(path)
+        part_codes = np.array([known.setdefault(name, len(known)) for name in part_names], dtype=np.int64)
+        parts.append((np.repeat(part_codes, part_counts), part_starts, part_ends))
+    parts.append((np.repeat(np.arange(len(names), dtype=np.int64), counts), starts, ends))
+    codes = np.concatenate([p[0] for p in parts])
+    starts = np.concatenate([p[1] for p in parts])
+    ends = np.concatenate([p[2] for p in parts])
+    order = np.lexsort((starts, codes))
+    codes, starts, ends = codes[order], starts[order], ends[order]
+    last = np.ones(len(codes), dtype=bool)
+    last[:-1] = (codes[1:] != codes[:-1]) | (starts[1:] != starts[:-1])
+    return list(known), codes[last], starts[last], ends[last]
+
+class ChangeSet:
+    # The changes in a server answer reduced to their net effect, the last remove of each
+    # activity and then the last change of each instance after it. It is worked out on the worker
+    # thread, so applying a large pull on the Tk thread costs a few array operations per activity
+    # instead of one apply_record per change.
+    revision: int
+    removed: List[dict]
+    activities: Dict[str, tuple]
+
+    def __init__(self, res: dict):
+        self.revision = res["revision"]
+        changes = res["changes"]
+        last_remove = { }
+        for k, change in enumerate(changes):
+            if change["op"] == "remove":
+                last_remove[change["activity"]] = k
+        latest = { }
+        for k, change in enumerate(changes):
+            if change["op"] in ("add", "stop", "delete") and k > last_remove.get(change["activity"], -1):
+                latest[(change["activity"], change["start"])] = change
+        self.removed = [changes[k] for k in sorted(last_remove.values())]
+        grouped = { }
+        for change in latest.values():
+            grouped.setdefault(change["activity"], ([ ], [ ]))[change["op"] == "delete"].append(change)
+        # per activity the set changes with their starts and ends, and the deletes with their starts
+        self.activities = {
+            name: (
+                sets,
+                np.array([parse_timestamp(c["start"]) for c in sets], dtype=np.int64),
+                np.array([parse_timestamp(c["end"]) for c in sets], dtype=np.int64),
+                deletes,
+                np.array([parse_timestamp(c["start"]) for c in deletes], dtype=np.int64)
+            )
+            for name, (sets, deletes) in grouped.items()
+        }
+
+    def apply(self, tracker: ActivityTracker) -> List[dict]:
+        # returns the changes that changed the tracker
+        applied = [change for change in self.removed if tracker.remove_activity(change["activity"])]
+        for name, (sets, starts, ends, deletes, deleted) in self.activities.items():
+            if len(sets) == 0 and tracker.name_available(name):
+                continue
+            tracker.load_starts(np.concatenate([starts, deleted]))
+            tracker.add_activity(name)
+            changed, removed = tracker.activities[name].store.apply(starts, ends, deleted)
+            applied.extend(itertools.compress(sets, changed.tolist()))
+            applied.extend(itertools.compress(deletes, removed.tolist()))
+        return applied
+
+class SyncClient:
+    password: str
+    user: str | None
+    timeout: float
+    session: ServerSession
+    state_path: str
+    revision: int
+    bootstrapped: bool
+    history_queued: bool
+    history_source: tuple | None
+    history: tuple | None
+    history_sent: int
+    sending: int
+    batch_size: int
+    outbox: Journal
+    sent: tuple | None
+    pending: List[dict]
+
+    def __init__(self, url: str, password: str, state_path: str = 'sync_state.json', user: str = None, timeout: float = 10, queue_path: str = 'sync_queue.jsonl', session: ServerSession = None, batch_size: int = BATCH_SIZE):
+        self.password = password
+        self.user = user
+        self.timeout = timeout
+        self.session = session if session is not None else ServerSession(url, timeout)
+        self.state_path = state_path
+        self.revision = 0
+        self.bootstrapped = False
+        self.history_queued = False
+        # the history uploaded by the first sync, see queue_history
+        self.history_source = None
+        self.history = None
+        self.history_sent = 0
+        self.sending = 0
+        self.batch_size = batch_size
+        # changes not yet acknowledged by the server survive restarts while offline
+        self.outbox = Journal(queue_path, None)
+        self.sent = None
+        self.pending = self.outbox.read()
+        if os.path.exists(self.state_path):
+            with open(self.state_path, 'r', encoding='utf-8') as f:
+                state = json.loads(f.read())
+            self.revision = state['revision']
+            self.bootstrapped = True
+
+    @property
+    def url(self) -> str:
+        return self.session.url
+
+    @url.setter
+    def url(self, url: str):
+        self.session.url = url
+
+    @property
+    def server_encodings(self) -> str | None:
+        return self.session.server_encodings
+
+    def save_state(self):
+        if not self.bootstrapped:
+            return
+        temp_path = self.state_path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            f.write(json.dumps({ "revision": self.revision }))
+        os.replace(temp_path, self.state_path)
+
+    def queue(self, record: dict):
+        if record["op"] == "start":
+            return
+        self.outbox.append(record)
+        self.pending.append(record)
+
+    def queue_history(self, tracker: ActivityTracker):
+        # only a snapshot is taken here, history_batch reads it into columns on the worker thread
+        # and formats one batch of records at a time. The history goes out before the queue.
+        self.history_source = (tracker.to_columns(), tracker.unread_files())
+        self.history_queued = True
+
+    def uploading_history(self) -> bool:
+        return self.history_source is not None or (self.history is not None and self.history_sent < len(self.history[2]))
+
+    def has_pending(self) -> bool:
+        return self.uploading_history() or len(self.pending) > 0
+
+    def history_batch(self) -> List[dict]:
+        if self.history_source is not None:
+            self.history = history_columns(*self.history_source)
+            self.history_source = None
+        names, codes, starts, ends = self.history
+        lo, hi = self.history_sent, min(self.history_sent + self.batch_size, len(starts))
+        self.sending = hi - lo
+        return list(add_records((names, codes[lo:hi], starts[lo:hi], ends[lo:hi])))
+
+    def history_rows(self, applied: List[dict]) -> Dict[str, tuple]:
+        # the (starts, ends) of the history rows not acknowledged yet that applied touched, by activity
+        names, codes, starts, ends = self.history
+        removed = set(c["activity"] for c in applied if c["op"] == "remove")
+        touched = { }
+        for change in applied:
+            if change["op"] != "remove":
+                touched.setdefault(change["activity"], [ ]).append(parse_timestamp(change["start"]))
+        rows = { }
+        for code, name in enumerate(names):
+            if name not in removed and name not in touched:
+                continue
+            lo = max(int(np.searchsorted(codes, code, 'left')), self.history_sent)
+            hi = max(int(np.searchsorted(codes, code, 'right')), lo)
+            picked = slice(lo, hi) if name in removed else lo + np.flatnonzero(np.isin(starts[lo:hi], touched[name]))
+            rows[name] = (starts[picked], ends[picked])
+        return rows
+
+    def keep_local(self, tracker: ActivityTracker, applied: List[dict], pushed: List[dict]):
+        # The server puts pushed and everything not sent yet after the changes just applied, so
+        # the local rows and records those changes touched are applied again. The rest, like
+        # records the server acknowledged, are already in the tracker.
+        if len(applied) == 0:
+            return
+        if self.history is not None:
+            for name, (starts, ends) in self.history_rows(applied).items():
+                tracker.load_starts(starts)
+                tracker.add_activity(name)
+                tracker.activities[name].store.apply(starts, ends, np.zeros(0, dtype=np.int64))
+        if len(pushed) == 0 and len(self.pending) == 0:
+            return
+        names = set(c["activity"] for c in applied)
+        removed = set(c["activity"] for c in applied if c["op"] == "remove")
+        keys = set((c["activity"], c["start"]) for c in applied if c["op"] != "remove")
+        for record in itertools.chain(pushed, self.pending):
+            name = record["activity"]
+            if record["op"] == "remove" and name in names:
+                # the records of the activity that follow it are applied again as well
+                removed.add(name)
+                apply_record(tracker, record)
+            elif name in removed or (name, record.get("start")) in keys:
+                apply_record(tracker, record)
+
+    def request(self, path: str, body: dict) -> dict:
+        body["password"] = self.password
+        if self.user is not None:
+            body["user"] = self.user
+        data = json.dumps(body).encode('utf-8')
+        headers = { "Content-Type": "application/json" }
+        # uploads are only compressed once the server has said it can decode them
+        encoding = choose_encoding(self.server_encodings) if len(data) >= MIN_COMPRESS_SIZE else None
+        if encoding is not None:
+            data = compress(data, encoding)
+            headers["Content-Encoding"] = encoding
+        return self.session.post(path, data=data, headers=headers).json()
+
+    def post(self, path: str, body: dict) -> dict | None:
+        return self.attempt(lambda: self.request(path, body))
+
+    def attempt(self, send) -> dict | None:
+        import requests
+        try:
+            return send()
+        except requests.RequestException as e:
+            print(f'Could not reach server: {e}')
+        except Exception as e:
+            print(e)
+        return None
+
+    def pull(self, tracker: ActivityTracker) -> List[dict] | None:
+        res = self.post('/retrieve', { "since": self.revision })
+        if res is None:
+            return None
+        changes = ChangeSet(res)
+        applied = changes.apply(tracker)
+        self.keep_local(tracker, applied, [ ])
+        self.revision = changes.revision
+        return applied
+
+    # push is split in three so the request can run off the Tk thread: prepare_push and
+    # finish_push touch the tracker, send does the formatting, the network round-trip and the
+    # ChangeSet
+    def prepare_push(self, tracker: ActivityTracker) -> List[dict]:
+        if not self.bootstrapped and not self.history_queued:
+            self.queue_history(tracker)
+        if self.uploading_history():
+            return [ ]
+        pushed = self.pending[:self.batch_size]
+        self.pending = self.pending[self.batch_size:]
+        return pushed
+
+    def send(self, pushed: List[dict]) -> ChangeSet:
+        self.sending = 0
+        if self.uploading_history():
+            changes = self.history_batch()
+        else:
+            changes = pushed
+            # the queue file up to the last pushed record, pending holds its records in order
+            self.sent = (self.outbox.compacted_offset + sum(len(encode_record(r)) for r in pushed), self.outbox.compacted_records + len(pushed))
+        return ChangeSet(self.request('/sync', { "since": self.revision, "changes": changes }))
+
+    def push(self, tracker: ActivityTracker) -> List[dict] | None:
+        # sends batches until nothing is left, returns None if one fails
+        applied = [ ]
+        while True:
+            pushed = self.prepare_push(tracker)
+            res = self.finish_push(tracker, pushed, self.attempt(lambda: self.send(pushed)))
+            if res is None:
+                return None
+            applied.extend(res)
+            if not self.has_pending():
+                return applied
+
+    def finish_push(self, tracker: ActivityTracker, pushed: List[dict], changes: ChangeSet | None) -> List[dict] | None:
+        if changes is None:
+            self.pending = pushed + self.pending
+            return None
+        applied = changes.apply(tracker)
+        self.keep_local(tracker, applied, pushed)
+        if self.history is not None:
+            self.history_sent += self.sending
+        else:
+            self.outbox.truncate(self.sent)
+        self.revision = changes.revision
+        if not self.uploading_history():
+            self.history = None
+            self.bootstrapped = True
+        return applied
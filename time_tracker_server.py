@@ -1,61 +1,624 @@
 import os
-import sys
+import csv
+import io
+import re
 import json
-from http.server import HTTPServer, BaseHTTPRequestHandler
+import bisect
+import itertools
+import threading
+from array import array
+from contextlib import contextmanager
+from typing import List, Dict
+from http.server import HTTPServer, ThreadingHTTPServer, BaseHTTPRequestHandler
+from codec import format_timestamp, parse_datetime, parse_timestamp
+from metrics import Metrics
+from transfer import CHUNK_SIZE, MIN_COMPRESS_SIZE, available_encodings, choose_encoding, compress, encode_chunks, ChunkedReader, LimitedReader, decoding_reader
 
 config = {}
-if not os.path.exists('config.json'):
-    raise Exception('config.json not found')
-
-with open('config.json', 'r', encoding='utf-8') as f:
-    config = json.loads(f.read())
 
 current_file = 'activities.csv'
+changes_file = 'changes.jsonl'
+users_directory = 'users'
+user_name_pattern = re.compile(r'[A-Za-z0-9_-][A-Za-z0-9_.-]*')
+
+# the fields each operation needs, all of them timestamps
+change_fields = {
+    'add': ('start', 'end'),
+    'stop': ('start', 'end'),
+    'delete': ('start',),
+    'remove': ()
+}
+
+class InvalidChange(Exception):
+    pass
+
+def check_changes(records: List[dict]):
+    # raises InvalidChange for the first record that could not be applied, before any is
+    if not isinstance(records, list):
+        raise InvalidChange('changes must be a list')
+    for k, record in enumerate(records):
+        if not isinstance(record, dict) or not isinstance(record.get('activity'), str):
+            raise InvalidChange(f'Change {k} has no activity')
+        fields = change_fields.get(record.get('op'))
+        if fields is None:
+            raise InvalidChange(f'Change {k} has unknown operation "{record.get("op")}"')
+        for field in fields:
+            value = record.get(field)
+            try:
+                parse_datetime(value)
+            except (TypeError, ValueError):
+                raise InvalidChange(f'Change {k} has no valid {field}: {value!r}')
+
+def load_config():
+    if not os.path.exists('config.json'):
+        raise Exception('config.json not found')
+
+    with open('config.json', 'r', encoding='utf-8') as f:
+        config.update(json.loads(f.read()))
+
+class ReadWriteLock:
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.readers = 0
+        self.writing = False
+        self.waiting_writers = 0
+
+    @contextmanager
+    def read(self):
+        with self.condition:
+            while self.writing or self.waiting_writers > 0:
+                self.condition.wait()
+            self.readers += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.readers -= 1
+                if self.readers == 0:
+                    self.condition.notify_all()
+
+    @contextmanager
+    def write(self):
+        with self.condition:
+            self.waiting_writers += 1
+            while self.writing or self.readers > 0:
+                self.condition.wait()
+            self.waiting_writers -= 1
+            self.writing = True
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.writing = False
+                self.condition.notify_all()
+
+class ActivityIndex:
+    starts: array
+    ends: array
+    prefix: List[int] | None
+    total: int
+
+    def __init__(self, instances: Dict[str, str] = None):
+        pairs = sorted((parse_timestamp(start), parse_timestamp(end)) for start, end in (instances or { }).items())
+        self.starts = array('q', [start for start, _ in pairs])
+        self.ends = array('q', [end for _, end in pairs])
+        self.total = sum(end - start for start, end in pairs)
+        self.prefix = None
+
+    def set(self, start: str, end: str):
+        start = parse_timestamp(start)
+        end = parse_timestamp(end)
+        index = bisect.bisect_left(self.starts, start)
+        if index < len(self.starts) and self.starts[index] == start:
+            self.total += end - self.ends[index]
+            self.ends[index] = end
+        else:
+            self.starts.insert(index, start)
+            self.ends.insert(index, end)
+            self.total += end - start
+        self.prefix = None
+
+    def remove(self, start: str):
+        start = parse_timestamp(start)
+        index = bisect.bisect_left(self.starts, start)
+        if index < len(self.starts) and self.starts[index] == start:
+            self.total -= self.ends[index] - start
+            del self.starts[index]
+            del self.ends[index]
+            self.prefix = None
+
+    def total_between(self, start: int = None, end: int = None) -> int:
+        prefix = self.prefix
+        if prefix is None:
+            prefix = list(itertools.accumulate((e - s for s, e in zip(self.starts, self.ends)), initial=0))
+            self.prefix = prefix
+        lo = 0 if start is None else bisect.bisect_left(self.starts, start)
+        hi = len(self.starts) if end is None else bisect.bisect_left(self.starts, end)
+        return prefix[hi] - prefix[lo] if hi > lo else 0
+
+    def page(self, offset: int, limit: int, newest_first: bool = True) -> List[dict]:
+        if newest_first:
+            indexes = range(len(self.starts) - 1 - offset, max(len(self.starts) - 1 - offset - limit, -1), -1)
+        else:
+            indexes = range(offset, min(offset + limit, len(self.starts)))
+        return [{ 'start': format_timestamp(self.starts[i]), 'end': format_timestamp(self.ends[i]) } for i in indexes]
+
+class QueryIndex:
+    # Built from the rows on the first query and then kept up to date by every applied change,
+    # instances count towards a range by their start time like Activity.get_time_between
+    activities: Dict[str, ActivityIndex]
+
+    def __init__(self, rows: Dict[str, Dict[str, str]]):
+        self.activities = { name: ActivityIndex(instances) for name, instances in rows.items() }
+
+    def apply(self, record: dict):
+        op = record.get('op')
+        name = record.get('activity')
+        if op == 'add' or op == 'stop':
+            self.activities.setdefault(name, ActivityIndex()).set(record['start'], record['end'])
+        elif op == 'delete' and name in self.activities:
+            self.activities[name].remove(record['start'])
+        elif op == 'remove':
+            self.activities.pop(name, None)
+
+    def totals(self, params: dict) -> dict:
+        return {
+            'totals': {
+                name: { 'seconds': activity.total / 1_000_000, 'instances': len(activity.starts) }
+                for name, activity in self.activities.items()
+            }
+        }
+
+    def range(self, params: dict) -> dict:
+        start = parse_timestamp(params['start']) if params.get('start') else None
+        end = parse_timestamp(params['end']) if params.get('end') else None
+        names = [params['activity']] if params.get('activity') else list(self.activities.keys())
+        return {
+            'totals': {
+                name: { 'seconds': self.activities[name].total_between(start, end) / 1_000_000 }
+                for name in names if name in self.activities
+            }
+        }
+
+    def instances(self, params: dict) -> dict:
+        activity = self.activities.get(params['activity'])
+        if activity is None:
+            return { 'count': 0, 'instances': [ ] }
+        offset = max(int(params.get('offset', 0)), 0)
+        limit = min(max(int(params.get('limit', 100)), 0), 10_000)
+        return {
+            'count': len(activity.starts),
+            'instances': activity.page(offset, limit, params.get('order', 'newest') != 'oldest')
+        }
+
+queries = {
+    'totals': QueryIndex.totals,
+    'range': QueryIndex.range,
+    'instances': QueryIndex.instances
+}
+
+class RevisionStore:
+    path: str
+    revision: int
+    rows: Dict[str, Dict[str, str]]
+    shared: set
+    changes: List[dict]
+    revisions: List[int]
+    index: QueryIndex | None
+    index_lock: threading.Lock
+    lock: ReadWriteLock
+
+    def __init__(self, path: str = changes_file, csv_path: str = current_file):
+        self.path = path
+        self.revision = 0
+        self.rows = { }
+        self.shared = set()
+        self.changes = [ ]
+        self.revisions = [ ]
+        self.index = None
+        self.index_lock = threading.Lock()
+        self.lock = ReadWriteLock()
+        if os.path.exists(self.path):
+            self.load()
+        elif csv_path is not None and os.path.exists(csv_path):
+            with open(csv_path, 'r', encoding='utf-8') as f:
+                self.replace_csv(f.read())
+            print(f'Imported {csv_path} into {self.path}')
+
+    def load(self):
+        offset = 0
+        with open(self.path, 'rb') as f:
+            for line in f:
+                try:
+                    if not line.endswith(b'\n'):
+                        raise ValueError('change is not terminated')
+                    change = json.loads(line.decode('utf-8'))
+                except ValueError:
+                    print(f'Dropping incomplete change after revision {self.revision}')
+                    break
+                self.apply(change)
+                self.revision = change['rev']
+                self.changes.append(change)
+                self.revisions.append(change['rev'])
+                offset += len(line)
+        if offset != os.path.getsize(self.path):
+            os.truncate(self.path, offset)
+
+    def apply(self, record: dict) -> bool:
+        if not self.apply_row(record):
+            return False
+        if self.index is not None:
+            self.index.apply(record)
+        return True
+
+    def apply_row(self, record: dict) -> bool:
+        op = record.get('op')
+        name = record.get('activity')
+        if op == 'add' or op == 'stop':
+            instances = self.rows.setdefault(name, { })
+            if instances.get(record['start']) == record['end']:
+                return False
+            self.owned(name)[record['start']] = record['end']
+            return True
+        if op == 'delete':
+            instances = self.rows.get(name, { })
+            if record['start'] not in instances:
+                return False
+            del self.owned(name)[record['start']]
+            return True
+        if op == 'remove':
+            return self.rows.pop(name, None) is not None
+        return False
+
+    def owned(self, name: str) -> Dict[str, str]:
+        # the rows of name, copied first if a snapshot may still be reading them
+        if name in self.shared:
+            self.shared.discard(name)
+            self.rows[name] = dict(self.rows[name])
+        return self.rows[name]
+
+    def snapshot(self) -> Dict[str, Dict[str, str]]:
+        # the rows as they are now, which stay readable after the lock is released. Only the
+        # outer dict is copied, the first change to an activity afterwards copies its rows.
+        self.shared = set(self.rows)
+        return dict(self.rows)
 
-def sync_activities(row: str):
-    with open(current_file, 'w', encoding='utf-8') as f:
-            f.write(row + '\n')
+    def commit(self, records: List[dict]) -> List[dict]:
+        committed = self.stage(records)
+        self.append(committed)
+        return committed
+
+    def stage(self, records: List[dict]) -> List[dict]:
+        # applies the records in memory and numbers them, append writes them to the file. The
+        # batch is checked first, a record failing halfway would leave memory ahead of the file.
+        check_changes(records)
+        committed = [ ]
+        for record in records:
+            if not self.apply(record):
+                continue
+            self.revision += 1
+            change = dict(record, rev=self.revision)
+            self.changes.append(change)
+            self.revisions.append(self.revision)
+            committed.append(change)
+        return committed
+
+    def append(self, committed: List[dict]):
+        if len(committed) > 0:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(''.join(json.dumps(c) + '\n' for c in committed))
+                f.flush()
+                os.fsync(f.fileno())
+
+    def since(self, revision: int) -> List[dict]:
+        return self.changes[bisect.bisect_right(self.revisions, revision):]
+
+    def should_compact(self) -> bool:
+        live = sum(len(instances) for instances in self.rows.values())
+        return len(self.changes) > 1000 and len(self.changes) > 2 * live
+
+    def compact(self):
+        kept = self.compacted()
+        self.rewrite(kept)
+        print(f'Compacted {len(self.changes)} changes into {len(kept)}')
+        self.changes = kept
+        self.revisions = [c['rev'] for c in kept]
+
+    def compacted(self) -> List[dict]:
+        # the latest change of each instance and the last remove of each activity
+        removed = { }
+        latest = { }
+        for change in reversed(self.changes):
+            name = change.get('activity')
+            if change['op'] == 'remove':
+                removed.setdefault(name, change['rev'])
+                continue
+            key = (name, change['start'])
+            if key not in latest and change['rev'] > removed.get(name, 0):
+                latest[key] = change
+        kept = list(latest.values())
+        kept.extend(c for c in self.changes if c['op'] == 'remove' and removed[c['activity']] == c['rev'])
+        kept.sort(key=lambda c: c['rev'])
+        return kept
+
+    def rewrite(self, kept: List[dict]):
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            f.write(''.join(json.dumps(c) + '\n' for c in kept))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.path)
+
+    def query(self, name: str, params: dict) -> dict:
+        # called under the read lock, so only the lazy parts of the index need their own lock
+        if name not in queries:
+            raise Exception(f'Unknown query "{name}"')
+        with self.index_lock:
+            if self.index is None:
+                self.index = QueryIndex(self.rows)
+            return dict(queries[name](self.index, params), revision=self.revision)
+
+    def is_empty(self) -> bool:
+        return self.revision == 0
+
+    def iter_csv(self, batch_size: int = 5000, rows: Dict[str, Dict[str, str]] = None):
+        # rows is a snapshot to write instead of the current rows
+        out = io.StringIO()
+        writer = csv.writer(out, lineterminator='\n')
+        writer.writerow(['Activity', 'Start', 'End'])
+        for name, instances in (rows if rows is not None else self.rows).items():
+            for start, end in instances.items():
+                writer.writerow([name, start, end])
+                if out.tell() >= batch_size * 32:
+                    yield out.getvalue()
+                    out.seek(0)
+                    out.truncate()
+        yield out.getvalue()
+
+    def activity_csv(self, name: str) -> str:
+        # the rows iter_csv writes for one activity
+        out = io.StringIO()
+        csv.writer(out, lineterminator='\n').writerows((name, start, end) for start, end in self.rows[name].items())
+        return out.getvalue()
+
+    def to_csv(self) -> str:
+        return ''.join(self.iter_csv())
+
+    def replace_csv(self, data) -> List[dict]:
+        return self.commit(self.csv_records(read_csv_rows(data)))
+
+    def csv_records(self, rows: Dict[str, Dict[str, str]]) -> List[dict]:
+        # the records that turn the stored rows into rows
+        records = [ ]
+        for name, instances in self.rows.items():
+            for start in instances:
+                if start not in rows.get(name, { }):
+                    records.append({ 'op': 'delete', 'activity': name, 'start': start })
+        for name, instances in rows.items():
+            for start, end in instances.items():
+                records.append({ 'op': 'add', 'activity': name, 'start': start, 'end': end })
+        return records
+
+def read_csv_rows(data) -> Dict[str, Dict[str, str]]:
+    # data is the CSV text or a stream of its lines, read without the store's lock held
+    rows = { }
+    reader = csv.reader(io.StringIO(data) if isinstance(data, str) else data)
+    next(reader, None)
+    for row in reader:
+        if len(row) < 3:
+            continue
+        rows.setdefault(row[0], { })[row[1]] = row[2]
+    return rows
+
+class ShardIndex:
+    root: str
+    password: str
+    users: Dict[str, str]
+    shards: Dict[str, RevisionStore]
+    lock: threading.Lock
+
+    def __init__(self, root: str = '.', password: str = None, users: Dict[str, str] = None):
+        self.root = root
+        self.password = password
+        self.users = users if users is not None else { }
+        self.shards = { }
+        self.lock = threading.Lock()
+
+    def authenticate(self, user: str | None, password: str) -> bool:
+        if user is None:
+            return self.password is not None and password == self.password
+        return user in self.users and password == self.users[user]
+
+    def get(self, user: str | None) -> RevisionStore:
+        store = self.shards.get(user)
+        if store is not None:
+            return store
+        with self.lock:
+            if user not in self.shards:
+                self.shards[user] = self.open(user)
+            return self.shards[user]
+
+    def open(self, user: str | None) -> RevisionStore:
+        if user is None:
+            return RevisionStore(os.path.join(self.root, changes_file), os.path.join(self.root, current_file))
+        if not user_name_pattern.fullmatch(user):
+            raise Exception(f'Invalid user name "{user}"')
+        directory = os.path.join(self.root, users_directory, user)
+        os.makedirs(directory, exist_ok=True)
+        return RevisionStore(os.path.join(directory, changes_file), None)
 
 class RequestHandler(BaseHTTPRequestHandler):
-    def do_GET(self):
-        self.send_response(200)
-        self.send_header('Content-type', 'text/plain')
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def send_body(self, status: int, content_type: str, body: bytes):
+        encoding = None
+        if len(body) >= MIN_COMPRESS_SIZE:
+            encoding = choose_encoding(self.headers.get('Accept-Encoding'))
+        if encoding is not None:
+            body = compress(body, encoding)
+        self.send_response(status)
+        self.send_header('Content-type', content_type)
+        if encoding is not None:
+            self.send_header('Content-Encoding', encoding)
+        self.send_header('Accept-Encoding', ', '.join(available_encodings()))
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.sent_bytes += len(body)
+
+    def send_stream(self, status: int, content_type: str, chunks):
+        encoding = choose_encoding(self.headers.get('Accept-Encoding'))
+        self.send_response(status)
+        self.send_header('Content-type', content_type)
+        if encoding is not None:
+            self.send_header('Content-Encoding', encoding)
+        self.send_header('Accept-Encoding', ', '.join(available_encodings()))
+        self.send_header('Transfer-Encoding', 'chunked')
         self.end_headers()
-        self.wfile.write('success'.encode())
+        for data in encode_chunks(chunks, encoding):
+            self.wfile.write(f'{len(data):x}\r\n'.encode() + data + b'\r\n')
+            self.sent_bytes += len(data)
+        self.wfile.write(b'0\r\n\r\n')
+
+    def request_body(self):
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            raw = ChunkedReader(self.rfile)
+        else:
+            raw = LimitedReader(self.rfile, int(self.headers.get('Content-Length', 0)))
+        self.raw_body = raw
+        return decoding_reader(io.BufferedReader(raw, CHUNK_SIZE), self.headers.get('Content-Encoding'))
+
+    def endpoint(self) -> str:
+        # metric names come from a fixed set so arbitrary paths cannot grow the registry
+        if self.path in ('/retrieve', '/sync'):
+            return self.path
+        if self.path.startswith('/query/') and self.path[len('/query/'):] in queries:
+            return self.path
+        return '/other'
+
+    def do_GET(self):
+        self.sent_bytes = 0
+        if self.path == '/metrics':
+            metrics = self.server.metrics
+            if not metrics.enabled:
+                self.send_body(404, 'text/plain', 'Metrics are disabled'.encode())
+                return
+            self.send_body(200, 'application/json', metrics.to_json().encode())
+            return
+        self.send_body(200, 'text/plain', 'success'.encode())
 
     def do_POST(self):
+        metrics = self.server.metrics
+        endpoint = self.endpoint()
+        self.sent_bytes = 0
+        self.raw_body = None
+        with metrics.timer('request' + endpoint):
+            err = self.handle_post()
+        metrics.count('requests' + endpoint)
+        if err:
+            metrics.count('errors' + endpoint)
+        if self.raw_body is not None:
+            metrics.observe('request_bytes' + endpoint, self.raw_body.received)
+        metrics.observe('response_bytes' + endpoint, self.sent_bytes)
+
+    def handle_post(self) -> bool:
         err = False
+        status = 401
+        streamed = False
         ret_data = 'blank'
+        content_type = 'text/plain'
+        shards = self.server.shards
         try:
-            content_length = int(self.headers['Content-Length'])
-            post_data = json.loads(self.rfile.read(content_length).decode('utf-8'))
-            if post_data['password'] != config['password']:
+            body = self.request_body()
+            if self.headers.get('Content-Type', '').startswith('text/csv'):
+                # a streamed CSV upload carries its credentials in headers so the body is read only once
+                post_data = {
+                    'user': self.headers.get('X-User'),
+                    'password': self.headers.get('X-Password'),
+                    'data': io.TextIOWrapper(body, encoding='utf-8', newline='')
+                }
+            else:
+                post_data = json.load(body)
+            user = post_data.get('user')
+            if not shards.authenticate(user, post_data['password']):
                 ret_data = 'Unauthorized'
                 raise Exception('Unauthorized')
-            if self.path =='/retrieve':
-                ret_data = ''
-                if os.path.exists(current_file):
-                    with open(current_file, 'r', encoding='utf-8') as f:
-                            ret_data = f.read()
-                else:
-                    ret_data = 'File does not exist'
-                    raise Exception('File not found')
-            if self.path == '/sync':
+            store = shards.get(user)
+            if self.path == '/retrieve' and 'since' in post_data:
+                content_type = 'application/json'
+                with store.lock.read():
+                    ret_data = json.dumps({
+                        'revision': store.revision,
+                        'changes': store.since(int(post_data['since']))
+                    })
+            elif self.path == '/retrieve':
+                # only a snapshot is taken under the lock, the chunks are built from it while
+                # they are sent, so neither a slow client nor the full CSV holds up the shard
+                with store.lock.read():
+                    if store.is_empty():
+                        ret_data = 'File does not exist'
+                        raise Exception('File not found')
+                    rows = store.snapshot()
+                streamed = True
+                self.send_stream(200, content_type, store.iter_csv(rows=rows))
+            if self.path.startswith('/query/'):
+                content_type = 'application/json'
+                with store.lock.read():
+                    ret_data = json.dumps(store.query(self.path[len('/query/'):], post_data))
+            if self.path == '/sync' and 'changes' in post_data:
+                since = int(post_data['since'])
+                content_type = 'application/json'
+                with store.lock.write():
+                    newer = store.since(since)
+                    store.commit(post_data['changes'])
+                    ret_data = json.dumps({
+                        'revision': store.revision,
+                        'changes': newer
+                    })
+                    if store.should_compact():
+                        with self.server.metrics.timer('compact'):
+                            store.compact()
+            elif self.path == '/sync':
                 ret_data = 'synced'
-                sync_activities(post_data['data'])
+                # the upload is read before taking the lock, a slow sender only holds its own thread
+                rows = read_csv_rows(post_data['data'])
+                with store.lock.write():
+                    store.commit(store.csv_records(rows))
+                    if store.should_compact():
+                        with self.server.metrics.timer('compact'):
+                            store.compact()
+        except InvalidChange as e:
+            err = True
+            status = 400
+            content_type = 'text/plain'
+            ret_data = str(e)
+            self.close_connection = True
+            print(e)
         except Exception as e:
             err = True
+            self.close_connection = True
             print(e)
         finally:
-            self.send_response(200 if not err else 401)
-            self.send_header('Content-type', 'text/plain')
-            self.end_headers()
-            self.wfile.write(ret_data.encode())
+            if not streamed:
+                self.send_body(200 if not err else status, content_type, ret_data.encode())
+        return err
+
+def make_server(server_address, shards: ShardIndex, threaded: bool = True, metrics: Metrics = None) -> HTTPServer:
+    server_class = ThreadingHTTPServer if threaded else HTTPServer
+    httpd = server_class(server_address, RequestHandler)
+    httpd.shards = shards
+    httpd.metrics = metrics if metrics is not None else Metrics()
+    return httpd
 
-def run_server(port):
+def run_server(port, threaded: bool = True):
     server_address = ('', port)
-    httpd = HTTPServer(server_address, RequestHandler)
-    print(f'Starting server on port {port}...')
+    shards = ShardIndex('.', config.get('password'), config.get('users'))
+    metrics = Metrics(config.get('metrics', False), config.get('profile'))
+    httpd = make_server(server_address, shards, threaded, metrics)
+    print(f'Starting {"threaded " if threaded else ""}server on port {port}...')
     httpd.serve_forever()
 
-run_server(config['server_port'])
+if __name__ == '__main__':
+    load_config()
+    run_server(config['server_port'], config.get('threaded', True))
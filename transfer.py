@@ -0,0 +1,166 @@
+import io
+import zlib
+import importlib.util
+from functools import lru_cache
+
+# Content encodings for /retrieve and /sync bodies, shared by the server and the clients.
+# gzip is always available, zstd when the zstandard package is installed.
+
+CHUNK_SIZE = 64 * 1024
+MIN_COMPRESS_SIZE = 1024
+
+@lru_cache(maxsize=None)
+def available_encodings() -> tuple:
+    # looked up once, every response lists them
+    if importlib.util.find_spec('zstandard') is not None:
+        return ('zstd', 'gzip')
+    return ('gzip',)
+
+def choose_encoding(accept_encoding: str | None) -> str | None:
+    if accept_encoding is None:
+        return None
+    accepted = set()
+    for item in accept_encoding.split(','):
+        parts = [p.strip() for p in item.split(';')]
+        q = 1.0
+        for param in parts[1:]:
+            if param.startswith('q='):
+                try:
+                    q = float(param[2:])
+                except ValueError:
+                    q = 0
+        if q > 0:
+            accepted.add(parts[0].lower())
+    for encoding in available_encodings():
+        if encoding in accepted:
+            return encoding
+    return None
+
+class Compressor:
+    def __init__(self, encoding: str):
+        if encoding == 'zstd':
+            import zstandard
+            self.compressor = zstandard.ZstdCompressor().compressobj()
+        elif encoding == 'gzip':
+            self.compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        else:
+            raise Exception(f'Unsupported content encoding "{encoding}"')
+
+    def compress(self, data: bytes) -> bytes:
+        return self.compressor.compress(data)
+
+    def flush(self) -> bytes:
+        return self.compressor.flush()
+
+def compress(data: bytes, encoding: str) -> bytes:
+    compressor = Compressor(encoding)
+    return compressor.compress(data) + compressor.flush()
+
+def encode_chunks(chunks, encoding: str | None):
+    # chunks is an iterable of str or bytes, the result can be sent with chunked transfer encoding
+    compressor = Compressor(encoding) if encoding is not None else None
+    pending = [ ]
+    size = 0
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode('utf-8')
+        if compressor is not None:
+            chunk = compressor.compress(chunk)
+        pending.append(chunk)
+        size += len(chunk)
+        if size >= CHUNK_SIZE:
+            yield b''.join(pending)
+            pending = [ ]
+            size = 0
+    if compressor is not None:
+        pending.append(compressor.flush())
+    data = b''.join(pending)
+    if len(data) > 0:
+        yield data
+
+class BodyTooLarge(Exception):
+    pass
+
+class CappedReader(io.RawIOBase):
+    # a decompressed body, which can be far larger than the bytes sent for it
+    def __init__(self, stream, limit: int):
+        self.stream = stream
+        self.remaining = limit
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        data = self.stream.read(min(len(buffer), self.remaining + 1))
+        if len(data) > self.remaining:
+            raise BodyTooLarge()
+        buffer[:len(data)] = data
+        self.remaining -= len(data)
+        return len(data)
+
+class LimitedReader(io.RawIOBase):
+    def __init__(self, stream, length: int):
+        self.stream = stream
+        self.remaining = length
+        self.received = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        if self.remaining <= 0:
+            return 0
+        data = self.stream.read(min(len(buffer), self.remaining))
+        if len(data) == 0:
+            raise Exception('Request body ended early')
+        buffer[:len(data)] = data
+        self.remaining -= len(data)
+        self.received += len(data)
+        return len(data)
+
+class ChunkedReader(io.RawIOBase):
+    def __init__(self, stream):
+        self.stream = stream
+        self.remaining = 0
+        self.received = 0
+        self.done = False
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        if self.done:
+            return 0
+        if self.remaining == 0:
+            line = self.stream.readline(1024)
+            self.remaining = int(line.split(b';')[0].strip(), 16)
+            if self.remaining == 0:
+                while self.stream.readline(1024) not in (b'\r\n', b'\n', b''):
+                    pass
+                self.done = True
+                return 0
+        data = self.stream.read(min(len(buffer), self.remaining))
+        if len(data) == 0:
+            raise Exception('Request body ended early')
+        buffer[:len(data)] = data
+        self.remaining -= len(data)
+        self.received += len(data)
+        if self.remaining == 0:
+            self.stream.readline(1024)
+        return len(data)
+
+def decoding_reader(stream, encoding: str | None, limit: int = None):
+    # with a limit, reading more than limit decoded bytes raises BodyTooLarge
+    if encoding is None or encoding == 'identity':
+        return stream
+    if encoding == 'gzip':
+        import gzip
+        decoded = gzip.GzipFile(fileobj=stream, mode='rb')
+    elif encoding == 'zstd' and 'zstd' in available_encodings():
+        import zstandard
+        decoded = zstandard.ZstdDecompressor().stream_reader(stream)
+    else:
+        raise Exception(f'Unsupported content encoding "{encoding}"')
+    if limit is None:
+        return decoded
+    return io.BufferedReader(CappedReader(decoded, limit), CHUNK_SIZE)
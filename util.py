@@ -1,19 +1,24 @@
-from typing import List, Dict
 from datetime import datetime, timedelta
-import pandas as pd
 import tkinter as tk
+from codec import EPOCH, MICROSECOND, datetime_to_timestamp, parse_datetime
+
+# pretty_time and pretty_duration keep str(timedelta), which runs in C and beats formatting the
+# fields in Python (see bench_codec)
 
 def pretty_time(d: timedelta) -> str:
     return str(d).split(".")[0]
 
-def append_df(df, row):
-    return pd.concat([df, pd.DataFrame.from_records([row])])   
-
 def str_to_datetime(d: str) -> datetime:
-    return datetime.strptime(d, '%y-%m-%d %H:%M:%S.%f')
+    return parse_datetime(d)
 
 def datetime_to_str(d: datetime) -> str:
-    return d.strftime('%y-%m-%d %H:%M:%S.%f')
+    return datetime_to_timestamp(d)
+
+def datetime_to_micros(d: datetime) -> int:
+    return (d - EPOCH) // MICROSECOND
+
+def micros_to_datetime(us: int) -> datetime:
+    return EPOCH + timedelta(microseconds=us)
 
 def pretty_duration(d):
     split = str(d).split('.')[0].split(':')
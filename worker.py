@@ -0,0 +1,103 @@
+import time
+import queue
+import threading
+import tkinter as tk
+from typing import Callable, Dict
+
+class Task:
+    function: Callable
+    callback: Callable | None
+    retries: int
+
+    def __init__(self, function: Callable, callback: Callable = None, retries: int = 0):
+        self.function = function
+        self.callback = callback
+        self.retries = retries
+
+class BackgroundWorker:
+    widget: tk.Misc
+    tasks: queue.Queue
+    results: queue.Queue
+    pending: Dict[str, Task]
+    lock: threading.Lock
+    backoff: float
+    poll_interval: int
+    outstanding: int
+    thread: threading.Thread
+
+    def __init__(self, widget: tk.Misc, max_tasks: int = 64, backoff: float = 0.5, poll_interval: int = 50):
+        self.widget = widget
+        self.tasks = queue.Queue(max_tasks)
+        self.results = queue.Queue()
+        self.pending = { }
+        self.lock = threading.Lock()
+        self.backoff = backoff
+        self.poll_interval = poll_interval
+        self.outstanding = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, function: Callable, callback: Callable = None, key: str = None, retries: int = 0) -> bool:
+        # Called from the Tk thread. A task with the same key as one still waiting replaces it,
+        # so a burst of saves turns into a single write of the latest snapshot.
+        task = Task(function, callback, retries)
+        with self.lock:
+            if key is not None and key in self.pending:
+                self.pending[key] = task
+                return True
+            try:
+                self.tasks.put_nowait((key, task))
+            except queue.Full:
+                print(f'Worker: queue is full, dropping {key or "task"}')
+                return False
+            if key is not None:
+                self.pending[key] = task
+        self.outstanding += 1
+        if self.outstanding == 1:
+            self.widget.after(self.poll_interval, self.poll)
+        return True
+
+    def run(self):
+        while True:
+            key, task = self.tasks.get()
+            if task is None:
+                return
+            if key is not None:
+                with self.lock:
+                    task = self.pending.pop(key)
+            self.results.put((task.callback, self.execute(task, key)))
+
+    def execute(self, task: Task, key: str | None):
+        delay = self.backoff
+        for attempt in range(task.retries + 1):
+            try:
+                return task.function()
+            except Exception as e:
+                print(f'Worker: {key or "task"} failed: {e}')
+            if attempt == task.retries:
+                break
+            with self.lock:
+                if key is not None and key in self.pending:
+                    break
+            time.sleep(delay)
+            delay *= 2
+        return None
+
+    def poll(self):
+        while True:
+            try:
+                callback, result = self.results.get_nowait()
+            except queue.Empty:
+                break
+            self.outstanding -= 1
+            if callback is not None:
+                callback(result)
+        if self.outstanding > 0:
+            self.widget.after(self.poll_interval, self.poll)
+
+    def close(self, timeout: float = 10):
+        try:
+            self.tasks.put((None, None), timeout=timeout)
+        except queue.Full:
+            return
+        self.thread.join(timeout)